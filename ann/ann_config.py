@@ -20,6 +20,13 @@ class Config(object):
   # AWS S3 upload parameters
   AWS_S3_INPUTS_BUCKET = "gas-inputs"
   AWS_S3_RESULTS_BUCKET = "gas-results"
+  # Multipart input downloads: concurrent ranged GETs of this many MB
+  AWS_S3_TRANSFER_CONCURRENCY = 10
+  AWS_S3_TRANSFER_CHUNK_SIZE_MB = 16
+  # Annotate inputs while they stream from S3 instead of downloading first
+  ANNOTATOR_STREAM_INPUT = False
+  # Write BGZF (.annot.vcf.gz) results with a tabix index
+  ANNOTATOR_COMPRESS_RESULTS = False
 
   # AWS SNS topics
   AWS_SNS_REQUESTS_NAME = "arn:aws:sns:us-east-1:127134666975:ywang27_a16_job_requests"
@@ -29,7 +36,14 @@ class Config(object):
   AWS_SQS_WAIT_TIME = 20
   AWS_SQS_MAX_MESSAGES = 10
 
+  # Concurrent annotation jobs, and jobs queued locally when all slots are busy
+  ANNOTATOR_WORKER_SLOTS = 4
+  ANNOTATOR_MAX_PENDING_JOBS = 4
+  # Seconds a received SQS message is kept invisible per heartbeat extension
+  ANNOTATOR_VISIBILITY_TIMEOUT = 300
+
   # AWS DynamoDB
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "ywang27_annotations"
+  AWS_DYNAMODB_RESULTS_INDEX_TABLE = "ywang27_results_index"
 
 ### EOF
\ No newline at end of file
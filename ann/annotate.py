@@ -12,6 +12,8 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import file_utils as fu
 import utils as u
+import reference
+from genemodel import GENE_MODELS
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -72,14 +74,6 @@ def binarySearchUniqueAndSorted(arg0, key):
     return -1 # NOT_FOUND
 
 
-"""Cleans characters not accepted by MySQL
-"""
-def clean_mysql_chars(entry):
-    entry = entry.replace("\"", "")
-    entry = entry.replace("\'", "")
-    return str(entry)
-
-
 def getFormatSpecificIndices(format='vcf'):
     chr_ind = 0
     pos_ind = 1
@@ -107,11 +101,82 @@ def getComplementary(nuc):
         return compNuc
 
 
+"""dbSNP lookup key of a record: chromosome without the 'chr' prefix,
+position, REF and the complement of REF
+"""
+def getDbSnpKey(fields, inds):
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+
+    pos = fields[inds[1]].strip()
+    ref = fields[inds[2]].strip()
+    return (chr, pos, ref, getComplementary(ref))
+
+
+"""Batched dbSNP lookup for a block of records
+Fetches all dbSNP rows at the block's positions with one keyed query per
+chromosome and batch_size positions, then matches REF (or its complement)
+in Python. Returns the matching rows of every key, in the order of keys.
+"""
+def getDbSnpRows(refdb, keys, varclass='SNV', batch_size=5000):
+    positions = {}
+    for (chr, pos, ref, compRef) in keys:
+        positions.setdefault(chr, []).append(pos)
+
+    found = {}
+    ref_ind = None
+    for chr in positions:
+        (names, found[chr]) = refdb.rows_at('dbSNP', chr, positions[chr],
+            chrom_col='CHR', pos_col='POS', match={'INFO': varclass},
+            batch_size=batch_size)
+        ref_ind = names.index('ref')
+
+    matches = []
+    for (chr, pos, ref, compRef) in keys:
+        # MySQL compares REF case-insensitively
+        alleles = (ref.upper(), compRef.upper())
+        matches.append([row for row in found[chr].get(int(pos), [])
+            if str(row[ref_ind]).upper() in alleles])
+    return matches
+
+
+"""Writes the rsids and GMAF of the matching dbSNP rows into fields
+Returns True if the record is in dbSNP
+"""
+def addDbSnpFields(fields, rows, varclass='SNV'):
+    ## reset rsid to "." - in case there was annotation from old release of dbSNP
+    fields[2] = '.'
+    if (len(rows) == 0):
+        return False
+
+    rsids = []
+    mafs = []
+    for row in rows:
+        rsids.append(str(row[3]))
+        if (str(row[7]) != '.'):
+            mafs.append('GMAF=' + str(row[7]))
+
+    maf_str=''
+    if (len(mafs) > 0):
+        maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+    if (str(fields[7]) == '.'):
+        fields[7] = 'DB' + maf_str
+    else:
+        fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+
+    fields[2] = str(';'.join(rsids))
+    return True
+
+
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    With batch_size set, records are looked up in blocks of batch_size
+    (see getDbSnpRows) instead of one query per record
 """ 
 def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
+    varclass='SNV', sep='\t', backend=None, batch_size=None):
     
     outfile = vcf + tmpextout
     fh_out = open(outfile, "w")
@@ -122,64 +187,50 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     inds = getFormatSpecificIndices(format=format)
 
     fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
+    block = []
+
+    def writeBlock(block):
+        keys = [getDbSnpKey(fields, inds) for fields in block]
+        count = 0
+        for (fields, rows) in zip(block, getDbSnpRows(refdb, keys,
+            varclass=varclass, batch_size=batch_size)):
+            if addDbSnpFields(fields, rows, varclass=varclass):
+                count = count + 1
+            fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+        return count
 
     for line in fh:
         line = line.strip()
         if not line.startswith("#"):
             fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
-
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
-
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+            if batch_size:
+                block.append(fields)
+                if (len(block) >= batch_size):
+                    var_count = var_count + writeBlock(block)
+                    block = []
 
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
+                rows = getDbSnpRows(refdb, [getDbSnpKey(fields, inds)],
+                    varclass=varclass)[0]
+
+                if addDbSnpFields(fields, rows, varclass=varclass):
+                    var_count = var_count + 1
                 fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
 
             linenum = linenum + 1
 
         else:
+            if (len(block) > 0):
+                var_count = var_count + writeBlock(block)
+                block = []
             fh_out.write(line + '\n')
 
+    if (len(block) > 0):
+        var_count = var_count + writeBlock(block)
+
     ratioInDbSnp = (var_count / float(linenum)) * 100
     fh_log.write("## Please notice that all Isoforms were counted\n")
     fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
@@ -187,17 +238,47 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
 
+"""Rows of the first bigRefGene table with a hit for a record
+    1. chrom_pos_equal_base, matching REF/ALT or their complements
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+"""
+def getBigRefGeneRows(refdb, chr, pos, ref, alt):
+    (names, found) = refdb.rows_at('chrom_pos_equal_base', chr, [pos],
+        chrom_col='CHR', pos_col='start')
+    rows = found.get(int(pos), [])
+    if (len(rows) > 0):
+        # MySQL compares the haplotypes case-insensitively
+        alleles = [(ref.upper(), alt.upper()),
+            (getComplementary(ref).upper(), getComplementary(alt).upper())]
+        ref_ind = names.index('haplotypereference')
+        alt_ind = names.index('haplotypealternate')
+        rows = [row for row in rows if (str(row[ref_ind]).upper(),
+            str(row[alt_ind]).upper()) in alleles]
+
+    if (len(rows) == 0):
+        (names, found) = refdb.rows_at('chrom_pos_equal_nobase', chr, [pos],
+            chrom_col='CHR', pos_col='start')
+        rows = found.get(int(pos), [])
+
+    if (len(rows) == 0):
+        rows = refdb.overlapping('chrom_pos_unequal', chr, int(pos),
+            chrom_col='CHR', start_col='start', end_col='end')
+    return rows
+
+
 """NOTE: all isoforms are collapsed in one record
     1. chrom_pos_equal_base
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    backend=None):
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
@@ -205,8 +286,7 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     vcf_linenum = 1
 
     for line in fh:
@@ -218,35 +298,14 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
                 chr = chr.replace('chr', '')
 
             pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+            ref = fields[inds[2]].strip()
+            alt = fields[inds[3]].strip()
 
+            rows = getBigRefGeneRows(refdb, chr, pos, ref, alt)
             if (len(rows) > 0):
-                keep_going = False
                 m = set([])
                 for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
                 fields[7] = fields[7] + ';' + ';'.join(m)
                 if (str(fields[7]).startswith(".;")):
@@ -255,41 +314,7 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
                 l = '\t'.join([str(x) for x in fields])
                 fh_out.write(l + '\n')
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
+            else:
                 fh_out.write(line + '\n')
 
             vcf_linenum = vcf_linenum + 1
@@ -297,7 +322,7 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
         else:
             fh_out.write(line + '\n')
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
@@ -305,7 +330,7 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
 """Get information about location in gene structures
 """
 def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+    tmpextin='.2', tmpextout='.3', sep='\t', backend=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -327,8 +352,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -341,18 +365,14 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                 chr = "chr" + chr
 
             pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
+            ref = fields[inds[2]].strip()
+            alt = fields[inds[3]].strip()
+            info_field = fields[7].strip()
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            rows = refdb.overlapping(table, chr,
+                int(pos) - int(promoter_offset), int(pos) + int(promoter_offset),
+                start_col='txStart', end_col='txEnd')
             info = []
 
             if (len(rows) > 0):
@@ -375,54 +395,40 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                     elif (positionType == 'utr3'):
                         utr3_count = utr3_count + 1
 
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
+                    tx = GENE_MODELS.transcript(row)
+                    txtStart = tx.txStart
+                    txtEnd = tx.txEnd
+                    cdsStart = tx.cdsStart
+                    cdsEnd = tx.cdsEnd
+                    exonCount = tx.exonCount
                     geneSymbol = str(row[12])
-                    strand = str(row[3])
+                    strand = tx.strand
 
                     promoter_plus = txtStart - int(promoter_offset)
                     promoter_minus = txtEnd + int(promoter_offset)
                     region = ""
                     pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
 
                     if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
+                        for e in tx.exons(pos):
+                            exnum = tx.exonNumber(e)
+                            exons.append("non_coding_exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
                         if (len(exons) > 0):
                             region = ";".join(exons)
                     elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
+                        for e in tx.exons(pos):
+                            exnum = tx.exonNumber(e)
+                            exons.append("exon=" +  "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            exonic_count = exonic_count + 1
                         if (len(exons) > 0):
                             region = ";".join(exons)
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and 
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = GENE_MODELS.cpgIsland(refdb, chr, pos)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -430,13 +436,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                             promoter_count = promoter_count + 1
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
+                        rows = GENE_MODELS.cpgIsland(refdb, chr, pos)
                         if (rows is not None):
                             region = 'putativePromoterRegion=' +  \
                                 "".join(str(rows[3]).split())
@@ -498,13 +498,13 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
+    refdb.close()
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
 """
 def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+    tmpextin='.2', tmpextout='.3', sep='\t', backend=None):
 
     basefile = vcf
     vcf = basefile + tmpextin
@@ -526,8 +526,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -540,48 +539,39 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                 chr = "chr" + chr
             
             pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
+            ref = fields[inds[2]].strip()
+            alt = fields[inds[3]].strip()
+            info_field = fields[7].strip()
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            rows = refdb.overlapping(table, chr,
+                int(pos) - int(promoter_offset), int(pos) + int(promoter_offset),
+                start_col='txStart', end_col='txEnd')
             info = []
             if (len(rows) > 0):
                 cnt = 1
                 for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
+                    tx = GENE_MODELS.transcript(row)
+                    txtStart = tx.txStart
+                    txtEnd = tx.txEnd
+                    cdsStart = tx.cdsStart
+                    cdsEnd = tx.cdsEnd
+                    exonCount = tx.exonCount
                     geneSymbol = str(row[12])
-                    strand = str(row[3])
+                    strand = tx.strand
 
                     promoter_plus = txtStart - int(promoter_offset)
                     promoter_minus = txtEnd + int(promoter_offset)
                     region = ""
                     pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
 
                     if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
+                        for e in tx.exons(pos):
+                            exnum = tx.exonNumber(e)
+                            exons.append("non_coding_exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
                             region='positionType=non_coding_exon;' + ";".join(exons)
                         else:
@@ -590,14 +580,11 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
                         cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
+                        for e in tx.exons(pos):
+                            exnum = tx.exonNumber(e)
+                            exons.append("exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            exonic_count=exonic_count+1
                         if (len(exons) > 0):
                             region = 'positionType=CDS;' + ";".join(exons)
                         else:
@@ -626,12 +613,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = GENE_MODELS.cpgIsland(refdb, chr, pos)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -640,12 +622,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and \
                         (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = GENE_MODELS.cpgIsland(refdb, chr, pos)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -709,13 +686,13 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
+    refdb.close()
 
 
 """Overlap with tfbsConsSites
 """
 def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+    tmpextin='.2', tmpextout='.3', sep='\t', backend=None):
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
@@ -733,8 +710,7 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
 
     linenum = 1
     for line in fh:
@@ -760,12 +736,9 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
 
             if (chrIndex in allowed_chrom):
                 isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = refdb.overlapping('tfbsConsSites' + chrIndex, None,
+                    int(pos), columns='chrom, chromStart, chromEnd, name',
+                    chrom_col=None)
                 records = []
 
                 if (len(rows) > 0):
@@ -799,7 +772,7 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
@@ -807,7 +780,7 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
 """Overlap with GadAll table
 """
 def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
+    tmpextout='.1', sep='\t', backend=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -822,8 +795,7 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -843,11 +815,8 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
                 pos = fields[inds[1]].strip()
                 isOverlap = False
 
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = refdb.overlapping(table, chr, int(pos),
+                    chrom_col='chromosome')
                 records = []
 
                 if (len(rows) > 0):
@@ -876,14 +845,14 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
 
 """ Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', backend=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -898,8 +867,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -918,10 +886,8 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
                 pos = fields[inds[1]].strip()
                 isOverlap = False
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = refdb.overlapping(table, chr, int(pos),
+                    start_col='chromEnd', end_col='chromEnd')
                 records = []
 
                 if (len(rows) > 0):
@@ -948,7 +914,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
@@ -956,7 +922,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
 def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', backend=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -971,8 +937,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -991,11 +956,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
                 pos=fields[inds[1]].strip()
                 isOverlap = False
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = refdb.overlapping(table, chr, int(pos))
                 records = []
 
                 if (len(rows) > 0):
@@ -1028,7 +989,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
@@ -1036,7 +997,8 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
 """Overlap with segdup regions genomicSuperDups
 """
 def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t',
+    backend=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1051,8 +1013,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -1075,11 +1036,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
                 otherEnd = ''
                 l = str(isOverlap)
 
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                rows = refdb.first_overlapping(table, chr, int(pos))
 
                 if rows is not None:
                     line_count = line_count + 1
@@ -1103,7 +1060,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
@@ -1112,7 +1069,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
    with which SNP or INDEL overlaps
 """
 def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', backend=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1132,8 +1089,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     endName = 'txEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -1152,12 +1108,9 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
                 pos = fields[inds[1]].strip()
                 isOverlap = False
                 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
                 overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = refdb.overlapping(table, chr, int(pos),
+                    start_col=startName, end_col=endName)
 
                 if (len(rows) > 0):
                     line_count = line_count + 1
@@ -1182,7 +1135,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
@@ -1190,7 +1143,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
 """Method to find overlap with Cytoband table
 """
 def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', backend=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1212,8 +1165,7 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         endName = 'chromEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -1232,12 +1184,9 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
                 pos = fields[inds[1]].strip()
                 isOverlap = False
                 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
                 overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = refdb.overlapping(table, chr, int(pos),
+                    start_col=startName, end_col=endName)
 
                 if (len(rows) > 0):
                     line_count = line_count + 1
@@ -1261,7 +1210,7 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
@@ -1269,7 +1218,7 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
 """Method to find overlap with CNV tables
 """
 def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', backend=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1284,8 +1233,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -1303,11 +1251,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
 
                 pos = fields[inds[1]].strip()
                 isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                rows = refdb.first_overlapping(table, chr, int(pos))
 
                 if rows is not None:
                     line_count = line_count + 1
@@ -1329,7 +1273,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
@@ -1337,7 +1281,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
 """Method to find overlap with targetScanS tables
 """
 def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', backend=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1352,8 +1296,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    refdb = reference.open_reference(backend)
     linenum = 1
 
     for line in fh:
@@ -1370,11 +1313,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
                     chr = "chr" + chr
 
                 pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                rows = refdb.first_overlapping(table, chr, int(pos))
 
                 if rows is not None:
                     line_count = line_count + 1
@@ -1396,7 +1335,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
+    refdb.close()
     fh.close()
     fh_out.close()
 
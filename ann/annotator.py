@@ -7,10 +7,77 @@ from botocore.client import Config
 from boto3.dynamodb.conditions import Attr
 from botocore.exceptions import ClientError
 import json
+import time
+import threading
+
+from scheduler import Job, JobScheduler
+from jobqueue import JobQueue, LocalQueue
+import transfer
 
 # Get configuration
 from configparser import ConfigParser
 
+# Longest receive wait while jobs are pending or running
+BUSY_WAIT_TIME = 1
+
+
+"""Polls the job requests queue and hands every message to submit_job
+requests is a jobqueue.JobQueue over SQS (or a LocalQueue stand-in).
+Receives at most as many messages as the scheduler can take, and
+batch-deletes the messages of finished jobs. While jobs are pending or
+running, receives wait at most BUSY_WAIT_TIME seconds instead of the
+full long poll, so the loop comes round to the scheduler promptly (see
+also startScheduler). Runs forever unless max_polls is set.
+"""
+def poll(requests, scheduler, submit_job, max_polls=None):
+    polls = 0
+    while (max_polls is None) or (polls < max_polls):
+        polls = polls + 1
+        scheduler.poll()
+        requests.flush()
+
+        # Leave messages in SQS for other annotators while all slots and
+        # the local queue are full
+        capacity = scheduler.capacity()
+        if (capacity == 0):
+            scheduler.paused()
+            time.sleep(1)
+            continue
+
+        # Attempt to read up to AwsSQSMaxMessages messages from the queue
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.receive_messages
+        wait_time = None if scheduler.idle() \
+            else min(BUSY_WAIT_TIME, requests.wait_time)
+        messages = requests.receive(capacity, wait_time=wait_time)
+        print(f"Read {len(messages)} messages from queue.")
+
+        for message in messages:
+            submit_job(message)
+
+        if (len(messages) > 0):
+            print(f"Scheduler: {json.dumps(scheduler.metrics())}")
+            print(f"Queue: {json.dumps(requests.stats())}")
+
+
+"""Reaps finished jobs, starts queued ones and deletes the messages of
+finished jobs every interval seconds in a daemon thread, independently
+of the receives of poll(), which may block for the whole long poll
+Errors are logged and the thread keeps running.
+"""
+def startScheduler(requests, scheduler, interval=1):
+    def run():
+        while True:
+            try:
+                scheduler.poll()
+                requests.flush()
+            except Exception as e:
+                print(f"Unable to run the job scheduler: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
 
 if __name__ == "__main__":
     config = ConfigParser(os.environ)
@@ -24,90 +91,112 @@ if __name__ == "__main__":
 
     # queue name
     queue_name = config["sqs"]["AwsSQSRequestsName"]
+    if ('ANN_LOCAL_QUEUE' in os.environ):
+        # In-memory stand-in; only receives messages sent to it in process
+        queue = LocalQueue()
+    else:
+        try:
+            queue = sqs.get_queue_by_name(QueueName=queue_name)
+        except:
+            raise Exception(f'Failure to get queue {queue_name}. Please try again.')
+
+    # Received messages stay invisible until their job has finished
+    requests = JobQueue(queue,
+        max_messages=config.getint('sqs', 'AwsSQSMaxMessages'),
+        wait_time=config.getint('sqs', 'AwsSQSWaitTime'),
+        visibility_timeout=config.getint('ann', 'AnnVisibilityTimeout'))
+    requests.startHeartbeat()
+
+    dynamodb = boto3.resource('dynamodb', region_name=config["aws"]["AwsRegionName"])
     try:
-        queue = sqs.get_queue_by_name(QueueName=queue_name)
-    except:
-        raise Exception(f'Failure to get queue {queue_name}. Please try again.')
-
-    # Poll the message queue in a loop 
-    while True:
-      
-        # Attempt to read a message from the queue
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.receive_messages
-        messages = queue.receive_messages(WaitTimeSeconds=20)
-        print(f"Read {len(messages)} messages from queue.")
-
-        for message in messages:
-            # If message read, extract job parameters from the message body as before
-            # get message body
-            mbody: str = message.body
-            mbody: dict = json.loads(mbody)
-            mbody_messages = json.loads(mbody["Message"])
-            
-            # extract params from body
-            job_id = mbody_messages["job_id"]
-            user_id = mbody_messages["user_id"]
-            bucket_name = mbody_messages['s3_inputs_bucket']
-            file_name = mbody_messages['input_file_name']
-            s3_key_input_file = mbody_messages['s3_key_input_file']
-            email = mbody_messages['email']
-
-            # Include below the same code you used in prior homework
-            # Get the input file S3 object and copy it to a local file
-            # Use a local directory structure that makes it easy to organize
-            # multiple running annotation jobs
-
-            if not os.path.isdir("jobs"):
-                os.mkdir("jobs")
-
-            create_folder = f'mkdir ./jobs/{job_id}'
-            os.system(create_folder)
-
-            # Download input file from s3
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
-            s3 = boto3.resource('s3', region_name=config["aws"]["AwsRegionName"], config=Config(signature_version='s3v4'))
-            try:
-                s3.meta.client.download_file(bucket_name, s3_key_input_file, file_name)
-            except:
-                raise Exception(f'Fail to download the file {file_name}. Please check the file is under {path}.')
-
-            # move file to /jobs/<job_id>/
-            mv_command = f"mv {file_name} ./jobs/{job_id}"
-            os.system(mv_command)
-
-            # Launch annotation job as a background process
-            target_path = f"./jobs/{job_id}/{file_name}"
-            try:
-                subprocess.Popen(["python","run.py", target_path, s3_key_input_file, job_id, email])
-            except:
-                raise Exception('Failure to launch the annotator job. Please try again.')
-
-            # Update the “job_status” key in the annotations table to “RUNNING”.
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
-            # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/LegacyConditionalParameters.AttributeUpdates.html
-            dynamodb = boto3.resource('dynamodb', region_name=config["aws"]["AwsRegionName"])
+        table = dynamodb.Table('ywang27_annotations')
+    except ClientError as e:
+        raise Exception(f'Unable to connect to DynamoDB table: {e}')
+
+    # Runs once a job leaves the local queue, before it is launched in a
+    # worker slot; returns False for a job that is no longer PENDING
+    def start_job(job):
+        # Update the “job_status” key in the annotations table to “RUNNING”.
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+        # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/LegacyConditionalParameters.AttributeUpdates.html
+        # Conditinal update: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/dynamodb.html#boto3.dynamodb.conditions.Attr
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/dynamodb.html#ref-dynamodb-conditions
+        try:
+            table.update_item(
+                Key={
+                    "job_id": job.job_id
+                },
+                UpdateExpression="SET job_status=:jobStatus",
+                ExpressionAttributeValues={
+                    ":jobStatus": "RUNNING"
+                },
+                ConditionExpression=Attr("job_status").eq("PENDING")
+            )
+        except ClientError as e:
+            # SQS may deliver a message more than once; the job has
+            # already been started from another delivery
+            if (e.response['Error']['Code'] == 'ConditionalCheckFailedException'):
+                print(f"Job {job.job_id} is not PENDING; skipping duplicate.")
+                return False
+            raise Exception(f'Cannot update Dynamodb. Please double check: {e}')
+        return True
+
+    # Delete the message from the queue once the job has finished; deletes
+    # are sent in batches by requests.flush()
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.delete_messages
+    def finish_job(job):
+        requests.done(job.message)
+
+    # Run at most AnnWorkerSlots jobs at once and queue up to
+    # AnnMaxPendingJobs more locally
+    scheduler = JobScheduler(
+        slots=config.getint('ann', 'AnnWorkerSlots'),
+        max_pending=config.getint('ann', 'AnnMaxPendingJobs'))
+
+    def submit_job(message):
+        # If message read, extract job parameters from the message body as before
+        # get message body
+        mbody: str = message.body
+        mbody: dict = json.loads(mbody)
+        mbody_messages = json.loads(mbody["Message"])
+        
+        # extract params from body
+        job_id = mbody_messages["job_id"]
+        user_id = mbody_messages["user_id"]
+        bucket_name = mbody_messages['s3_inputs_bucket']
+        file_name = mbody_messages['input_file_name']
+        s3_key_input_file = mbody_messages['s3_key_input_file']
+        email = mbody_messages['email']
+
+        # Get the input file S3 object and copy it to a local file in
+        # <AnnJobsDir>/<job_id>/, so multiple running annotation jobs are
+        # kept apart. In streaming mode run.py reads the input from S3
+        # while it annotates, so only the job directory is created here.
+        jobs_dir = config['ann']['AnnJobsDir']
+        target_path = os.path.join(jobs_dir, job_id, file_name)
+        args = ["python","run.py", target_path, s3_key_input_file, job_id, email]
+        if config.getboolean('ann', 'AnnStreamInput'):
+            args.append('--stream-input')
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        else:
             try:
-                table = dynamodb.Table('ywang27_annotations')
+                transfer.download_input(bucket_name, s3_key_input_file,
+                    jobs_dir, job_id, file_name, config["aws"]["AwsRegionName"],
+                    max_concurrency=config.getint('s3', 'AwsS3TransferConcurrency'),
+                    chunk_size=config.getint('s3', 'AwsS3TransferChunkSizeMB') * transfer.MB)
             except ClientError as e:
-                raise Exception(f'Unable to connect to DynamoDB table: {e}')
-
-            # Conditinal update: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/dynamodb.html#boto3.dynamodb.conditions.Attr
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/dynamodb.html#ref-dynamodb-conditions
-            try:
-                table.update_item(
-                    Key={
-                        "job_id": job_id
-                    },
-                    UpdateExpression="SET job_status=:jobStatus",
-                    ExpressionAttributeValues={
-                        ":jobStatus": "RUNNING"
-                    },
-                    ConditionExpression=Attr("job_status").eq("PENDING")
-                )
-            except:
-                raise Exception('Cannot update Dynamodb. Please double check.')
-
-            # Delete the message from the queue, if job was successfully submitted
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Message.delete
-            message.delete()
+                raise Exception(f'Fail to download the file {file_name}: {e}')
+
+        # Queue the annotation job; it is launched as a background
+        # process as soon as a worker slot is free
+        try:
+            scheduler.submit(Job(job_id, args,
+                message=message, on_start=start_job, on_finish=finish_job))
+        except:
+            raise Exception('Failure to launch the annotator job. Please try again.')
+
+    # Reap and start jobs every second, and poll the message queue in a
+    # loop
+    startScheduler(requests, scheduler)
+    poll(requests, scheduler, submit_job)
@@ -14,13 +14,18 @@ from flask import Flask, jsonify, request, redirect
 
 import json
 import os
-import subprocess
+import threading
+import time
 
 import boto3
 from botocore.client import Config
 from boto3.dynamodb.conditions import Attr
 from botocore.exceptions import ClientError
 
+from scheduler import Job, JobScheduler
+from jobqueue import JobQueue
+import transfer
+
 app = Flask(__name__)
 environment = 'ann_config.Config'
 app.config.from_object(environment)
@@ -93,6 +98,151 @@ except ClientError as e:
 
   sqs = boto3.resource('sqs', region_name=app.config.get("AWS_REGION_NAME"))
   queue = sqs.get_queue_by_name(QueueName=queue_name)
+# Run at most ANNOTATOR_WORKER_SLOTS jobs at once and queue up to
+# ANNOTATOR_MAX_PENDING_JOBS more locally
+scheduler = JobScheduler(
+  slots=app.config.get("ANNOTATOR_WORKER_SLOTS"),
+  max_pending=app.config.get("ANNOTATOR_MAX_PENDING_JOBS"))
+
+# Received messages stay invisible until their job has finished
+requests_queue = JobQueue(queue,
+  max_messages=app.config.get("AWS_SQS_MAX_MESSAGES"),
+  wait_time=app.config.get("AWS_SQS_WAIT_TIME"),
+  visibility_timeout=app.config.get("ANNOTATOR_VISIBILITY_TIMEOUT"))
+requests_queue.startHeartbeat()
+
+# Set when a notification arrived while the scheduler was full
+receive_deferred = threading.Event()
+# Notifications and the scheduler thread must not receive concurrently
+receive_lock = threading.Lock()
+
+dynamodb = boto3.resource('dynamodb', region_name=app.config.get("AWS_REGION_NAME"))
+try:
+  table = dynamodb.Table(app.config.get("AWS_DYNAMODB_ANNOTATIONS_TABLE"))
+except ClientError as e:
+  raise Exception(f'Unable to connect to DynamoDB table: {e}')
+
+# Runs once a job leaves the local queue, before it is launched in a
+# worker slot; returns False for a job that is no longer PENDING
+def start_job(job):
+  # Update the “job_status” key in the annotations table to “RUNNING”.
+  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+  # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/LegacyConditionalParameters.AttributeUpdates.html
+  # Conditinal update: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/dynamodb.html#boto3.dynamodb.conditions.Attr
+  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/dynamodb.html#ref-dynamodb-conditions
+  try:
+    table.update_item(
+      Key={
+          "job_id": job.job_id
+      },
+      UpdateExpression="SET job_status=:jobStatus",
+      ExpressionAttributeValues={
+          ":jobStatus": "RUNNING"
+      },
+      ConditionExpression=Attr("job_status").eq("PENDING")
+    )
+  except ClientError as e:
+    # SQS may deliver a message more than once; the job has already been
+    # started from another delivery
+    if (e.response['Error']['Code'] == 'ConditionalCheckFailedException'):
+      print(f"Job {job.job_id} is not PENDING; skipping duplicate.")
+      return False
+    raise Exception(f'Cannot update Dynamodb. Please double check: {e}')
+  return True
+
+# Delete the message from the queue once the job has finished; deletes
+# are sent in batches by requests_queue.flush()
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.delete_messages
+def finish_job(job):
+  requests_queue.done(job.message)
+
+'''
+Receives job requests from SQS and queues them in the scheduler, waiting
+up to wait_time (default: AWS_SQS_WAIT_TIME) seconds for a message
+Leaves messages in SQS (backpressure) while the scheduler is full.
+'''
+def receive_jobs(wait_time=None):
+  with receive_lock:
+    capacity = scheduler.capacity()
+    if (capacity == 0):
+      scheduler.paused()
+      receive_deferred.set()
+      return
+
+    receive_deferred.clear()
+    messages = requests_queue.receive(capacity, wait_time=wait_time)
+    print(f"Read {len(messages)} messages from queue.")
+
+    for message in messages:
+      # If message read, extract job parameters from the message body as before
+      # get message body
+      mbody: str = message.body
+      mbody: dict = json.loads(mbody)
+      mbody_messages = json.loads(mbody["Message"])
+
+      # extract params from body
+      job_id = mbody_messages["job_id"]
+      user_id = mbody_messages["user_id"]
+      bucket_name = mbody_messages['s3_inputs_bucket']
+      file_name = mbody_messages['input_file_name']
+      s3_key_input_file = mbody_messages['s3_key_input_file']
+      email = mbody_messages['email']
+      # role = mbody_messages['role']
+
+      # Get the input file S3 object and copy it to a local file in
+      # ANNOTATOR_JOBS_DIR/<job_id>/, so multiple running annotation jobs
+      # are kept apart. In streaming mode run.py reads the input from S3
+      # while it annotates, so only the job directory is created here.
+      jobs_dir = app.config.get("ANNOTATOR_JOBS_DIR")
+      target_path = os.path.join(jobs_dir, job_id, file_name)
+      args = ["python","run.py", target_path, s3_key_input_file, job_id, email, user_id]
+      if app.config.get("ANNOTATOR_STREAM_INPUT"):
+        args.append('--stream-input')
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+      else:
+        try:
+          transfer.download_input(bucket_name, s3_key_input_file,
+            jobs_dir, job_id, file_name, app.config.get("AWS_REGION_NAME"),
+            max_concurrency=app.config.get("AWS_S3_TRANSFER_CONCURRENCY"),
+            chunk_size=app.config.get("AWS_S3_TRANSFER_CHUNK_SIZE_MB") * transfer.MB)
+        except ClientError as e:
+          raise Exception(f'Fail to download the file {file_name}: {e}')
+
+      # Queue the annotation job; it is launched as a background
+      # process as soon as a worker slot is free
+      try:
+        scheduler.submit(Job(job_id, args,
+          message=message, on_start=start_job, on_finish=finish_job))
+      except:
+        raise Exception('Failure to launch the annotator job. Please try again.')
+
+    if (len(messages) > 0):
+      print(f"Scheduler: {json.dumps(scheduler.metrics())}")
+      print(f"Queue: {json.dumps(requests_queue.stats())}")
+
+
+'''
+Reaps finished jobs, starts queued ones, deletes the messages of finished
+jobs and resumes receiving once a notification had to be deferred. The
+deferred receive does not wait for messages, so it never holds up the
+loop or the notifications waiting on receive_lock. Errors are logged and
+the loop keeps running.
+'''
+def run_scheduler():
+  while True:
+    try:
+      scheduler.poll()
+      requests_queue.flush()
+      if receive_deferred.is_set() and (scheduler.capacity() > 0):
+        receive_jobs(wait_time=0)
+    except Exception as e:
+      print(f"Unable to run the job scheduler: {e}")
+    time.sleep(1)
+
+threading.Thread(target=run_scheduler, daemon=True).start()
+
+
 '''
 A13 - Replace polling with webhook in annotator
 
@@ -127,90 +277,23 @@ def annotate():
   
   # Process job request notification
   else:
-    messages = queue.receive_messages(WaitTimeSeconds=20)
-    print(f"Read {len(messages)} messages from queue.")
-
-    for message in messages:
-      # If message read, extract job parameters from the message body as before
-      # get message body
-      mbody: str = message.body
-      mbody: dict = json.loads(mbody)
-      mbody_messages = json.loads(mbody["Message"])
-      
-      # extract params from body
-      job_id = mbody_messages["job_id"]
-      user_id = mbody_messages["user_id"]
-      bucket_name = mbody_messages['s3_inputs_bucket']
-      file_name = mbody_messages['input_file_name']
-      s3_key_input_file = mbody_messages['s3_key_input_file']
-      email = mbody_messages['email']
-      # role = mbody_messages['role']
-
-      # Include below the same code you used in prior homework
-      # Get the input file S3 object and copy it to a local file
-      # Use a local directory structure that makes it easy to organize
-      # multiple running annotation jobs
-
-      if not os.path.isdir("jobs"):
-        os.mkdir("jobs")
-
-      create_folder = f'mkdir ./jobs/{job_id}'
-      os.system(create_folder)
-
-      # Download input file from s3
-      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
-      s3 = boto3.resource('s3', region_name=app.config.get("AWS_REGION_NAME"), config=Config(signature_version='s3v4'))
-      try:
-        s3.meta.client.download_file(bucket_name, s3_key_input_file, file_name)
-      except:
-        raise Exception(f'Fail to download the file {file_name}. Please check the file is under {path}.')
-
-      # move file to /jobs/<job_id>/
-      mv_command = f"mv {file_name} ./jobs/{job_id}"
-      os.system(mv_command)
-
-      # Launch annotation job as a background process
-      target_path = f"./jobs/{job_id}/{file_name}"
-      try:
-        subprocess.Popen(["python","run.py", target_path, s3_key_input_file, job_id, email, user_id])
-      except:
-        raise Exception('Failure to launch the annotator job. Please try again.')
-
-      # Update the “job_status” key in the annotations table to “RUNNING”.
-      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
-      # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/LegacyConditionalParameters.AttributeUpdates.html
-      dynamodb = boto3.resource('dynamodb', region_name=app.config.get("AWS_REGION_NAME"))
-      try:
-        table = dynamodb.Table(app.config.get("AWS_DYNAMODB_ANNOTATIONS_TABLE"))
-      except ClientError as e:
-        raise Exception(f'Unable to connect to DynamoDB table: {e}')
-
-      # Conditinal update: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
-      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/dynamodb.html#boto3.dynamodb.conditions.Attr
-      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/dynamodb.html#ref-dynamodb-conditions
-      try:
-        table.update_item(
-          Key={
-              "job_id": job_id
-          },
-          UpdateExpression="SET job_status=:jobStatus",
-          ExpressionAttributeValues={
-              ":jobStatus": "RUNNING"
-          },
-          ConditionExpression=Attr("job_status").eq("PENDING")
-        )
-      except:
-        raise Exception('Cannot update Dynamodb. Please double check.')
-
-      # Delete the message from the queue, if job was successfully submitted
-      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Message.delete
-      message.delete()
+    receive_jobs()
 
   return jsonify({
     "code": 200, 
     "message": "Annotation job request processed."
   }), 200
 
+
+'''
+Worker slot utilisation and local queue depth, for autoscaling
+'''
+@app.route('/scheduler-metrics', methods=['GET'])
+def scheduler_metrics():
+  metrics = scheduler.metrics()
+  metrics['queue'] = requests_queue.stats()
+  return jsonify(metrics), 200
+
 app.run('0.0.0.0', debug=True)
 
 ### EOF
\ No newline at end of file
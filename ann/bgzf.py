@@ -0,0 +1,376 @@
+# bgzf.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Compressed VCF input and output
+#
+# Inputs may be plain text, gzip or BGZF (.vcf.gz); open_text reads all
+# three. Results can be written as BGZF: a series of gzip members of at
+# most 64 KB of text each, so every block can be decompressed on its own
+# and the file is still a valid .gz. Blocks are compressed by a pool of
+# threads (zlib releases the GIL). build_index writes a tabix (.tbi)
+# index for a coordinate-sorted BGZF VCF, and fetch uses it to read the
+# records of a region without decompressing the whole file.
+#
+# See the SAM/BAM format specification, section 4.1 (BGZF), and the
+# tabix index format (Li H., Bioinformatics 27(5), 2011).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import gzip
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+COMPRESSED_EXTS = ['.gz', '.bgz']
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Text per block; keeps even incompressible blocks under the 64 KB limit
+BLOCK_SIZE = 0xff00
+
+# 18-byte BGZF member header; the last field is the block size - 1
+HEADER = struct.Struct('<4BI2BH2BHH')
+
+EOF_BLOCK = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def is_compressed_name(path):
+    return any([path.endswith(ext) for ext in COMPRESSED_EXTS])
+
+
+def is_compressed(path):
+    with open(path, 'rb') as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+"""Opens a plain, gzip or BGZF file for reading text lines
+"""
+def open_text(path):
+    if is_compressed(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+"""Decompresses a stream of gzip/BGZF bytes chunks (any number of members)
+Yields decompressed chunks; plain chunks are passed through
+"""
+def iter_decompress(chunks):
+    chunks = iter(chunks)
+    decompressor = None
+    for chunk in chunks:
+        if decompressor is None:
+            if (chunk[:2] != GZIP_MAGIC):
+                yield chunk
+                for chunk in chunks:
+                    yield chunk
+                return
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+        while chunk:
+            yield decompressor.decompress(chunk)
+            # The next member starts in the unused data of this one
+            chunk = decompressor.unused_data
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                chunk = b''
+
+
+"""One BGZF block holding data
+"""
+def compress_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+        len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+        len(data))
+
+
+"""Writes a BGZF file, compressing blocks on a pool of threads
+Accepts str (encoded as UTF-8) or bytes. Blocks are written in order.
+"""
+class BgzfWriter(object):
+    def __init__(self, path, threads=None, level=6):
+        self.fh = open(path, 'wb')
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer += data
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.submit(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def submit(self, block):
+        self.pending.append(self.pool.submit(compress_block, block,
+            self.level))
+        # Keep a few blocks per thread in flight
+        while (len(self.pending) > 4 * self.threads):
+            self.fh.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fh.write(self.pending.popleft().result())
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Opens path for writing text: BGZF if it ends in .gz, plain otherwise
+"""
+def open_output(path, threads=None):
+    if is_compressed_name(path):
+        return BgzfWriter(path, threads=threads)
+    return open(path, 'w')
+
+
+"""Reads a BGZF file block by block with virtual offsets
+A virtual offset is (file offset of the block << 16) | offset in the
+uncompressed block, as used by .tbi indexes.
+"""
+class BgzfReader(object):
+    def __init__(self, path):
+        self.fh = open(path, 'rb')
+        self.block_offset = 0
+        self.next_offset = 0
+        self.data = b''
+        self.within = 0
+
+    def close(self):
+        self.fh.close()
+
+    def readBlock(self):
+        self.block_offset = self.next_offset
+        self.fh.seek(self.block_offset)
+        header = self.fh.read(HEADER.size)
+        if (len(header) < HEADER.size):
+            self.data = b''
+            return False
+        fields = HEADER.unpack(header)
+        if (fields[0:4] != (31, 139, 8, 4)) or (fields[8:11] != (66, 67, 2)):
+            raise ValueError(f"Not a BGZF block at offset {self.block_offset}")
+        rest = self.fh.read(fields[11] + 1 - HEADER.size)
+        self.data = zlib.decompress(rest[:-8], -zlib.MAX_WBITS)
+        self.next_offset = self.block_offset + fields[11] + 1
+        self.within = 0
+        return True
+
+    def seek(self, voffset):
+        self.next_offset = voffset >> 16
+        self.readBlock()
+        self.within = voffset & 0xffff
+
+    def tell(self):
+        if (self.within == len(self.data)):
+            return self.next_offset << 16
+        return (self.block_offset << 16) | self.within
+
+    """Next line (bytes, with its newline) and the virtual offsets of its
+    start and end; (b'', end, end) at the end of the file
+    """
+    def readline(self):
+        start = None
+        parts = []
+        while True:
+            if (self.within == len(self.data)) and not self.readBlock():
+                end = self.tell()
+                return (b''.join(parts), end if start is None else start, end)
+            if start is None:
+                start = self.tell()
+            newline = self.data.find(b'\n', self.within)
+            if (newline < 0):
+                parts.append(self.data[self.within:])
+                self.within = len(self.data)
+                continue
+            parts.append(self.data[self.within:newline + 1])
+            self.within = newline + 1
+            return (b''.join(parts), start, self.tell())
+
+
+"""UCSC bin of the 0-based, half-open region [beg, end)
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    for (shift, offset) in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if (beg >> shift) == (end >> shift):
+            return offset + (beg >> shift)
+    return 0
+
+
+"""All bins that may hold records overlapping [beg, end)
+"""
+def reg2bins(beg, end):
+    # Bins cover positions up to 2^29, as in htslib
+    end = min(end, 1 << 29) - 1
+    bins = [0]
+    for (shift, offset) in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+"""Writes <path>.tbi for a BGZF VCF sorted by chromosome and position
+Returns the index path, or None if the records are not sorted.
+"""
+def build_index(path, sep='\t'):
+    refs = []
+    indexes = {}
+    last = (None, -1)
+    reader = BgzfReader(path)
+    try:
+        while True:
+            (line, start, end) = reader.readline()
+            if not line:
+                break
+            if line.startswith(b'#'):
+                continue
+            fields = line.rstrip(b'\r\n').split(sep.encode(), 4)
+            chrom = fields[0].decode('utf-8')
+            beg = int(fields[1]) - 1
+            stop = beg + max(len(fields[3]), 1) if len(fields) > 3 else beg + 1
+
+            if (chrom != last[0]):
+                if chrom in indexes:
+                    return None
+                refs.append(chrom)
+                indexes[chrom] = ({}, [])
+            elif (beg < last[1]):
+                return None
+            last = (chrom, beg)
+
+            (bins, linear) = indexes[chrom]
+            chunks = bins.setdefault(reg2bin(beg, stop), [])
+            if chunks and (chunks[-1][1] == start):
+                chunks[-1][1] = end
+            else:
+                chunks.append([start, end])
+
+            for window in range(beg >> 14, ((stop - 1) >> 14) + 1):
+                if (window >= len(linear)):
+                    linear.extend([None] * (window + 1 - len(linear)))
+                if linear[window] is None:
+                    linear[window] = start
+    finally:
+        reader.close()
+
+    names = b''.join([name.encode('utf-8') + b'\x00' for name in refs])
+    out = io.BytesIO()
+    # VCF preset: format 2, sequence in column 1, start in column 2,
+    # end from REF, '#' header lines
+    out.write(b'TBI\x01' + struct.pack('<8i', len(refs), 2, 1, 2, 0,
+        ord('#'), 0, len(names)) + names)
+    for chrom in refs:
+        (bins, linear) = indexes[chrom]
+        out.write(struct.pack('<i', len(bins)))
+        for (bin, chunks) in sorted(bins.items()):
+            out.write(struct.pack('<Ii', bin, len(chunks)))
+            for (beg, end) in chunks:
+                out.write(struct.pack('<QQ', beg, end))
+        previous = 0
+        for (i, offset) in enumerate(linear):
+            if offset is None:
+                linear[i] = previous
+            previous = linear[i]
+        out.write(struct.pack('<i', len(linear)))
+        out.write(struct.pack(f'<{len(linear)}Q', *linear))
+
+    index_path = path + '.tbi'
+    with BgzfWriter(index_path, threads=1) as fh:
+        fh.write(out.getvalue())
+    return index_path
+
+
+"""Reads a .tbi index into {chrom: (bins, linear)}
+"""
+def read_index(index_path):
+    with gzip.open(index_path, 'rb') as fh:
+        data = fh.read()
+    if (data[:4] != b'TBI\x01'):
+        raise ValueError(f"Not a tabix index: {index_path}")
+    (n_ref, format, col_seq, col_beg, col_end, meta, skip, l_nm) = \
+        struct.unpack_from('<8i', data, 4)
+    pos = 36
+    names = data[pos:pos + l_nm].split(b'\x00')[:n_ref]
+    pos = pos + l_nm
+
+    indexes = {}
+    for name in names:
+        (n_bin,) = struct.unpack_from('<i', data, pos)
+        pos = pos + 4
+        bins = {}
+        for i in range(n_bin):
+            (bin, n_chunk) = struct.unpack_from('<Ii', data, pos)
+            pos = pos + 8
+            bins[bin] = [struct.unpack_from('<QQ', data, pos + 16 * j)
+                for j in range(n_chunk)]
+            pos = pos + 16 * n_chunk
+        (n_intv,) = struct.unpack_from('<i', data, pos)
+        pos = pos + 4
+        linear = list(struct.unpack_from(f'<{n_intv}Q', data, pos))
+        pos = pos + 8 * n_intv
+        indexes[name.decode('utf-8')] = (bins, linear)
+    return indexes
+
+
+"""Records of a BGZF VCF overlapping chrom:start-end (1-based, inclusive)
+Reads only the blocks the .tbi index points to
+"""
+def fetch(path, chrom, start, end, sep='\t'):
+    indexes = read_index(path + '.tbi')
+    if chrom not in indexes:
+        return []
+    (bins, linear) = indexes[chrom]
+    (beg, stop) = (start - 1, end)
+
+    window = beg >> 14
+    min_offset = linear[window] if (window < len(linear)) else \
+        (linear[-1] if linear else 0)
+    chunks = sorted([chunk for bin in reg2bins(beg, stop)
+        for chunk in bins.get(bin, []) if (chunk[1] > min_offset)])
+
+    records = []
+    seen = set()
+    reader = BgzfReader(path)
+    try:
+        for (chunk_beg, chunk_end) in chunks:
+            reader.seek(max(chunk_beg, min_offset))
+            while True:
+                (line, line_start, line_end) = reader.readline()
+                if (not line) or (line_start >= chunk_end):
+                    break
+                if line_start in seen:
+                    continue
+                seen.add(line_start)
+                fields = line.decode('utf-8').rstrip('\r\n').split(sep)
+                if (fields[0] != chrom):
+                    continue
+                rec_beg = int(fields[1]) - 1
+                rec_end = rec_beg + max(len(fields[3]), 1)
+                if (rec_beg < stop) and (rec_end > beg):
+                    records.append('\t'.join(fields))
+    finally:
+        reader.close()
+    return records
+
+### EOF
@@ -0,0 +1,111 @@
+# cnvflags.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Vectorized boolean overlap flags for the CNV tables
+#
+# addOverlapWithCnvDatabase only records whether any interval of a table
+# contains a variant. Instead of one lookup per variant and table, the
+# positions of a block of records are grouped by chromosome and tested
+# against each table at once: the intervals are sorted by start, and a
+# position p is contained in some interval iff the largest end among the
+# intervals starting at or before p is >= p. That is one searchsorted and
+# one comparison per chromosome and table.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import numpy as np
+
+import pipeline
+
+
+"""Closed [start, end] intervals sorted by start, with the running
+maximum of their ends
+"""
+class FlagIndex(object):
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        order = np.argsort(starts, kind='stable')
+        self.starts = starts[order]
+        self.max_ends = np.maximum.accumulate(ends[order]) \
+            if (len(order) > 0) else ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Boolean array: whether each of positions lies in any interval
+    """
+    def contains(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        if (len(self.starts) == 0):
+            return np.zeros(len(positions), dtype=bool)
+        k = np.searchsorted(self.starts, positions, side='right')
+        return (k > 0) & (self.max_ends[np.maximum(k - 1, 0)] >= positions)
+
+
+"""Boolean CNV flags for all CNV tables in one pass over a block;
+replaces one pipeline.CnvStage per table with identical output
+"""
+class CnvFlagsStage(pipeline.Stage):
+    def __init__(self, format='vcf', tables=pipeline.CNV_TABLES):
+        pipeline.Stage.__init__(self, table=None, format=format)
+        self.tables = list(tables)
+        self.var_count = dict([(table, 0) for table in self.tables])
+        self.indexes = {}
+
+    def open(self, reference):
+        pipeline.Stage.open(self, reference)
+        self.indexes = {}
+
+    """FlagIndex of table on chrom, loaded the first time it is used
+    """
+    def getIndex(self, table, chrom):
+        key = (table, chrom)
+        index = self.indexes.get(key)
+        if index is None:
+            (starts, ends) = self.reference.intervals(table, chrom)
+            index = self.indexes[key] = FlagIndex(starts, ends)
+        return index
+
+    def annotate(self, fields):
+        self.annotate_block([fields])
+
+    def annotate_block(self, block):
+        rows_by_chrom = {}
+        for (i, fields) in enumerate(block):
+            rows_by_chrom.setdefault(self.getChrom(fields), []).append(i)
+
+        flags = dict([(table, np.zeros(len(block), dtype=bool))
+            for table in self.tables])
+        for (chrom, rows) in rows_by_chrom.items():
+            positions = [int(self.getPos(block[i])) for i in rows]
+            for table in self.tables:
+                flags[table][rows] = \
+                    self.getIndex(table, chrom).contains(positions)
+
+        for table in self.tables:
+            self.var_count[table] += int(np.count_nonzero(flags[table]))
+            flags[table] = flags[table].tolist()
+
+        for (i, fields) in enumerate(block):
+            for table in self.tables:
+                if flags[table][i]:
+                    pipeline.appendInfo(fields, str(table) + '=' + str(True))
+
+    def counters(self):
+        return {'var_count': dict(self.var_count)}
+
+    def merge(self, counters):
+        for (table, count) in counters['var_count'].items():
+            self.var_count[table] += count
+
+    def report(self, fh_log):
+        # Every flagged variant matches once, so both counts are the same
+        for table in self.tables:
+            fh_log.write(f"In {str(table)}: {str(self.var_count[table])} in " + \
+                f"{str(self.var_count[table])} variants\n")
+
+### EOF
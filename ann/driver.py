@@ -14,108 +14,117 @@ import sys
 import os
 import file_utils as fu
 import annotate as ann
-
-def run(infile, format):
+import pipeline
+import sharded
+import bgzf
+
+"""Runs the AnnTools pipeline on infile
+By default every record is annotated in a single fused pass; set
+fused=False to run the original one-file-per-stage pipeline instead.
+shard_by ('chrom' or 'records', default: the ANN_SHARD_BY environment
+variable) annotates shards of the input in parallel on all cores.
+lines, if given, is read instead of infile (e.g. a streamed S3 input);
+outputs are still named after infile. Inputs may be gzip/BGZF
+compressed; compress (default: whether the input is compressed) writes a
+BGZF .annot.vcf.gz with a .tbi index. Returns the output path.
+"""
+def run(infile, format, fused=True, shard_by=None, lines=None, compress=None):
+    if not fused:
+        # The staged pipeline re-reads plain text from disk
+        base = pipeline.input_base(infile)
+        if (lines is not None) or (base != infile):
+            if lines is None:
+                lines = bgzf.open_text(infile)
+            fh = open(base, 'w')
+            fh.writelines(lines)
+            fh.close()
+        run_staged(base, format)
+        return pipeline.annotated_name(base)
+
+    if shard_by is None:
+        shard_by = os.environ['ANN_SHARD_BY'] if \
+            ('ANN_SHARD_BY' in os.environ) else None
 
     print("Running . . .")
-
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
+    if shard_by:
+        outfile = sharded.run(infile, format=format, shard_by=shard_by,
+            lines=lines, compress=compress)
+    else:
+        outfile = pipeline.run(infile, format=format, lines=lines,
+            compress=compress)
+    print("Annotation - done.")
+    return outfile
+
+
+# Steps of the staged pipeline, in order: (name, annotate.py function,
+# options)
+STAGED_STEPS = [
+    ('dbSNP', ann.getSnpsFromDbSnp, {'format': 'vcf'}),
+    ('BigRefGene', ann.getBigRefGene, {'format': 'vcf'}),
+    ('Genes', ann.getGenes,
+        {'format': 'vcf', 'table': 'refGene', 'promoter_offset': 500}),
+    ('Cytoband', ann.addOverlapWithCytoband,
+        {'format': 'vcf', 'table': 'cytoBand'}),
+    ('gadAll', ann.addOverlapWithGadAll, {'format': 'vcf', 'table': 'gadAll'}),
+    ('GwasCatalog', ann.addOverlapWithGwasCatalog,
+        {'format': 'vcf', 'table': 'gwasCatalog'}),
+    ('miRNA', ann.addOverlapWithMiRNA,
+        {'format': 'vcf', 'table': 'targetScanS'}),
+    ('HUGO Gene Nomenclature Committee',
+        ann.addOverlapWitHUGOGeneNomenclature,
+        {'format': 'vcf', 'table': 'hugo'}),
+    ('dgv_Cnv', ann.addOverlapWithCnvDatabase,
+        {'format': 'vcf', 'table': 'dgv_Cnv'}),
+    ('abParts_IG_T_CelReceptors', ann.addOverlapWithCnvDatabase,
+        {'format': 'vcf', 'table': 'abParts_IG_T_CelReceptors'}),
+    ('mcCarroll_Cnv', ann.addOverlapWithCnvDatabase,
+        {'format': 'vcf', 'table': 'mcCarroll_Cnv'}),
+    ('conrad_Cnv', ann.addOverlapWithCnvDatabase,
+        {'format': 'vcf', 'table': 'conrad_Cnv'}),
+    ('genomicSuperDups', ann.addOverlapWithGenomicSuperDups,
+        {'format': 'vcf', 'table': 'genomicSuperDups'}),
+    ('addOverlapWithTfbsConsSites', ann.addOverlapWithTfbsConsSites,
+        {'table': 'tfbsConsSites'})
+]
+
+
+"""Extension of the temp file read by staged step i (written by step i-1)
+"""
+def stagedExt(i):
+    return '' if (i == 0) else ('.' + str(i))
+
+
+"""Runs step i of the staged pipeline on infile
+"""
+def run_staged_step(infile, i):
+    (name, function, options) = STAGED_STEPS[i]
+    function(vcf=infile, tmpextin=stagedExt(i), tmpextout=stagedExt(i + 1),
+        **options)
+
+
+"""Deletes the temp files of the staged pipeline and renames the output
+of the last step to the .annot.vcf
+"""
+def finish_staged(infile):
+    last = len(STAGED_STEPS)
+    for i in range(1, last):
+        fu.delete(infile + stagedExt(i))
+
+    os.rename(infile + stagedExt(last), infile + '.annot')
     finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
     os.rename(infile + '.annot', finalout)
 
+
+"""Original staged pipeline; each stage reads and rewrites a temp file
+"""
+def run_staged(infile, format):
+
+    print("Running . . .")
+
+    for i in range(len(STAGED_STEPS)):
+        run_staged_step(infile, i)
+        print(f"{STAGED_STEPS[i][0]} - done.")
+
+    finish_staged(infile)
+
 ### EOF
\ No newline at end of file
@@ -0,0 +1,119 @@
+# genemodel.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Parsed refGene transcripts and CpG islands, cached per process
+#
+# Every refGene row that overlaps a variant used to have its exonStarts
+# and exonEnds blobs decoded, split and converted to int for each
+# variant. A Transcript parses a row once into int32 exon arrays; the
+# exons that contain a position are found with bisect. CpG islands, used
+# for putative promoter regions, are loaded once per chromosome into an
+# IntervalIndex instead of being queried per variant.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+from intervals import IntervalIndex, MAX_POS
+
+
+"""One refGene row: strand, transcript and CDS bounds and exon arrays
+"""
+class Transcript(object):
+    __slots__ = ('strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd',
+        'exonCount', 'exonStarts', 'exonEnds', 'ordered')
+
+    def __init__(self, row):
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.exonStarts = parseExons(row[9], self.exonCount)
+        self.exonEnds = parseExons(row[10], self.exonCount)
+        # refGene exons do not overlap, so both arrays are sorted
+        self.ordered = isSorted(self.exonStarts) and isSorted(self.exonEnds)
+
+    """Indices of the exons whose closed [start, end] contains pos,
+    in increasing order
+    """
+    def exons(self, pos):
+        if self.ordered:
+            return range(bisect_left(self.exonEnds, pos),
+                bisect_right(self.exonStarts, pos))
+        return [e for e in range(self.exonCount)
+            if (self.exonStarts[e] <= pos) and (pos <= self.exonEnds[e])]
+
+    """1-based exon number of exon e in transcription order
+    """
+    def exonNumber(self, e):
+        if (self.strand == '-'):
+            return self.exonCount - e
+        return e + 1
+
+
+def parseExons(blob, count):
+    if isinstance(blob, bytes):
+        blob = blob.decode('utf-8')
+    return array('i', [int(x) for x in str(blob).split(',')[:count]])
+
+
+def isSorted(values):
+    return all([values[i] <= values[i + 1] for i in range(len(values) - 1)])
+
+
+"""Process-wide cache of Transcripts by refGene row and of CpG island
+indexes by chromosome; the reference tables do not change while the
+annotator runs
+"""
+class GeneModels(object):
+    def __init__(self):
+        self.transcripts = {}
+        self.cpg_islands = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.transcripts = {}
+        self.cpg_islands = {}
+
+    def transcript(self, row):
+        key = tuple(row)
+        transcript = self.transcripts.get(key)
+        if transcript is None:
+            self.misses += 1
+            transcript = self.transcripts[key] = Transcript(row)
+        else:
+            self.hits += 1
+        return transcript
+
+    """First cpgIslandExt row (chrom, chromStart, chromEnd, name) on chrom
+    that contains pos, or None; same row as
+    reference.first_overlapping('cpgIslandExt', chrom, pos, ...)
+    """
+    def cpgIsland(self, reference, chrom, pos):
+        index = self.cpg_islands.get(chrom)
+        if index is None:
+            rows = reference.overlapping('cpgIslandExt', chrom, 0, MAX_POS,
+                columns='chrom, chromStart, chromEnd, name')
+            index = self.cpg_islands[chrom] = IntervalIndex(
+                (row[1], row[2], row) for row in rows)
+        return index.first(int(pos))
+
+    def stats(self):
+        return {
+            'transcripts': len(self.transcripts),
+            'transcript_hits': self.hits,
+            'transcript_misses': self.misses,
+            'cpg_chromosomes': len(self.cpg_islands)
+        }
+
+
+GENE_MODELS = GeneModels()
+
+### EOF
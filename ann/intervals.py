@@ -0,0 +1,98 @@
+# intervals.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval index for reference tables
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from bisect import bisect_left
+
+ROOT = -1
+
+# Upper bound for positions in the reference tables, for lookups that
+# fetch every interval of a chromosome
+MAX_POS = 2 ** 31 - 1
+
+
+"""Nested containment list (NCList) over closed [start, end] intervals
+See Alekseyenko & Lee, Bioinformatics 23(11), 2007. Every interval that
+is contained in another one is stored in that interval's sublist, so
+each sublist is sorted by start *and* by end and can be searched with
+bisect. Point and range queries return the stored values in the order
+the intervals were added, which is the order the table rows were read.
+"""
+class IntervalIndex(object):
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        self.values = []
+        for (start, end, value) in intervals:
+            self.starts.append(int(start))
+            self.ends.append(int(end))
+            self.values.append(value)
+        self.build()
+
+    def __len__(self):
+        return len(self.values)
+
+    def build(self):
+        starts = self.starts
+        ends = self.ends
+        order = sorted(range(len(starts)), key=lambda i: (starts[i], -ends[i]))
+
+        children = {ROOT: []}
+        stack = []
+        for i in order:
+            # Sorted by start, so i is contained in the top of the stack
+            # as soon as it does not extend past its end
+            while stack and ends[stack[-1]] < ends[i]:
+                stack.pop()
+            parent = stack[-1] if stack else ROOT
+            children.setdefault(parent, []).append(i)
+            stack.append(i)
+
+        self.sublists = {}
+        for (parent, members) in children.items():
+            self.sublists[parent] = ([starts[i] for i in members],
+                [ends[i] for i in members], members)
+
+    """Row ids of all intervals overlapping [start, end], in insertion order
+    """
+    def find(self, start, end=None):
+        if end is None:
+            end = start
+
+        hits = []
+        todo = [ROOT]
+        sublists = self.sublists
+        while todo:
+            (sub_starts, sub_ends, members) = sublists[todo.pop()]
+            j = bisect_left(sub_ends, start)
+            n = len(members)
+            while j < n and sub_starts[j] <= end:
+                i = members[j]
+                hits.append(i)
+                if i in sublists:
+                    todo.append(i)
+                j = j + 1
+
+        hits.sort()
+        return hits
+
+    """Values of all intervals overlapping [start, end]
+    """
+    def overlapping(self, start, end=None):
+        return [self.values[i] for i in self.find(start, end)]
+
+    """Value of the first interval overlapping [start, end], or None
+    """
+    def first(self, start, end=None):
+        hits = self.find(start, end)
+        if len(hits) == 0:
+            return None
+        return self.values[hits[0]]
+
+### EOF
@@ -0,0 +1,284 @@
+# jobqueue.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Batched access to the job requests queue
+#
+# JobQueue wraps an SQS queue (a boto3 sqs.Queue, or the in-memory
+# LocalQueue below for local runs) and
+#   - receives up to AWS_SQS_MAX_MESSAGES messages per call,
+#   - keeps every received message invisible until its job is done with a
+#     background heartbeat (one ChangeMessageVisibilityBatch per 10
+#     messages),
+#   - deletes done messages in batches (one DeleteMessageBatch per 10
+#     messages), and
+#   - counts messages handled per API call.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import uuid
+import threading
+from collections import deque
+
+# SQS batch requests take at most 10 entries
+SQS_BATCH_SIZE = 10
+
+
+def batches(items, size=SQS_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+"""Receives, heartbeats and deletes job request messages in batches
+"""
+class JobQueue(object):
+    def __init__(self, queue, max_messages=10, wait_time=20,
+        visibility_timeout=300):
+        self.queue = queue
+        self.max_messages = min(max_messages, SQS_BATCH_SIZE)
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.in_flight = {}
+        self.done_messages = []
+        self.lock = threading.Lock()
+        self.receive_calls = 0
+        self.messages_received = 0
+        self.delete_calls = 0
+        self.messages_deleted = 0
+        self.delete_failures = 0
+        self.delete_dropped = 0
+        self.visibility_calls = 0
+        self.visibility_extensions = 0
+
+    """Receives up to limit (at most max_messages) messages, waiting up to
+    wait_time (default: the queue's wait_time) seconds for one
+    They stay invisible to other pollers until done() and flush()
+    """
+    def receive(self, limit=None, wait_time=None):
+        count = self.max_messages if limit is None \
+            else max(1, min(limit, self.max_messages))
+        messages = self.queue.receive_messages(MaxNumberOfMessages=count,
+            WaitTimeSeconds=self.wait_time if (wait_time is None)
+                else wait_time,
+            VisibilityTimeout=self.visibility_timeout)
+
+        with self.lock:
+            self.receive_calls += 1
+            self.messages_received += len(messages)
+            for message in messages:
+                self.in_flight[message.receipt_handle] = message
+        return messages
+
+    """Marks a message as handled; it is deleted by the next flush()
+    """
+    def done(self, message):
+        with self.lock:
+            self.in_flight.pop(message.receipt_handle, None)
+            self.done_messages.append(message)
+
+    """Deletes all done messages, 10 per DeleteMessageBatch call
+    Messages whose batch call fails, or that fail to delete through no
+    fault of the sender, are retried on the next flush. Sender faults
+    (e.g. ReceiptHandleIsInvalid, for a handle that went stale after its
+    visibility lapsed) never succeed on retry and are dropped.
+    """
+    def flush(self):
+        with self.lock:
+            messages = self.done_messages
+            self.done_messages = []
+
+        failed = []
+        for batch in batches(messages):
+            entries = [{'Id': str(i), 'ReceiptHandle': m.receipt_handle}
+                for (i, m) in enumerate(batch)]
+            try:
+                response = self.queue.delete_messages(Entries=entries)
+            except Exception as e:
+                print(f"Unable to delete messages: {e}")
+                failed.extend(batch)
+                with self.lock:
+                    self.delete_failures += len(batch)
+                continue
+            dropped = 0
+            for failure in response.get('Failed', []):
+                if failure.get('SenderFault'):
+                    print(f"Unable to delete message, dropping it: {failure}")
+                    dropped += 1
+                else:
+                    print(f"Unable to delete message: {failure}")
+                    failed.append(batch[int(failure['Id'])])
+            with self.lock:
+                self.delete_calls += 1
+                self.messages_deleted += len(batch) - \
+                    len(response.get('Failed', []))
+                self.delete_failures += len(response.get('Failed', []))
+                self.delete_dropped += dropped
+
+        if failed:
+            with self.lock:
+                self.done_messages.extend(failed)
+
+    """Extends the visibility of every in-flight message
+    """
+    def heartbeat(self):
+        with self.lock:
+            messages = list(self.in_flight.values())
+
+        for batch in batches(messages):
+            entries = [{'Id': str(i), 'ReceiptHandle': m.receipt_handle,
+                'VisibilityTimeout': self.visibility_timeout}
+                for (i, m) in enumerate(batch)]
+            try:
+                response = self.queue.change_message_visibility_batch(
+                    Entries=entries)
+            except Exception as e:
+                print(f"Unable to extend message visibility: {e}")
+                continue
+            for failure in response.get('Failed', []):
+                print(f"Unable to extend message visibility: {failure}")
+            with self.lock:
+                self.visibility_calls += 1
+                self.visibility_extensions += len(batch) - \
+                    len(response.get('Failed', []))
+
+    """Runs heartbeat() every interval seconds (default: a third of the
+    visibility timeout) in a daemon thread
+    """
+    def startHeartbeat(self, interval=None):
+        if interval is None:
+            interval = max(1, self.visibility_timeout // 3)
+
+        # An error (e.g. a throttled or failed call) must not stop the
+        # heartbeat, or in-flight messages reappear and run twice
+        def beat():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    print(f"Unable to extend message visibility: {e}")
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        return thread
+
+    """Messages handled per API call
+    """
+    def stats(self):
+        with self.lock:
+            return {
+                'receive_calls': self.receive_calls,
+                'messages_received': self.messages_received,
+                'messages_per_receive': round(self.messages_received /
+                    max(self.receive_calls, 1), 2),
+                'delete_calls': self.delete_calls,
+                'messages_deleted': self.messages_deleted,
+                'messages_per_delete': round(self.messages_deleted /
+                    max(self.delete_calls, 1), 2),
+                'delete_failures': self.delete_failures,
+                'delete_dropped': self.delete_dropped,
+                'visibility_calls': self.visibility_calls,
+                'visibility_extensions': self.visibility_extensions,
+                'in_flight': len(self.in_flight)
+            }
+
+
+"""Message returned by LocalQueue; same attributes as a boto3 sqs.Message
+"""
+class LocalMessage(object):
+    def __init__(self, queue, message_id, body, receipt_handle):
+        self.queue = queue
+        self.message_id = message_id
+        self.body = body
+        self.receipt_handle = receipt_handle
+
+    def change_visibility(self, VisibilityTimeout):
+        self.queue.change_message_visibility_batch(Entries=[{'Id': '0',
+            'ReceiptHandle': self.receipt_handle,
+            'VisibilityTimeout': VisibilityTimeout}])
+
+    def delete(self):
+        self.queue.delete_messages(Entries=[{'Id': '0',
+            'ReceiptHandle': self.receipt_handle}])
+
+
+"""In-memory stand-in for a boto3 sqs.Queue
+Implements the calls JobQueue makes, with SQS visibility semantics, so
+the annotator can be run and tested without AWS.
+"""
+class LocalQueue(object):
+    def __init__(self, visibility_timeout=30):
+        self.visibility_timeout = visibility_timeout
+        self.messages = deque()
+        self.invisible = {}
+        self.condition = threading.Condition()
+
+    def send_message(self, MessageBody):
+        message_id = str(uuid.uuid4())
+        with self.condition:
+            self.messages.append((message_id, MessageBody))
+            self.condition.notify_all()
+        return {'MessageId': message_id}
+
+    """Returns messages whose visibility timeout expired to the queue
+    """
+    def expire(self):
+        now = time.time()
+        for (handle, (message_id, body, until)) in list(self.invisible.items()):
+            if (until <= now):
+                del self.invisible[handle]
+                self.messages.append((message_id, body))
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0,
+        VisibilityTimeout=None):
+        timeout = self.visibility_timeout if (VisibilityTimeout is None) \
+            else VisibilityTimeout
+        deadline = time.time() + WaitTimeSeconds
+        with self.condition:
+            self.expire()
+            while (len(self.messages) == 0) and (time.time() < deadline):
+                self.condition.wait(min(1, deadline - time.time()))
+                self.expire()
+
+            received = []
+            while self.messages and (len(received) < MaxNumberOfMessages):
+                (message_id, body) = self.messages.popleft()
+                handle = str(uuid.uuid4())
+                self.invisible[handle] = (message_id, body,
+                    time.time() + timeout)
+                received.append(LocalMessage(self, message_id, body, handle))
+            return received
+
+    def delete_messages(self, Entries):
+        successful = []
+        failed = []
+        with self.condition:
+            for entry in Entries:
+                if self.invisible.pop(entry['ReceiptHandle'], None) is None:
+                    failed.append({'Id': entry['Id'], 'SenderFault': True,
+                        'Code': 'ReceiptHandleIsInvalid'})
+                else:
+                    successful.append({'Id': entry['Id']})
+        return {'Successful': successful, 'Failed': failed}
+
+    def change_message_visibility_batch(self, Entries):
+        successful = []
+        failed = []
+        now = time.time()
+        with self.condition:
+            for entry in Entries:
+                handle = entry['ReceiptHandle']
+                if handle not in self.invisible:
+                    failed.append({'Id': entry['Id'], 'SenderFault': True,
+                        'Code': 'ReceiptHandleIsInvalid'})
+                    continue
+                (message_id, body, until) = self.invisible[handle]
+                self.invisible[handle] = (message_id, body,
+                    now + entry['VisibilityTimeout'])
+                successful.append({'Id': entry['Id']})
+        return {'Successful': successful, 'Failed': failed}
+
+### EOF
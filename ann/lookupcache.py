@@ -0,0 +1,270 @@
+# lookupcache.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Memoized reference lookups
+#
+# Users often resubmit the same sample, or panels that overlap earlier
+# ones, so the same positions are looked up in the same tables over and
+# over. CachedReference wraps a reference backend and remembers the
+# result of every rows_at()/overlapping()/first_overlapping() lookup,
+# keyed by the reference version and the lookup (table, chromosome,
+# position or range, columns). Results are kept in a bounded in-memory
+# LRU and, optionally, in an SQLite file that all annotation jobs on the
+# host share.
+#
+# Configure with
+#   ANN_REFERENCE_CACHE       entries kept in memory per process (0: off)
+#   ANN_REFERENCE_CACHE_DB    path of the shared on-disk tier (optional)
+#   ANN_REFERENCE_CACHE_DISK  entries kept on disk (default 1000000)
+#   ANN_REFERENCE_VERSION     version of the reference tables; change it
+#                             whenever the tables are reloaded
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+REFERENCE_CACHE = int(os.environ['ANN_REFERENCE_CACHE']) if \
+    ('ANN_REFERENCE_CACHE' in os.environ) else 0
+REFERENCE_CACHE_DB = os.environ['ANN_REFERENCE_CACHE_DB'] if \
+    ('ANN_REFERENCE_CACHE_DB' in os.environ) else None
+REFERENCE_CACHE_DISK = int(os.environ['ANN_REFERENCE_CACHE_DISK']) if \
+    ('ANN_REFERENCE_CACHE_DISK' in os.environ) else 1000000
+REFERENCE_VERSION = os.environ['ANN_REFERENCE_VERSION'] if \
+    ('ANN_REFERENCE_VERSION' in os.environ) else '1'
+
+# Returned by LookupCache.get for keys that are not cached
+MISS = object()
+
+
+"""Bounded LRU of lookup results with an optional SQLite tier
+Disk writes are buffered and committed every flush_every entries and by
+flush(). The number of rows on disk is counted when the file is opened
+and kept up to date by the writes; once it goes over max_disk_entries,
+the oldest rows are deleted, at most trim_batch per flush, until 90% of
+max_disk_entries are left. Hits, disk hits and misses are counted per
+table.
+"""
+class LookupCache(object):
+    def __init__(self, max_entries=100000, path=None, max_disk_entries=1000000,
+        flush_every=1000, trim_batch=10000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.flush_every = flush_every
+        self.trim_batch = trim_batch
+        self.disk_entries = 0
+        self.trimming = False
+        self.entries = OrderedDict()
+        self.pending = []
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.openDisk(path)
+
+    def openDisk(self, path):
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None,
+            check_same_thread=False)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.execute('pragma synchronous=normal')
+        self.db.execute('create table if not exists lookups ' + \
+            '(key text primary key, value blob, created real)')
+        self.db.execute('create index if not exists lookups_created ' + \
+            'on lookups (created)')
+        self.countDisk()
+
+    """Counts the rows on disk; other processes sharing the file add rows
+    too, so the count is refreshed before every trim
+    """
+    def countDisk(self):
+        self.disk_entries = self.db.execute(
+            'select count(*) from lookups').fetchone()[0]
+
+    def count(self, table, outcome):
+        counts = self.counts.setdefault(table,
+            {'hits': 0, 'disk_hits': 0, 'misses': 0})
+        counts[outcome] += 1
+
+    """Cached value of key, or MISS
+    """
+    def get(self, table, key):
+        with self.lock:
+            value = self.entries.get(key, MISS)
+            if value is not MISS:
+                self.entries.move_to_end(key)
+                self.count(table, 'hits')
+                return value
+
+            if self.db is not None:
+                row = self.db.execute('select value from lookups where key=?',
+                    (repr(key),)).fetchone()
+                if row is not None:
+                    value = pickle.loads(row[0])
+                    self.remember(key, value)
+                    self.count(table, 'disk_hits')
+                    return value
+
+            self.count(table, 'misses')
+            return MISS
+
+    def put(self, key, value):
+        with self.lock:
+            self.remember(key, value)
+            if self.db is not None:
+                self.pending.append((repr(key), pickle.dumps(value,
+                    protocol=pickle.HIGHEST_PROTOCOL), time.time()))
+                if (len(self.pending) >= self.flush_every):
+                    self.flushPending()
+
+    def remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while (len(self.entries) > self.max_entries):
+            self.entries.popitem(last=False)
+
+    """Writes buffered entries to the disk tier and trims it to
+    max_disk_entries, dropping the oldest entries
+    """
+    def flush(self):
+        with self.lock:
+            self.flushPending()
+
+    def flushPending(self):
+        if (self.db is None) or (len(self.pending) == 0):
+            return
+        self.db.execute('begin')
+        self.db.executemany('insert or replace into lookups ' + \
+            '(key, value, created) values (?, ?, ?)', self.pending)
+        # Replaced keys are counted too; the count is refreshed below
+        self.disk_entries += len(self.pending)
+        self.pending = []
+
+        if not self.trimming and (self.disk_entries > self.max_disk_entries):
+            self.countDisk()
+            self.trimming = (self.disk_entries > self.max_disk_entries)
+        if self.trimming:
+            self.trimDisk()
+        self.db.execute('commit')
+
+    """Deletes up to trim_batch of the oldest rows, walking the created
+    index from its start
+    """
+    def trimDisk(self):
+        low_water = int(self.max_disk_entries * 0.9)
+        batch = min(self.trim_batch, self.disk_entries - low_water)
+        deleted = self.db.execute('delete from lookups where rowid in ' + \
+            '(select rowid from lookups order by created limit ?)',
+            (max(batch, 0),)).rowcount
+        self.disk_entries -= deleted
+        if (self.disk_entries <= low_water) or (deleted == 0):
+            self.trimming = False
+
+    """Hits, disk hits, misses and hit rate per table
+    """
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for (table, counts) in self.counts.items():
+                lookups = sum(counts.values())
+                stats[table] = dict(counts)
+                stats[table]['hit_rate'] = round((counts['hits'] +
+                    counts['disk_hits']) / max(lookups, 1), 4)
+            return stats
+
+
+"""Reference backend wrapper that memoizes lookups in a LookupCache
+Every other call goes to the wrapped backend.
+"""
+class CachedReference(object):
+    def __init__(self, reference, cache, version=REFERENCE_VERSION):
+        self.reference = reference
+        self.cache = cache
+        self.version = (str(version), type(reference).__name__)
+
+    def __getattr__(self, name):
+        return getattr(self.reference, name)
+
+    def close(self):
+        self.cache.flush()
+        self.reference.close()
+
+    """Positions already cached are answered from the cache; the others
+    are looked up in one rows_at call and cached, including positions
+    without rows
+    """
+    def rows_at(self, table, chrom, positions, chrom_col='chrom',
+        pos_col='pos', match=None, batch_size=5000):
+        base = self.version + ('rows_at', table, str(chrom), chrom_col,
+            pos_col, tuple(sorted((match or {}).items())))
+
+        names = []
+        found = {}
+        missing = []
+        for pos in sorted(set([int(p) for p in positions])):
+            value = self.cache.get(table, base + (pos,))
+            if value is MISS:
+                missing.append(pos)
+                continue
+            (names, rows) = value
+            if (len(rows) > 0):
+                found[pos] = list(rows)
+
+        if (len(missing) > 0):
+            (names, fetched) = self.reference.rows_at(table, chrom, missing,
+                chrom_col=chrom_col, pos_col=pos_col, match=match,
+                batch_size=batch_size)
+            for pos in missing:
+                rows = fetched.get(pos, [])
+                self.cache.put(base + (pos,), (names, tuple(rows)))
+                if (len(rows) > 0):
+                    found[pos] = list(rows)
+
+        return (names, found)
+
+    def lookup(self, method, table, chrom, start, end, columns, chrom_col,
+        start_col, end_col):
+        if end is None:
+            end = start
+        key = self.version + (method, table, str(chrom), int(start),
+            int(end), columns, chrom_col, start_col, end_col)
+        value = self.cache.get(table, key)
+        if value is MISS:
+            value = getattr(self.reference, method)(table, chrom, start, end,
+                columns=columns, chrom_col=chrom_col, start_col=start_col,
+                end_col=end_col)
+            if isinstance(value, list):
+                value = tuple(value)
+            self.cache.put(key, value)
+        return value
+
+    def overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        return list(self.lookup('overlapping', table, chrom, start, end,
+            columns, chrom_col, start_col, end_col))
+
+    def first_overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        return self.lookup('first_overlapping', table, chrom, start, end,
+            columns, chrom_col, start_col, end_col)
+
+
+SHARED_CACHE = None
+
+"""The process-wide LookupCache configured by ANN_REFERENCE_CACHE*, or
+None if caching is off
+"""
+def shared_cache():
+    global SHARED_CACHE
+    if (SHARED_CACHE is None) and (REFERENCE_CACHE > 0):
+        SHARED_CACHE = LookupCache(max_entries=REFERENCE_CACHE,
+            path=REFERENCE_CACHE_DB, max_disk_entries=REFERENCE_CACHE_DISK)
+    return SHARED_CACHE
+
+### EOF
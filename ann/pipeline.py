@@ -0,0 +1,729 @@
+# pipeline.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Fused, single-pass AnnTools pipeline
+#
+# Each VCF record is parsed once, handed through an ordered list of
+# annotation stages in memory and written once. The stages reproduce the
+# per-file functions in annotate.py record for record, so the .annot.vcf
+# and the counters in the .count.log produced here are identical to the
+# staged pipeline. The count log ends with a profile of the stages (see
+# profiler.py).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import importlib.util
+
+import file_utils as fu
+import utils as u
+import annotate as ann
+import reference
+import bgzf
+import prefetch
+from profiler import Profiler
+from genemodel import GENE_MODELS
+from vcfrecord import Record
+
+
+"""Appends an annotation to the INFO column of a vcfrecord.Record,
+adding a ';' separator unless the column already ends with one
+"""
+def appendInfo(fields, text):
+    fields.appendInfo(text)
+
+
+"""Base class for annotation stages run by the fused pipeline
+Subclasses annotate one parsed record (a vcfrecord.Record, indexed like
+the list of VCF fields) in place and write their counters to the job's
+count log when the run ends.
+Stages that can look up many records at once override annotate_block.
+Stages that make one overlap lookup per record describe it with query()
+and make it with lookup(), so the lookups of a block can be issued
+concurrently before the block is annotated (see prefetch.py).
+"""
+class Stage(object):
+    # Attributes that are summed when the counters of shards are merged
+    counter_names = ()
+
+    def __init__(self, table=None, format='vcf'):
+        self.table = table
+        self.inds = ann.getFormatSpecificIndices(format=format)
+        self.reference = None
+
+    def open(self, reference):
+        self.reference = reference
+
+    def annotate(self, fields):
+        raise NotImplementedError
+
+    def annotate_block(self, block):
+        for fields in block:
+            self.annotate(fields)
+
+    def report(self, fh_log):
+        pass
+
+    """The overlap lookup annotate() makes for a record, as (method,
+    table, chrom, start, end, options), or None if it makes none
+    """
+    def query(self, fields):
+        return None
+
+    def lookup(self, fields):
+        (method, table, chrom, start, end, options) = self.query(fields)
+        return getattr(self.reference, method)(table, chrom, start, end,
+            **options)
+
+    def counters(self):
+        return dict([(name, getattr(self, name)) for name in self.counter_names])
+
+    """Adds the counters of another run of this stage, e.g. over a shard
+    """
+    def merge(self, counters):
+        for (name, value) in counters.items():
+            setattr(self, name, getattr(self, name) + value)
+
+    def getChrom(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return chr
+
+    def getPos(self, fields):
+        return fields[self.inds[1]].strip()
+
+
+"""Base class for the overlap stages that log "In <table>: N in M variants"
+"""
+class OverlapStage(Stage):
+    counter_names = ('var_count', 'line_count')
+
+    def __init__(self, table=None, format='vcf'):
+        Stage.__init__(self, table=table, format=format)
+        self.var_count = 0
+        self.line_count = 0
+
+    def report(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+
+"""dbSNP identifiers and GMAF; see annotate.getSnpsFromDbSnp
+Blocks of records are looked up with one keyed query per chromosome
+and batch_size positions (see annotate.getDbSnpRows).
+"""
+class DbSnpStage(Stage):
+    counter_names = ('var_count', 'linenum')
+
+    def __init__(self, format='vcf', varclass='SNV', batch_size=5000):
+        Stage.__init__(self, table='dbSNP', format=format)
+        self.varclass = varclass
+        self.batch_size = batch_size
+        self.var_count = 0
+        self.linenum = 1
+
+    def annotate(self, fields):
+        self.annotate_block([fields])
+
+    def annotate_block(self, block):
+        keys = [ann.getDbSnpKey(fields, self.inds) for fields in block]
+        matches = ann.getDbSnpRows(self.reference, keys,
+            varclass=self.varclass, batch_size=self.batch_size)
+
+        for (fields, rows) in zip(block, matches):
+            if ann.addDbSnpFields(fields, rows, varclass=self.varclass):
+                self.var_count = self.var_count + 1
+            self.linenum = self.linenum + 1
+
+    def merge(self, counters):
+        # linenum starts at 1 in every run
+        self.var_count = self.var_count + counters['var_count']
+        self.linenum = self.linenum + counters['linenum'] - 1
+
+    def report(self, fh_log):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
+
+
+"""Collapsed bigRefGene isoforms; see annotate.getBigRefGene
+"""
+class BigRefGeneStage(Stage):
+    def __init__(self, format='vcf'):
+        Stage.__init__(self, table='bigRefGene', format=format)
+
+    def annotate(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+
+        pos = self.getPos(fields)
+        ref = fields[self.inds[2]].strip()
+        alt = fields[self.inds[3]].strip()
+
+        # First table with a hit wins
+        rows = ann.getBigRefGeneRows(self.reference, chr, pos, ref, alt)
+        if (len(rows) == 0):
+            return
+
+        m = set([])
+        for row in rows:
+            m.add(ann.collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+
+        fields[7] = fields[7] + ';' + ';'.join(m)
+        if (str(fields[7]).startswith(".;")):
+            fields[7] = str(fields[7]).replace('.;', '', 1)
+
+
+"""Location in gene structures; see annotate.getGenes
+"""
+class GenesStage(Stage):
+    counter_names = ('interGenic_count', 'cds_count', 'utr3_count',
+        'utr5_count', 'intronic_count', 'non_coding_intronic_count',
+        'exonic_count', 'non_coding_exonic_count', 'promoter_count')
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500):
+        Stage.__init__(self, table=table, format=format)
+        self.promoter_offset = promoter_offset
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+    def getPromoterRegion(self, chr, pos):
+        row = GENE_MODELS.cpgIsland(self.reference, chr, pos)
+
+        if (row is not None):
+            self.promoter_count = self.promoter_count + 1
+            return 'putativePromoterRegion=' + "".join(str(row[3]).split())
+        return ""
+
+    def query(self, fields):
+        pos = int(self.getPos(fields))
+        return ('overlapping', self.table, self.getChrom(fields),
+            pos - int(self.promoter_offset), pos + int(self.promoter_offset),
+            {'start_col': 'txStart', 'end_col': 'txEnd'})
+
+    def annotate(self, fields):
+        chr = self.getChrom(fields)
+        pos = self.getPos(fields)
+        info_field = fields[7].strip()
+        promoter_offset = self.promoter_offset
+
+        rows = self.lookup(fields)
+
+        if (len(rows) == 0):
+            fields.extendInfo(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
+            return
+
+        info = []
+        pos = int(pos)
+        cnt = 1
+        for row in rows:
+            #count location
+            positionType = str(u.parse_field(info_field,
+                'positionType', ';', '='))
+
+            if (positionType == 'intron'):
+                self.intronic_count = self.intronic_count + 1
+            elif (positionType == 'non_coding_intron'):
+                self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+            elif (positionType == 'CDS'):
+                self.cds_count = self.cds_count + 1
+            elif (positionType == 'non_coding_exon'):
+                self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+            elif (positionType == 'utr5'):
+                self.utr5_count = self.utr5_count + 1
+            elif (positionType == 'utr3'):
+                self.utr3_count = self.utr3_count + 1
+
+            tx = GENE_MODELS.transcript(row)
+            txtStart = tx.txStart
+            txtEnd = tx.txEnd
+            cdsStart = tx.cdsStart
+            cdsEnd = tx.cdsEnd
+            exonCount = tx.exonCount
+            strand = tx.strand
+
+            promoter_plus = txtStart - int(promoter_offset)
+            promoter_minus = txtEnd + int(promoter_offset)
+            region = ""
+            exons = []
+
+            if (cdsStart == cdsEnd):
+                for e in tx.exons(pos):
+                    exons.append("non_coding_exon=" + "ex" + \
+                        str(tx.exonNumber(e)) + '/' + str(exonCount))
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+            elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                for e in tx.exons(pos):
+                    exons.append("exon=" +  "ex" + \
+                        str(tx.exonNumber(e)) + '/' + str(exonCount))
+                    self.exonic_count = self.exonic_count + 1
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+            elif (u.isBetween(pos, promoter_plus, txtStart) and
+                (strand == "+")):
+                region = self.getPromoterRegion(chr, pos)
+            elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                region = self.getPromoterRegion(chr, pos)
+
+            if (region != ''):
+                info.append(ann.collapseGeneNames(row=row,
+                    indices=ann.indicesKnownGenes, region=region, cnt=cnt))
+
+            cnt = cnt + 1
+
+        fields.extendInfo(';' + ";".join(info))
+
+    def report(self, fh_log):
+        counts = [
+            ("In interGenic", self.interGenic_count),
+            ("In CDS", self.cds_count),
+            ("In \'3 UTR", self.utr3_count),
+            ("In \'5 UTR", self.utr5_count),
+            ("In Intronic", self.intronic_count),
+            ("In Non_coding_intronic", self.non_coding_intronic_count),
+            ("In Exonic", self.exonic_count),
+            ("In Non_coding_exonic", self.non_coding_exonic_count),
+            ("In Putative Promoter Region", self.promoter_count)]
+
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
+        for (label, count) in counts:
+            print(f"{label} {str(count)}")
+            fh_log.write(f"{label} {str(count)}\n")
+
+
+"""Cytoband names; see annotate.addOverlapWithCytoband
+"""
+class CytobandStage(OverlapStage):
+    def __init__(self, format='vcf', table='cytoBand'):
+        OverlapStage.__init__(self, table=table, format=format)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+
+    def query(self, fields):
+        return ('overlapping', self.table, self.getChrom(fields),
+            int(self.getPos(fields)), None,
+            {'start_col': self.startName, 'end_col': self.endName})
+
+    def annotate(self, fields):
+        rows = self.lookup(fields)
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + len(rows)
+            overlapsWith = u.dedup([str(row[self.colindex]) for row in rows])
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+            appendInfo(fields, str(self.table) + '=' + str(cytoband))
+
+
+"""Genetic Association Database; see annotate.addOverlapWithGadAll
+"""
+class GadAllStage(OverlapStage):
+    def __init__(self, format='vcf', table='gadAll'):
+        OverlapStage.__init__(self, table=table, format=format)
+
+    def query(self, fields):
+        chr = fields[self.inds[0]].strip()
+        # For some reason this table has no "chr" preceeding number
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+
+        return ('overlapping', self.table, chr, int(self.getPos(fields)),
+            None, {'chrom_col': 'chromosome'})
+
+    def annotate(self, fields):
+        rows = self.lookup(fields)
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]))
+                    records.append(str(self.table) + '=' + str(row[3]))
+            appendInfo(fields, ';'.join(records))
+
+            # The staged pipeline writes matched records joined with '\t ',
+            # which the next stage reads back as a leading space on every
+            # column after CHROM
+            fields[1:] = [' ' + f for f in fields[1:]]
+
+
+"""GWAS catalog traits; see annotate.addOverlapWithGwasCatalog
+"""
+class GwasCatalogStage(OverlapStage):
+    def __init__(self, format='vcf', table='gwasCatalog'):
+        OverlapStage.__init__(self, table=table, format=format)
+
+    def query(self, fields):
+        return ('overlapping', self.table, self.getChrom(fields),
+            int(self.getPos(fields)), None,
+            {'start_col': 'chromEnd', 'end_col': 'chromEnd'})
+
+    def annotate(self, fields):
+        rows = self.lookup(fields)
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            records = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                records.append(str(self.table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+            appendInfo(fields, ';'.join(records))
+
+
+"""TargetScan miRNA sites; see annotate.addOverlapWithMiRNA
+"""
+class MiRNAStage(OverlapStage):
+    def __init__(self, format='vcf', table='targetScanS'):
+        OverlapStage.__init__(self, table=table, format=format)
+
+    def query(self, fields):
+        return ('first_overlapping', self.table, self.getChrom(fields),
+            int(self.getPos(fields)), None, {})
+
+    def annotate(self, fields):
+        row = self.lookup(fields)
+
+        if row is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+                str(row[2]) + '_' + str(row[3])
+            appendInfo(fields, 'miRNAsites=' + t.strip())
+
+    def report(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+
+"""HUGO Gene Nomenclature; see annotate.addOverlapWitHUGOGeneNomenclature
+"""
+class HugoStage(OverlapStage):
+    def __init__(self, format='vcf', table='hugo'):
+        OverlapStage.__init__(self, table=table, format=format)
+
+    def query(self, fields):
+        return ('overlapping', self.table, self.getChrom(fields),
+            int(self.getPos(fields)), None, {})
+
+    def annotate(self, fields):
+        rows = self.lookup(fields)
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
+            appendInfo(fields, ','.join(records).replace(';', ','))
+
+
+# Tables flagged by CnvStage, in the order the staged pipeline runs them
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+
+"""Boolean CNV flags; see annotate.addOverlapWithCnvDatabase
+"""
+class CnvStage(OverlapStage):
+    def __init__(self, format='vcf', table='dgv_Cnv'):
+        OverlapStage.__init__(self, table=table, format=format)
+
+    def query(self, fields):
+        return ('first_overlapping', self.table, self.getChrom(fields),
+            int(self.getPos(fields)), None, {})
+
+    def annotate(self, fields):
+        row = self.lookup(fields)
+
+        if row is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            appendInfo(fields, str(self.table) + '=' + str(True))
+
+
+"""Segmental duplications; see annotate.addOverlapWithGenomicSuperDups
+"""
+class GenomicSuperDupsStage(OverlapStage):
+    def __init__(self, format='vcf', table='genomicSuperDups'):
+        OverlapStage.__init__(self, table=table, format=format)
+
+    def query(self, fields):
+        return ('first_overlapping', self.table, self.getChrom(fields),
+            int(self.getPos(fields)), None, {})
+
+    def annotate(self, fields):
+        row = self.lookup(fields)
+
+        if row is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            fields.extendInfo(';' + str(self.table) + '=' + \
+                str(True) + ';' + 'otherChrom=' + str(row[7]) + \
+                ';otherStart=' + str(row[8]) + ';otherEnd=' + str(row[9]))
+
+
+"""Conserved transcription factor binding sites;
+see annotate.addOverlapWithTfbsConsSites
+"""
+class TfbsConsSitesStage(OverlapStage):
+    allowed_chrom = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+        '14','15','16','17','18','19','20','21','22','X','Y']
+
+    def __init__(self, format='vcf', table='tfbsConsSites'):
+        OverlapStage.__init__(self, table=table, format=format)
+
+    def query(self, fields):
+        chrIndex = self.getChrom(fields).replace('chr', '')
+        if (chrIndex not in self.allowed_chrom):
+            return None
+
+        return ('overlapping', 'tfbsConsSites' + chrIndex, None,
+            int(self.getPos(fields)), None,
+            {'columns': 'chrom, chromStart, chromEnd, name', 'chrom_col': None})
+
+    def annotate(self, fields):
+        if self.query(fields) is None:
+            return
+
+        rows = self.lookup(fields)
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            records = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                records.append('tfbsRegion' + '=' + t.strip())
+            appendInfo(fields, ';'.join(records))
+
+
+"""The 14 stages in the order run by driver.run
+With vectorized (the default when NumPy is installed, see
+ANN_VECTORIZED_CNV), the four CNV flag stages run as one
+cnvflags.CnvFlagsStage.
+"""
+def default_stages(format='vcf', vectorized=None):
+    if vectorized is None:
+        vectorized = (os.environ['ANN_VECTORIZED_CNV'] != '0') if \
+            ('ANN_VECTORIZED_CNV' in os.environ) else \
+            (importlib.util.find_spec('numpy') is not None)
+
+    if vectorized:
+        cnv_stages = [importlib.import_module('cnvflags').CnvFlagsStage(
+            format=format)]
+    else:
+        cnv_stages = [CnvStage(format=format, table=table)
+            for table in CNV_TABLES]
+
+    return [
+        DbSnpStage(format=format),
+        BigRefGeneStage(format=format),
+        GenesStage(format=format, table='refGene', promoter_offset=500),
+        CytobandStage(format=format, table='cytoBand'),
+        GadAllStage(format=format, table='gadAll'),
+        GwasCatalogStage(format=format, table='gwasCatalog'),
+        MiRNAStage(format=format, table='targetScanS'),
+        HugoStage(format=format, table='hugo')] + cnv_stages + [
+        GenomicSuperDupsStage(format=format, table='genomicSuperDups'),
+        TfbsConsSitesStage(format=format, table='tfbsConsSites')]
+
+
+"""Input file name without its compression extension (x.vcf.gz -> x.vcf)
+"""
+def input_base(infile):
+    for ext in bgzf.COMPRESSED_EXTS:
+        if infile.endswith(ext):
+            return infile[:-len(ext)]
+    return infile
+
+
+"""Name of the annotated output for an input file, as produced by driver.run
+Outputs are BGZF-compressed (.annot.vcf.gz) if compress is set, which
+defaults to whether the input is compressed
+"""
+def annotated_name(infile, compress=None):
+    base = input_base(infile)
+    if compress is None:
+        compress = (base != infile)
+    outfile = (base + '.annot').replace('.vcf.annot', '.annot.vcf')
+    return (outfile + '.gz') if compress else outfile
+
+
+def count_log_name(infile):
+    return input_base(infile) + '.count.log'
+
+
+"""Runs every stage over a block of parsed records and writes them out
+prefetchBlock, if given, is called with the block first (see annotateFile).
+profiler, if given, times the stages (see profiler.py).
+"""
+def writeBlock(stages, block, fh_out, sep='\t', prefetchBlock=None,
+    profiler=None):
+    if (prefetchBlock is not None) and (len(block) > 0):
+        if profiler is None:
+            prefetchBlock(block)
+        else:
+            profiler.prefetch(prefetchBlock, block)
+
+    for (i, stage) in enumerate(stages):
+        for record in block:
+            # Each staged step strips the line it reads back from disk
+            record.rstrip()
+        if profiler is None:
+            stage.annotate_block(block)
+        else:
+            profiler.annotate(i, stage, block)
+
+    for record in block:
+        line = record.serialize() + '\n'
+        fh_out.write(line)
+        if profiler is not None:
+            profiler.bytes_written += len(line)
+
+
+"""Annotates the records of infile with stages and writes them to outfile
+Records are read and annotated in blocks of block_size so stages can
+batch their lookups. lines, if given, is read instead of infile (e.g.
+transfer.stream_lines, to annotate an input while it downloads).
+Compressed inputs are read transparently, and outfile is written as
+BGZF if it ends in .gz.
+With in_flight (default: ANN_ASYNC_LOOKUPS) and the mysql backend, the
+overlap lookups of each block are made concurrently, in_flight at a
+time per stage, before it is annotated (see prefetch.py).
+profiler, if given, records the time, lookups and bytes of every stage.
+"""
+def annotateFile(infile, outfile, stages, sep='\t', backend=None,
+    block_size=10000, lines=None, in_flight=None, profiler=None):
+    backend = reference.backend_name(backend)
+    if in_flight is None:
+        in_flight = prefetch.ASYNC_LOOKUPS
+
+    refdb = reference.open_reference(backend)
+    prefetcher = None
+    prefetchBlock = None
+    if (in_flight > 0) and (backend == 'mysql'):
+        refdb = prefetch.PrefetchedReference(refdb)
+        prefetcher = prefetch.Prefetcher(
+            lambda: reference.open_reference(backend, sweep=False),
+            in_flight=in_flight)
+        prefetchBlock = lambda block: prefetcher.prefetch(stages, block, refdb)
+    for (i, stage) in enumerate(stages):
+        stage.open(refdb if (profiler is None) else
+            profiler.reference(i, refdb))
+
+    fh = bgzf.open_text(infile) if (lines is None) else None
+    fh_out = bgzf.open_output(outfile)
+
+    block = []
+    for line in (fh if (lines is None) else lines):
+        if profiler is not None:
+            profiler.bytes_read += len(line)
+        line = line.strip()
+        if line.startswith("#"):
+            writeBlock(stages, block, fh_out, sep, prefetchBlock, profiler)
+            block = []
+            fh_out.write(line + '\n')
+            if profiler is not None:
+                profiler.bytes_written += len(line) + 1
+            continue
+
+        block.append(Record(line, sep))
+        if (len(block) >= block_size):
+            writeBlock(stages, block, fh_out, sep, prefetchBlock, profiler)
+            block = []
+
+    writeBlock(stages, block, fh_out, sep, prefetchBlock, profiler)
+
+    if fh is not None:
+        fh.close()
+    fh_out.close()
+    if prefetcher is not None:
+        prefetcher.close()
+        print(f"Prefetched reference lookups: {prefetcher.stats()}")
+    refdb.close()
+
+
+def profile_name(infile):
+    return input_base(infile) + '.profile.json'
+
+
+"""Writes the counters of every stage to <infile>.count.log
+(x.vcf.count.log for x.vcf.gz), followed by the stage profile if one is
+given, which is also written to <infile>.profile.json
+"""
+def writeCountLog(infile, stages, profiler=None):
+    fh_log = open(count_log_name(infile), 'w')
+    for stage in stages:
+        stage.report(fh_log)
+    if profiler is not None:
+        profiler.writeLog(fh_log)
+        profiler.writeJson(profile_name(infile))
+    fh_log.close()
+
+
+"""Annotates infile in a single pass
+Writes <infile>.count.log (with the stage profile), <infile>.profile.json
+and the .annot.vcf and returns the output path. backend names the
+reference backend (see reference.open_reference). lines, if given, is
+read instead of infile (see annotateFile).
+Compressed outputs (see annotated_name) get a .tbi index if the records
+are sorted and index is set.
+"""
+def run(infile, format='vcf', stages=None, sep='\t', backend=None,
+    block_size=10000, lines=None, compress=None, index=True):
+    if stages is None:
+        stages = default_stages(format=format)
+
+    outfile = annotated_name(infile, compress)
+    profiler = Profiler(stages)
+    annotateFile(infile, outfile, stages, sep=sep, backend=backend,
+        block_size=block_size, lines=lines, profiler=profiler)
+    if index:
+        writeIndex(outfile)
+    profiler.finish()
+    writeCountLog(infile, stages, profiler)
+    return outfile
+
+
+"""Writes <outfile>.tbi for a compressed output
+"""
+def writeIndex(outfile):
+    if not bgzf.is_compressed_name(outfile):
+        return None
+    index = bgzf.build_index(outfile)
+    if index is None:
+        print(f"{outfile} is not sorted by position; no index written.")
+    return index
+
+### EOF
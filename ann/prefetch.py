@@ -0,0 +1,183 @@
+# prefetch.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Concurrent reference lookups for remote backends
+#
+# With the mysql backend every overlap lookup is a round trip to RDS, and
+# the fused pipeline makes them one after another: each stage waits for
+# its query before the next stage (or the next record) can ask. A
+# Prefetcher collects the lookups every stage will make for a block of
+# records (Stage.query) and issues them from an asyncio event loop, with
+# at most in_flight lookups outstanding per stage. Lookups of different
+# stages and records overlap; identical lookups are made once. Queries
+# run on a pool of worker threads, each with its own connection, as the
+# annotator's MySQL driver (PyMySQL) is blocking.
+#
+# The stages then annotate the block as before, answered from the
+# prefetched results by a PrefetchedReference, so records are annotated
+# and written in input order and the output does not change.
+#
+# Configure with
+#   ANN_ASYNC_LOOKUPS   lookups in flight per stage (0: off, the default)
+#   ANN_ASYNC_WORKERS   worker threads / connections (default 16)
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+ASYNC_LOOKUPS = int(os.environ['ANN_ASYNC_LOOKUPS']) if \
+    ('ANN_ASYNC_LOOKUPS' in os.environ) else 0
+ASYNC_WORKERS = int(os.environ['ANN_ASYNC_WORKERS']) if \
+    ('ANN_ASYNC_WORKERS' in os.environ) else 16
+
+
+"""Key of an overlapping()/first_overlapping() lookup, with the defaults
+of the reference backends filled in
+"""
+def lookupKey(method, table, chrom, start, end=None, columns='*',
+    chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+    if end is None:
+        end = start
+    return (method, table, str(chrom), int(start), int(end), columns,
+        chrom_col, start_col, end_col)
+
+
+"""Reference backend wrapper that answers overlap lookups from the
+results of the last Prefetcher.prefetch; lookups that were not
+prefetched, and every other call, go to the wrapped backend
+"""
+class PrefetchedReference(object):
+    def __init__(self, reference):
+        self.reference = reference
+        self.results = {}
+
+    def __getattr__(self, name):
+        return getattr(self.reference, name)
+
+    def close(self):
+        self.results = {}
+        self.reference.close()
+
+    def overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        key = lookupKey('overlapping', table, chrom, start, end, columns,
+            chrom_col, start_col, end_col)
+        if key in self.results:
+            return list(self.results[key])
+        return self.reference.overlapping(table, chrom, start, end,
+            columns=columns, chrom_col=chrom_col, start_col=start_col,
+            end_col=end_col)
+
+    def first_overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        key = lookupKey('first_overlapping', table, chrom, start, end,
+            columns, chrom_col, start_col, end_col)
+        if key in self.results:
+            return self.results[key]
+        return self.reference.first_overlapping(table, chrom, start, end,
+            columns=columns, chrom_col=chrom_col, start_col=start_col,
+            end_col=end_col)
+
+
+"""Issues the lookups of a block of records concurrently
+connect() opens the reference backend used by each worker thread.
+"""
+class Prefetcher(object):
+    def __init__(self, connect, in_flight=ASYNC_LOOKUPS, workers=ASYNC_WORKERS):
+        self.connect = connect
+        self.in_flight = in_flight
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+            thread_name_prefix='ann-lookup')
+        self.local = threading.local()
+        self.backends = []
+        self.lock = threading.Lock()
+        self.blocks = 0
+        self.lookups = 0
+        self.duplicates = 0
+        self.max_in_flight = 0
+        self.seconds = 0.0
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            backends = self.backends
+            self.backends = []
+        for backend in backends:
+            backend.close()
+
+    def backend(self):
+        backend = getattr(self.local, 'backend', None)
+        if backend is None:
+            backend = self.local.backend = self.connect()
+            with self.lock:
+                self.backends.append(backend)
+        return backend
+
+    def call(self, query):
+        (method, table, chrom, start, end, options) = query
+        return getattr(self.backend(), method)(table, chrom, start, end,
+            **options)
+
+    """Looks up the queries of every stage for every record of block
+    Stores the results in reference (a PrefetchedReference), replacing
+    those of the previous block.
+    """
+    def prefetch(self, stages, block, reference):
+        queries = {}
+        for (group, stage) in enumerate(stages):
+            for fields in block:
+                query = stage.query(fields)
+                if query is None:
+                    continue
+                (method, table, chrom, start, end, options) = query
+                key = lookupKey(method, table, chrom, start, end, **options)
+                if key in queries:
+                    self.duplicates += 1
+                    continue
+                queries[key] = (group, query)
+
+        start = time.perf_counter()
+        reference.results = {}
+        if (len(queries) > 0):
+            reference.results = asyncio.run(self.fetchAll(queries,
+                len(stages)))
+        self.seconds += time.perf_counter() - start
+        self.blocks += 1
+        self.lookups += len(queries)
+
+    async def fetchAll(self, queries, groups):
+        loop = asyncio.get_running_loop()
+        limits = [asyncio.Semaphore(self.in_flight) for group in range(groups)]
+        outstanding = [0]
+
+        async def fetch(key, group, query):
+            async with limits[group]:
+                outstanding[0] += 1
+                self.max_in_flight = max(self.max_in_flight, outstanding[0])
+                try:
+                    result = await loop.run_in_executor(self.executor,
+                        self.call, query)
+                finally:
+                    outstanding[0] -= 1
+            return (key, result)
+
+        return dict(await asyncio.gather(*[fetch(key, group, query)
+            for (key, (group, query)) in queries.items()]))
+
+    def stats(self):
+        return {
+            'blocks': self.blocks,
+            'lookups': self.lookups,
+            'duplicates': self.duplicates,
+            'max_in_flight': self.max_in_flight,
+            'seconds': round(self.seconds, 4)
+        }
+
+### EOF
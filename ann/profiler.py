@@ -0,0 +1,200 @@
+# profiler.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Per-stage profile of a fused pipeline run
+#
+# For every stage, a Profiler records the wall time spent annotating, the
+# records annotated, the reference lookups made and rows returned, and
+# the bytes of the records going into and coming out of the stage (what
+# the staged pipeline reads and writes per step). Lookups are counted by
+# wrapping the reference backend each stage sees; with the mysql backend
+# each lookup is one query unless it was cached or prefetched. The
+# profile is appended to the job's .count.log and written as JSON to
+# <input>.profile.json.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import json
+
+
+"""Counters of one stage
+"""
+class StageProfile(object):
+    counter_names = ('seconds', 'records', 'lookups', 'rows', 'bytes_read',
+        'bytes_written')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.records = 0
+        self.lookups = 0
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def counters(self):
+        return dict([(name, getattr(self, name)) for name in self.counter_names])
+
+    def merge(self, counters):
+        for (name, value) in counters.items():
+            setattr(self, name, getattr(self, name) + value)
+
+    def report(self):
+        report = self.counters()
+        report['stage'] = self.name
+        report['seconds'] = round(self.seconds, 4)
+        report['records_per_sec'] = round(self.records / self.seconds, 1) \
+            if (self.seconds > 0) else 0.0
+        return report
+
+
+"""Reference backend wrapper that counts the lookups of one stage and
+the rows they return; every call goes to the wrapped backend
+"""
+class CountingReference(object):
+    def __init__(self, reference, profile):
+        self.reference = reference
+        self.profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self.reference, name)
+
+    def count(self, rows):
+        self.profile.lookups += 1
+        self.profile.rows += rows
+
+    def rows_at(self, table, chrom, positions, **options):
+        (names, found) = self.reference.rows_at(table, chrom, positions,
+            **options)
+        self.count(sum([len(rows) for rows in found.values()]))
+        return (names, found)
+
+    def overlapping(self, table, chrom, start, end=None, **options):
+        rows = self.reference.overlapping(table, chrom, start, end, **options)
+        self.count(len(rows))
+        return rows
+
+    def first_overlapping(self, table, chrom, start, end=None, **options):
+        row = self.reference.first_overlapping(table, chrom, start, end,
+            **options)
+        self.count(0 if row is None else 1)
+        return row
+
+    def intervals(self, table, chrom, **options):
+        (starts, ends) = self.reference.intervals(table, chrom, **options)
+        self.count(len(starts))
+        return (starts, ends)
+
+    def intervalRows(self, table, chrom, **options):
+        (starts, ends, rows) = self.reference.intervalRows(table, chrom,
+            **options)
+        self.count(len(rows))
+        return (starts, ends, rows)
+
+
+"""Profile of a run of stages; one StageProfile per stage, plus the time
+spent prefetching lookups (see prefetch.py) and the bytes of the input
+and output. Wall time is measured from start (default: now) to finish().
+"""
+class Profiler(object):
+    def __init__(self, stages, start=None):
+        self.stages = [StageProfile(stageName(stage)) for stage in stages]
+        self.prefetch_seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.block_bytes = 0
+        self.start = time.perf_counter() if (start is None) else start
+        self.seconds = 0.0
+
+    """The reference backend stage i should use
+    """
+    def reference(self, i, reference):
+        return CountingReference(reference, self.stages[i])
+
+    """Runs stage i over block; stages are run in order, and each reads
+    the bytes the previous one wrote
+    """
+    def annotate(self, i, stage, block):
+        profile = self.stages[i]
+        if (i == 0):
+            self.block_bytes = sum([record.size() for record in block])
+        profile.bytes_read += self.block_bytes
+        start = time.perf_counter()
+        stage.annotate_block(block)
+        profile.seconds += time.perf_counter() - start
+        profile.records += len(block)
+        self.block_bytes = sum([record.size() for record in block])
+        profile.bytes_written += self.block_bytes
+
+    def prefetch(self, prefetchBlock, block):
+        start = time.perf_counter()
+        prefetchBlock(block)
+        self.prefetch_seconds += time.perf_counter() - start
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.start
+
+    def counters(self):
+        return {
+            'stages': [profile.counters() for profile in self.stages],
+            'prefetch_seconds': self.prefetch_seconds,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'seconds': self.seconds
+        }
+
+    """Adds the counters of another run, e.g. over a shard
+    """
+    def merge(self, counters):
+        for (profile, stage_counters) in zip(self.stages, counters['stages']):
+            profile.merge(stage_counters)
+        self.prefetch_seconds += counters['prefetch_seconds']
+        self.bytes_read += counters['bytes_read']
+        self.bytes_written += counters['bytes_written']
+
+    def report(self):
+        return {
+            'stages': [profile.report() for profile in self.stages],
+            'prefetch_seconds': round(self.prefetch_seconds, 4),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'seconds': round(self.seconds, 4)
+        }
+
+    """Appends the profile to a count log, slowest stage first
+    """
+    def writeLog(self, fh_log):
+        report = self.report()
+        fh_log.write("## Stage profile (seconds, records/sec, lookups, " + \
+            "rows, bytes read, bytes written)\n")
+        for stage in sorted(report['stages'], key=lambda s: -s['seconds']):
+            fh_log.write(f"{stage['stage']}: {stage['seconds']} s, " + \
+                f"{stage['records_per_sec']} records/s, " + \
+                f"{stage['lookups']} lookups, {stage['rows']} rows, " + \
+                f"{stage['bytes_read']} bytes read, " + \
+                f"{stage['bytes_written']} bytes written\n")
+        if (self.prefetch_seconds > 0):
+            fh_log.write(f"Prefetch: {report['prefetch_seconds']} s\n")
+        fh_log.write(f"Run total: {report['seconds']} s, " + \
+            f"{report['bytes_read']} bytes read, " + \
+            f"{report['bytes_written']} bytes written\n")
+
+    def writeJson(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.report(), fh, indent=2)
+            fh.write('\n')
+
+
+"""Name of a stage in the profile: its class, and its table if it has one
+"""
+def stageName(stage):
+    name = type(stage).__name__
+    if stage.table is not None:
+        name = name + ':' + str(stage.table)
+    return name
+
+### EOF
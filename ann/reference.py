@@ -0,0 +1,319 @@
+# reference.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Pluggable access to the annotator reference tables
+#
+# Annotation stages ask a reference backend for the rows of a table that
+# overlap a position instead of building SQL themselves. The backend is
+# chosen by name (see open_reference) so stages do not need to know
+# whether lookups are answered by MySQL, in process, or from a
+# memory-mapped reference pack (see refpack.py).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import time
+import threading
+import importlib
+
+import utils as u
+from intervals import IntervalIndex
+from sweep import SweepReference
+from lookupcache import CachedReference, shared_cache
+
+
+# Table and column names are spliced into query templates and must be
+# plain identifiers (or '*'); values are always passed as parameters
+IDENTIFIER = re.compile(r'^\s*(\*|[A-Za-z_][A-Za-z0-9_]*)\s*$')
+
+
+"""Comma-separated table or column names, quoted with backticks (which
+MySQL and SQLite both accept, so names like `end` need no special case)
+"""
+def quote(names):
+    quoted = []
+    for part in str(names).split(','):
+        match = IDENTIFIER.match(part)
+        if not match:
+            raise ValueError(f"Invalid table or column name '{part}'")
+        name = match.group(1)
+        quoted.append(name if (name == '*') else ('`' + name + '`'))
+    return ', '.join(quoted)
+
+
+"""Number of queries, rows and seconds spent per reference table
+"""
+class QueryStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def record(self, table, seconds, rows):
+        with self.lock:
+            stats = self.tables.setdefault(table, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += rows
+            stats[2] += seconds
+
+    def stats(self):
+        with self.lock:
+            return dict([(table, {
+                'queries': queries,
+                'rows': rows,
+                'seconds': round(seconds, 4),
+                'mean_ms': round(1000 * seconds / max(queries, 1), 3)
+            }) for (table, (queries, rows, seconds)) in self.tables.items()])
+
+
+QUERY_STATS = QueryStats()
+
+
+"""Answers every lookup with one SQL query against the annotator database
+Queries are built once per table and lookup shape (see template) and
+run with the variant's values as parameters.
+"""
+class MySQLReference(object):
+    def __init__(self, conn=None):
+        self.conn = conn if (conn is not None) else u.db_connect()
+        self.cursor = self.conn.cursor()
+        self.templates = {}
+
+    def close(self):
+        self.conn.close()
+
+    """SQL for key, built by build() the first time key is used
+    """
+    def template(self, key, build):
+        sql = self.templates.get(key)
+        if sql is None:
+            sql = self.templates[key] = build()
+        return sql
+
+    """Runs a query template with params and returns all rows (or only
+    the first, or None, with one), counting it against table
+    """
+    def query(self, table, sql, params=(), one=False):
+        start = time.perf_counter()
+        self.cursor.execute(sql, params)
+        if one:
+            rows = self.cursor.fetchone()
+            count = 0 if rows is None else 1
+        else:
+            rows = self.cursor.fetchall()
+            count = len(rows)
+        QUERY_STATS.record(table, time.perf_counter() - start, count)
+        return rows
+
+    """Lower-cased column names of the last query
+    """
+    def columnNames(self):
+        return [str(d[0]).lower() for d in self.cursor.description]
+
+    """Rows of table on chrom whose pos_col is any of positions
+    Issues one "pos_col in (...)" query per batch_size positions instead
+    of one query per position. Returns the lower-cased column names and a
+    dict from position to the rows at that position, in query order.
+    match restricts the rows to columns equal to the given values.
+    """
+    def rows_at(self, table, chrom, positions, chrom_col='chrom',
+        pos_col='pos', match=None, batch_size=5000):
+        positions = sorted(set([int(p) for p in positions]))
+        match = sorted((match or {}).items())
+        names = []
+        found = {}
+
+        def build(count):
+            sql = 'select * from ' + quote(table) + ' where ' + \
+                quote(chrom_col) + '=%s AND ' + quote(pos_col) + ' in (' + \
+                ','.join(['%s'] * count) + ')'
+            for (column, value) in match:
+                sql = sql + ' AND ' + quote(column) + '=%s'
+            return sql
+
+        for i in range(0, len(positions), batch_size):
+            batch = positions[i:i + batch_size]
+            key = ('rows_at', table, chrom_col, pos_col,
+                tuple([column for (column, value) in match]), len(batch))
+            sql = self.template(key, lambda: build(len(batch)))
+            rows = self.query(table, sql, [str(chrom)] + batch + \
+                [str(value) for (column, value) in match])
+
+            names = self.columnNames()
+            pos_ind = names.index(pos_col.lower())
+            for row in rows:
+                found.setdefault(int(row[pos_ind]), []).append(row)
+
+        return (names, found)
+
+    """Query template for the rows of table (on a chromosome, unless
+    chrom_col is None) with extra columns appended to columns
+    """
+    def selectSql(self, table, columns, chrom_col, extra=()):
+        key = ('select', table, columns, chrom_col, tuple(extra))
+
+        def build():
+            sql = 'select ' + quote(', '.join([columns] + list(extra))) + \
+                ' from ' + quote(table)
+            if chrom_col is not None:
+                sql = sql + ' where ' + quote(chrom_col) + '=%s'
+            return sql
+
+        return self.template(key, build)
+
+    def chromParams(self, chrom, chrom_col):
+        return [] if (chrom_col is None) else [str(chrom)]
+
+    def overlapSql(self, table, columns, chrom_col, start_col, end_col):
+        key = ('overlap', table, columns, chrom_col, start_col, end_col)
+
+        def build():
+            sql = 'select ' + quote(columns) + ' from ' + quote(table) + \
+                ' where '
+            if chrom_col is not None:
+                sql = sql + quote(chrom_col) + '=%s AND '
+            return sql + '(' + quote(start_col) + ' <= %s AND %s <= ' + \
+                quote(end_col) + ')'
+
+        return self.template(key, build)
+
+    """Rows of table on chrom whose [start_col, end_col] overlaps [start, end]
+    A point lookup is a range with end == start. Tables that are split
+    by chromosome (e.g. tfbsConsSites1..Y) pass chrom_col=None.
+    """
+    def overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        if end is None:
+            end = start
+        return self.query(table,
+            self.overlapSql(table, columns, chrom_col, start_col, end_col),
+            self.chromParams(chrom, chrom_col) + [int(end), int(start)])
+
+    """First row returned by overlapping(), or None
+    """
+    def first_overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        if end is None:
+            end = start
+        return self.query(table,
+            self.overlapSql(table, columns, chrom_col, start_col, end_col),
+            self.chromParams(chrom, chrom_col) + [int(end), int(start)],
+            one=True)
+
+    """Start and end columns of every row of table on chrom
+    Used by stages that test many positions against a table at once
+    (see cnvflags.py)
+    """
+    def intervals(self, table, chrom, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd'):
+        rows = self.query(table,
+            self.selectSql(table, start_col + ', ' + end_col, chrom_col),
+            self.chromParams(chrom, chrom_col))
+        return ([row[0] for row in rows], [row[1] for row in rows])
+
+    """Every row of table on chrom with its start and end
+    Returns (starts, ends, rows); rows hold the requested columns, in
+    table order (see sweep.py)
+    """
+    def intervalRows(self, table, chrom, columns='*', chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd'):
+        rows = self.query(table,
+            self.selectSql(table, columns, chrom_col, (start_col, end_col)),
+            self.chromParams(chrom, chrom_col))
+        return ([row[-2] for row in rows], [row[-1] for row in rows],
+            [row[:-2] for row in rows])
+
+
+"""Answers overlap lookups from an in-memory interval index
+The rows of a table are fetched once per chromosome, the first time a
+variant on that chromosome is looked up, and kept in an IntervalIndex
+for the lifetime of the reference. Keyed lookups (dbSNP, bigRefGene)
+still go to MySQL through rows_at().
+"""
+class IndexedReference(MySQLReference):
+    def __init__(self, conn=None):
+        MySQLReference.__init__(self, conn)
+        self.indexes = {}
+
+    def getIndex(self, table, chrom, columns, chrom_col, start_col, end_col):
+        key = (table, columns, chrom_col, start_col, end_col, chrom)
+        index = self.indexes.get(key)
+        if index is not None:
+            return index
+
+        rows = self.query(table, self.selectSql(table, columns, chrom_col),
+            self.chromParams(chrom, chrom_col))
+
+        names = self.columnNames()
+        start_ind = names.index(start_col.lower())
+        end_ind = names.index(end_col.lower())
+        index = IntervalIndex((row[start_ind], row[end_ind], row) for row in rows)
+        self.indexes[key] = index
+        return index
+
+    def overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        index = self.getIndex(table, chrom, columns, chrom_col, start_col,
+            end_col)
+        return index.overlapping(int(start), None if end is None else int(end))
+
+    def first_overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        index = self.getIndex(table, chrom, columns, chrom_col, start_col,
+            end_col)
+        return index.first(int(start), None if end is None else int(end))
+
+
+# Backends that need optional packages are named as "module.Class" and
+# imported on first use
+BACKENDS = {
+    'mysql': MySQLReference,
+    'index': IndexedReference,
+    'pack': 'refpack.PackedReference'
+}
+
+"""Name of the reference backend to use: backend, or the
+ANN_REFERENCE_BACKEND environment variable, or 'index'
+"""
+def backend_name(backend=None):
+    if backend is None:
+        backend = os.environ['ANN_REFERENCE_BACKEND'] if \
+            ('ANN_REFERENCE_BACKEND' in os.environ) else 'index'
+    return backend
+
+
+"""Opens a reference backend by name (see backend_name)
+With sweep, overlap lookups on sorted inputs are answered by a sweep
+line (see sweep.py); it is off unless sweep is true or
+ANN_REFERENCE_SWEEP=1. cache (default: the
+process-wide cache configured by ANN_REFERENCE_CACHE) memoizes lookups
+(see lookupcache.py).
+"""
+def open_reference(backend=None, conn=None, sweep=None, cache=None):
+    backend = backend_name(backend)
+    if sweep is None:
+        sweep = (os.environ['ANN_REFERENCE_SWEEP'] == '1') if \
+            ('ANN_REFERENCE_SWEEP' in os.environ) else False
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown reference backend '{backend}'; " + \
+            f"expected one of {', '.join(sorted(BACKENDS))}")
+
+    cls = BACKENDS[backend]
+    if isinstance(cls, str):
+        (module, name) = cls.rsplit('.', 1)
+        cls = getattr(importlib.import_module(module), name)
+    if cache is None:
+        cache = shared_cache()
+
+    refdb = cls() if (conn is None) else cls(conn)
+    if cache is not None:
+        refdb = CachedReference(refdb, cache)
+    if sweep:
+        refdb = SweepReference(refdb)
+    return refdb
+
+### EOF
@@ -0,0 +1,503 @@
+# refpack.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Compact, memory-mapped copy of the annotator reference tables
+#
+# A reference pack holds every table as one directory per chromosome with
+# one NumPy file per column. Integer and float columns are stored as
+# int64/float64 arrays; all other columns are dictionary-encoded as int32
+# codes into a per-column string table (a byte blob plus offsets). All
+# files are opened with mmap, so opening a pack costs no database
+# connection and no parsing, and only the pages a lookup touches are read.
+# Overlap lookups search arrays written at build time (the row ids
+# sorted by interval start, and the running maximum of their ends), so
+# annotator processes share the pages of a pack in the page cache instead
+# of each building an index of its own.
+#
+# Build a pack from the annotator database with:
+#   python refpack.py <outdir> [table ...]
+# and annotate against it with ANN_REFERENCE_BACKEND=pack and
+# ANN_REFERENCE_PACK=<outdir>.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import numpy as np
+import pymysql
+
+import utils as u
+
+# Reference tables and the column that holds their chromosome;
+# tfbsConsSites is already split into one table per chromosome
+TABLES = {
+    'dbSNP': 'CHR',
+    'chrom_pos_equal_base': 'CHR',
+    'chrom_pos_equal_nobase': 'CHR',
+    'chrom_pos_unequal': 'CHR',
+    'refGene': 'chrom',
+    'cpgIslandExt': 'chrom',
+    'cytoBand': 'chrom',
+    'gadAll': 'chromosome',
+    'gwasCatalog': 'chrom',
+    'targetScanS': 'chrom',
+    'hugo': 'chrom',
+    'dgv_Cnv': 'chrom',
+    'abParts_IG_T_CelReceptors': 'chrom',
+    'mcCarroll_Cnv': 'chrom',
+    'conrad_Cnv': 'chrom',
+    'genomicSuperDups': 'chrom'
+}
+for chrIndex in [str(i) for i in range(1, 23)] + ['X', 'Y']:
+    TABLES['tfbsConsSites' + chrIndex] = None
+
+# Tables answered by position (rows_at) are stored sorted by that column
+SORTED_BY = {
+    'dbSNP': 'POS',
+    'chrom_pos_equal_base': 'start',
+    'chrom_pos_equal_nobase': 'start'
+}
+
+# (start, end) columns that overlap lookups search; every partition that
+# has both as integer columns gets an overlap index for them
+OVERLAP_COLUMNS = [
+    ('chromStart', 'chromEnd'),
+    ('txStart', 'txEnd'),
+    ('start', 'end'),
+    ('chromEnd', 'chromEnd')
+]
+
+# Partition name of tables that are not split by chromosome
+ALL = '_all'
+
+FETCH_ROWS = 50000
+
+
+"""Storage kind of a column: 'int', 'float', 'bytes' or 'str'
+Columns with NULLs are stored as 'str' (or 'bytes') so NULL survives
+"""
+def columnKind(values):
+    kinds = set([type(v) for v in values])
+    if (len(kinds) == 0) or (kinds == set([int])):
+        return 'int'
+    if kinds == set([float]):
+        return 'float'
+    if kinds <= set([bytes, bytearray, type(None)]):
+        return 'bytes'
+    return 'str'
+
+
+"""Writes values as int32 codes into a string table
+NULL is stored as code -1
+"""
+def writeDictColumn(path, values, kind):
+    codes = np.empty(len(values), dtype=np.int32)
+    lookup = {}
+    strings = []
+    for (i, value) in enumerate(values):
+        if value is None:
+            codes[i] = -1
+            continue
+        if (kind == 'str'):
+            value = str(value).encode('utf-8')
+        else:
+            value = bytes(value)
+        code = lookup.get(value)
+        if code is None:
+            code = lookup[value] = len(strings)
+            strings.append(value)
+        codes[i] = code
+
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in strings])
+    np.save(path + '.npy', codes)
+    np.save(path + '.offsets.npy', offsets)
+    with open(path + '.strings', 'wb') as fh:
+        fh.write(b''.join(strings))
+
+
+"""Row ids sorted by start (ties in row order), their starts, and the
+running maximum of their ends, for overlap lookups on [start, end]
+"""
+def overlapArrays(starts, ends):
+    order = np.argsort(starts, kind='stable')
+    return (order, np.asarray(starts)[order],
+        np.maximum.accumulate(np.asarray(ends)[order]))
+
+
+"""Path prefix of the overlap index files of start_name and end_name
+"""
+def overlapPath(dirname, start_name, end_name):
+    return os.path.join(dirname, f"overlap.{start_name}.{end_name}")
+
+
+"""Writes the rows of one chromosome of a table into dirname
+"""
+def writePartition(dirname, names, columns, sorted_by=None):
+    os.makedirs(dirname, exist_ok=True)
+    if (sorted_by is not None) and (len(columns[0]) > 0):
+        key = np.asarray(columns[[n.lower() for n in names].index(
+            sorted_by.lower())], dtype=np.int64)
+        order = np.argsort(key, kind='stable').tolist()
+        columns = [[values[i] for i in order] for values in columns]
+
+    kinds = []
+    for (name, values) in zip(names, columns):
+        kind = columnKind(values)
+        path = os.path.join(dirname, name)
+        if (kind == 'int'):
+            np.save(path + '.npy', np.asarray(values, dtype=np.int64))
+        elif (kind == 'float'):
+            np.save(path + '.npy', np.asarray(values, dtype=np.float64))
+        else:
+            writeDictColumn(path, values, kind)
+        kinds.append(kind)
+
+    overlaps = []
+    lower = [name.lower() for name in names]
+    for (start_name, end_name) in OVERLAP_COLUMNS:
+        if (start_name.lower() not in lower) or \
+            (end_name.lower() not in lower):
+            continue
+        start_ind = lower.index(start_name.lower())
+        end_ind = lower.index(end_name.lower())
+        if (kinds[start_ind] != 'int') or (kinds[end_ind] != 'int'):
+            continue
+        (order, starts, max_ends) = overlapArrays(
+            np.asarray(columns[start_ind], dtype=np.int64),
+            np.asarray(columns[end_ind], dtype=np.int64))
+        path = overlapPath(dirname, names[start_ind], names[end_ind])
+        np.save(path + '.order.npy', order)
+        np.save(path + '.starts.npy', starts)
+        np.save(path + '.max_ends.npy', max_ends)
+        overlaps.append([names[start_ind], names[end_ind]])
+
+    with open(os.path.join(dirname, 'meta.json'), 'w') as fh:
+        json.dump({'rows': len(columns[0]) if columns else 0,
+            'columns': names, 'kinds': kinds, 'sorted_by': sorted_by,
+            'overlaps': overlaps}, fh)
+
+
+"""Exports one table into outdir/<table>/<chromosome>/
+Rows are streamed with a server-side cursor, one chromosome at a time
+"""
+def buildTable(conn, outdir, table):
+    chrom_col = TABLES[table]
+    cursor = conn.cursor()
+    if chrom_col is not None:
+        cursor.execute('select distinct ' + chrom_col + ' from ' + table + ';')
+        chroms = [str(row[0]) for row in cursor.fetchall()]
+    else:
+        chroms = [None]
+    cursor.close()
+
+    names = []
+    partitions = {}
+    for chrom in chroms:
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        if chrom is None:
+            cursor.execute('select * from ' + table + ';')
+        else:
+            cursor.execute('select * from ' + table + ' where ' + chrom_col +
+                ' = %s;', (chrom,))
+        names = [str(d[0]) for d in cursor.description]
+        columns = [[] for name in names]
+        while True:
+            rows = cursor.fetchmany(FETCH_ROWS)
+            if (len(rows) == 0):
+                break
+            for row in rows:
+                for (values, value) in zip(columns, row):
+                    values.append(value)
+        cursor.close()
+
+        name = ALL if chrom is None else chrom
+        writePartition(os.path.join(outdir, table, name), names, columns,
+            SORTED_BY.get(table))
+        partitions[name] = len(columns[0]) if columns else 0
+
+    with open(os.path.join(outdir, table, 'meta.json'), 'w') as fh:
+        json.dump({'table': table, 'chrom_col': chrom_col, 'columns': names,
+            'partitions': partitions}, fh)
+    return partitions
+
+
+"""Exports tables (default: all of TABLES) from the annotator database
+"""
+def build(outdir, tables=None, conn=None):
+    conn = conn if (conn is not None) else u.db_connect()
+    for table in (tables or sorted(TABLES)):
+        partitions = buildTable(conn, outdir, table)
+        print(f"{table}: {sum(partitions.values())} rows in " + \
+            f"{len(partitions)} partitions")
+    conn.close()
+
+
+"""One chromosome of one table, memory-mapped
+"""
+class Partition(object):
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'meta.json')) as fh:
+            meta = json.load(fh)
+        self.rows = meta['rows']
+        self.names = meta['columns']
+        self.kinds = meta['kinds']
+        self.sorted_by = meta['sorted_by']
+        self.overlaps = [tuple(pair) for pair in meta.get('overlaps', [])]
+        self.lower = [name.lower() for name in self.names]
+        self.arrays = {}
+        self.strings = {}
+        self.overlap_indexes = {}
+
+    def columnIndex(self, name):
+        return self.lower.index(name.strip().lower())
+
+    """Raw array of a column: values, or codes for dictionary columns
+    """
+    def array(self, j):
+        array = self.arrays.get(j)
+        if array is None:
+            array = np.load(os.path.join(self.dirname,
+                self.names[j] + '.npy'), mmap_mode='r')
+            self.arrays[j] = array
+        return array
+
+    def stringTable(self, j):
+        table = self.strings.get(j)
+        if table is None:
+            path = os.path.join(self.dirname, self.names[j])
+            offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+            if (os.path.getsize(path + '.strings') > 0):
+                blob = np.memmap(path + '.strings', dtype=np.uint8, mode='r')
+            else:
+                blob = np.zeros(0, dtype=np.uint8)
+            table = self.strings[j] = (offsets, blob)
+        return table
+
+    def value(self, j, i):
+        kind = self.kinds[j]
+        if (kind == 'int'):
+            return int(self.array(j)[i])
+        if (kind == 'float'):
+            return float(self.array(j)[i])
+
+        code = int(self.array(j)[i])
+        if (code < 0):
+            return None
+        (offsets, blob) = self.stringTable(j)
+        value = blob[offsets[code]:offsets[code + 1]].tobytes()
+        return value if (kind == 'bytes') else value.decode('utf-8')
+
+    """Row i as a tuple of the columns with indices cols
+    """
+    def row(self, i, cols):
+        return tuple([self.value(j, i) for j in cols])
+
+    """OverlapIndex over the columns start_col and end_col
+    Memory-mapped from the files written by build(); a pack built without
+    them gets an index computed in memory.
+    """
+    def overlapIndex(self, start_col, end_col):
+        key = (start_col.lower(), end_col.lower())
+        index = self.overlap_indexes.get(key)
+        if index is None:
+            start_ind = self.columnIndex(start_col)
+            end_ind = self.columnIndex(end_col)
+            ends = self.array(end_ind)
+            pair = (self.names[start_ind], self.names[end_ind])
+            if pair in self.overlaps:
+                path = overlapPath(self.dirname, *pair)
+                (order, starts, max_ends) = [
+                    np.load(path + suffix, mmap_mode='r') for suffix in
+                    ['.order.npy', '.starts.npy', '.max_ends.npy']]
+            else:
+                (order, starts, max_ends) = overlapArrays(
+                    self.array(start_ind), ends)
+            index = self.overlap_indexes[key] = \
+                OverlapIndex(order, starts, max_ends, ends)
+        return index
+
+
+"""Overlap lookups on the closed intervals of a partition
+Searches the row ids sorted by start: rows past the last start <= end
+cannot overlap, nor can rows before the first whose running maximum end
+reaches start. The rows in between are checked against their own end.
+Like intervals.IntervalIndex, lookups return row ids in row order.
+"""
+class OverlapIndex(object):
+    def __init__(self, order, starts, max_ends, ends):
+        self.order = order
+        self.starts = starts
+        self.max_ends = max_ends
+        self.ends = ends
+
+    """Row ids of all intervals overlapping [start, end], in row order
+    """
+    def find(self, start, end=None):
+        if end is None:
+            end = start
+        lo = int(np.searchsorted(self.max_ends, start, side='left'))
+        hi = int(np.searchsorted(self.starts, end, side='right'))
+        if (lo >= hi):
+            return []
+        ids = np.asarray(self.order[lo:hi])
+        return np.sort(ids[np.asarray(self.ends[ids]) >= start]).tolist()
+
+    """Row id of the first interval overlapping [start, end], or None
+    """
+    def first(self, start, end=None):
+        ids = self.find(start, end)
+        return ids[0] if ids else None
+
+
+"""Answers lookups from a reference pack built by build()
+Keyed lookups (rows_at) binary-search the sorted position column;
+overlap lookups search the memory-mapped overlap index of the start and
+end columns (see OverlapIndex).
+"""
+class PackedReference(object):
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ['ANN_REFERENCE_PACK'] if \
+                ('ANN_REFERENCE_PACK' in os.environ) else \
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'refpack')
+        if not os.path.isdir(path):
+            raise ValueError(f"Reference pack not found: {path}")
+        self.path = path
+        self.tables = {}
+        self.partitions = {}
+
+    def close(self):
+        self.tables = {}
+        self.partitions = {}
+
+    """meta.json of table, with its lower-cased column names
+    """
+    def tableMeta(self, table):
+        if table not in self.tables:
+            with open(os.path.join(self.path, table, 'meta.json')) as fh:
+                meta = json.load(fh)
+            meta['lower'] = [name.lower() for name in meta['columns']]
+            self.tables[table] = meta
+        return self.tables[table]
+
+    """Lower-cased column names of table
+    """
+    def columnNames(self, table):
+        return self.tableMeta(table)['lower']
+
+    """Partition of table for chrom, or None if the chromosome has no rows
+    Only partitions listed in the table's meta.json are opened, so the
+    chromosome of an input record is never used as a path.
+    """
+    def partition(self, table, chrom):
+        name = ALL if chrom is None else str(chrom)
+        key = (table, name)
+        if key not in self.partitions:
+            self.partitions[key] = \
+                Partition(os.path.join(self.path, table, name)) \
+                if (name in self.tableMeta(table)['partitions']) else None
+        return self.partitions[key]
+
+    def columnIndices(self, part, columns):
+        if (columns.strip() == '*'):
+            return list(range(len(part.names)))
+        return [part.columnIndex(name) for name in columns.split(',')]
+
+    def rows_at(self, table, chrom, positions, chrom_col='chrom',
+        pos_col='pos', match=None, batch_size=5000):
+        positions = sorted(set([int(p) for p in positions]))
+        part = self.partition(table, chrom)
+        if (part is None) or (len(positions) == 0):
+            return (self.columnNames(table), {})
+
+        cols = list(range(len(part.names)))
+        pos_ind = part.columnIndex(pos_col)
+        values = part.array(pos_ind)
+        # MySQL compares strings case-insensitively
+        match = [(part.columnIndex(column), str(value).upper())
+            for (column, value) in (match or {}).items()]
+
+        if (part.sorted_by is not None) and \
+            (part.sorted_by.lower() == pos_col.lower()):
+            keys = np.asarray(positions, dtype=np.int64)
+            lo = np.searchsorted(values, keys, side='left')
+            hi = np.searchsorted(values, keys, side='right')
+            hits = [(p, range(l, h)) for (p, l, h) in
+                zip(positions, lo.tolist(), hi.tolist()) if (h > l)]
+        else:
+            ids = np.nonzero(np.isin(values, positions))[0].tolist()
+            hits = [(int(values[i]), [i]) for i in ids]
+
+        found = {}
+        for (pos, ids) in hits:
+            for i in ids:
+                if all([str(part.value(j, i)).upper() == value
+                    for (j, value) in match]):
+                    found.setdefault(pos, []).append(part.row(i, cols))
+
+        return (self.columnNames(table), found)
+
+    def getIndex(self, table, chrom, chrom_col, start_col, end_col):
+        part = self.partition(table, chrom if chrom_col is not None else None)
+        if part is None:
+            return (None, None)
+        return (part, part.overlapIndex(start_col, end_col))
+
+    def overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        (part, index) = self.getIndex(table, chrom, chrom_col, start_col,
+            end_col)
+        if part is None:
+            return []
+        ids = index.find(int(start), None if end is None else int(end))
+        if (len(ids) == 0):
+            return []
+        cols = self.columnIndices(part, columns)
+        return [part.row(i, cols) for i in ids]
+
+    def first_overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        (part, index) = self.getIndex(table, chrom, chrom_col, start_col,
+            end_col)
+        if part is None:
+            return None
+        i = index.first(int(start), None if end is None else int(end))
+        if i is None:
+            return None
+        return part.row(i, self.columnIndices(part, columns))
+
+    """Memory-mapped start and end columns of table on chrom
+    """
+    def intervals(self, table, chrom, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd'):
+        part = self.partition(table, chrom if chrom_col is not None else None)
+        if part is None:
+            return ([], [])
+        return (part.array(part.columnIndex(start_col)),
+            part.array(part.columnIndex(end_col)))
+
+    def intervalRows(self, table, chrom, columns='*', chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd'):
+        part = self.partition(table, chrom if chrom_col is not None else None)
+        if part is None:
+            return ([], [], [])
+        cols = self.columnIndices(part, columns)
+        (starts, ends) = self.intervals(table, chrom, chrom_col=chrom_col,
+            start_col=start_col, end_col=end_col)
+        return (starts.tolist(), ends.tolist(),
+            [part.row(i, cols) for i in range(part.rows)])
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 2):
+        print("Usage: python refpack.py <outdir> [table ...]")
+        sys.exit(1)
+    build(sys.argv[1], tables=sys.argv[2:] or None)
+
+### EOF
@@ -12,8 +12,14 @@ import sys
 import time
 import json
 import driver
+import pipeline
+import utils
+import lookupcache
+import reference
+import transfer
 import boto3
 import os
+import shutil
 from botocore.client import Config
 from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
@@ -47,10 +53,30 @@ class Timer(object):
 
 
 if __name__ == '__main__':
+    # The annotator passes --stream-input when it did not download the
+    # input; read the input from S3 while annotating it then
+    stream_input = '--stream-input' in sys.argv
+    if stream_input:
+        sys.argv.remove('--stream-input')
+
     # Call the AnnTools pipeline
     if len(sys.argv) > 1:
+        lines = None
+        if stream_input:
+            lines = transfer.stream_lines(config["s3"]["AwsS3InputsBucket"],
+                sys.argv[2], config["aws"]["AwsRegionName"])
+
+        # Inputs may be gzip/BGZF compressed (.vcf.gz); compressed inputs,
+        # or all inputs with AnnCompressResults, get a .annot.vcf.gz result
+        compress = True if config.getboolean('ann', 'AnnCompressResults',
+            fallback=False) else None
         with Timer():
-            driver.run(sys.argv[1], 'vcf')
+            result_file = driver.run(sys.argv[1], 'vcf', lines=lines,
+                compress=compress)
+        print(f"Reference database connections: {utils.DB_POOL.stats()}")
+        print(f"Reference queries: {reference.QUERY_STATS.stats()}")
+        if lookupcache.shared_cache() is not None:
+            print(f"Reference lookup cache: {lookupcache.shared_cache().stats()}")
 
         complete_time = int(time.time())
             
@@ -62,37 +88,52 @@ if __name__ == '__main__':
         email = sys.argv[4]
         user_id = sys.argv[5]
 
-        segments = file_path.split('/')
-        file_name = segments[-1][:-4]
-
         bucket_name = config["s3"]["AwsS3ResultsBucket"]
 
         # Get connection to S3 bucket
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
         s3 = boto3.resource('s3', region_name=config["aws"]["AwsRegionName"], config=Config(signature_version='s3v4'))
 
-        # Get current working directory
-        cwd = os.getcwd()
-        file_name_local = f"{cwd}/jobs/{job_id}/{file_name}.annot.vcf"
-        log_file_name_local = f"{cwd}/jobs/{job_id}/{file_name}.vcf.count.log"
+        # Results are written next to the input, in the job's directory
+        job_dir = os.path.dirname(os.path.abspath(file_path))
+        file_name_local = result_file
+        log_file_name_local = pipeline.count_log_name(file_path)
 
         # Upload the annotation result file to S3 bucket
-        key_result_file = f"{key_prefix}/{job_id}~{file_name}.annot.vcf"
+        key_result_file = f"{key_prefix}/{job_id}~{os.path.basename(file_name_local)}"
         try:
             s3.meta.client.upload_file(file_name_local, bucket_name, key_result_file)
         except ClientError as e:
             raise Exception(f'Unable to upload file: {e}')
 
+        # Upload the tabix index of a compressed result next to it
+        sidecar_keys = []
+        if os.path.exists(file_name_local + '.tbi'):
+            try:
+                s3.meta.client.upload_file(file_name_local + '.tbi', bucket_name, key_result_file + '.tbi')
+            except ClientError as e:
+                raise Exception(f'Unable to upload file: {e}')
+            sidecar_keys.append(key_result_file + '.tbi')
+
+        # Upload the stage profile next to the result
+        profile_file_name_local = pipeline.profile_name(file_path)
+        if os.path.exists(profile_file_name_local):
+            key_profile_file = f"{key_prefix}/{job_id}~{os.path.basename(profile_file_name_local)}"
+            try:
+                s3.meta.client.upload_file(profile_file_name_local, bucket_name, key_profile_file)
+            except ClientError as e:
+                raise Exception(f'Unable to upload file: {e}')
+            sidecar_keys.append(key_profile_file)
+
         # Upload the log file to S3 results bucket
-        key_log_file = f"{key_prefix}/{job_id}~{file_name}.vcf.count.log"
+        key_log_file = f"{key_prefix}/{job_id}~{os.path.basename(log_file_name_local)}"
         try:
             s3.meta.client.upload_file(log_file_name_local, bucket_name, key_log_file)
         except ClientError as e:
             raise Exception(f'Unable to upload file: {e}')
 
         # Clean up (delete) local job files
-        dl_command = f"rm -rf {cwd}/jobs/{job_id}"
-        os.system(dl_command)
+        shutil.rmtree(job_dir, ignore_errors=True)
 
         # Updates the job item in DynamoDB table
         dynamodb = boto3.resource('dynamodb', region_name=config["aws"]["AwsRegionName"])
@@ -103,7 +144,7 @@ if __name__ == '__main__':
 
         # Conditional update: job_status=RUNNING
         try:
-            table.update_item(
+            job = table.update_item(
                 Key={
                     "job_id": job_id
                 },
@@ -115,11 +156,31 @@ if __name__ == '__main__':
                     ":ct": complete_time,
                     ":js": "COMPLETED"
                 },
-                ConditionExpression=Attr("job_status").eq("RUNNING")
-            )
+                ConditionExpression=Attr("job_status").eq("RUNNING"),
+                ReturnValues="ALL_NEW"
+            )['Attributes']
         except ClientError as e:
             raise Exception(f'Unable to update the table: {e}')
 
+        # Index the results by the content hash of the input, so identical
+        # uploads can reuse them; only if the web app hashed the input
+        # against the reference version this annotator uses
+        content_hash = job.get('content_hash')
+        if content_hash and content_hash.endswith(':' + lookupcache.REFERENCE_VERSION):
+            try:
+                index_table = dynamodb.Table(config['dydb']['AwsDynamoDBResultsIndexName'])
+                index_table.put_item(Item={
+                    "content_hash": content_hash,
+                    "job_id": job_id,
+                    "s3_results_bucket": bucket_name,
+                    "s3_key_result_file": key_result_file,
+                    "s3_key_log_file": key_log_file,
+                    "s3_sidecar_keys": sidecar_keys,
+                    "complete_time": complete_time
+                })
+            except ClientError as e:
+                print(f'Unable to index the results of job {job_id}: {e}')
+
         # Publish notification to ywang27_a12_job_results topic
         sns_client = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
 
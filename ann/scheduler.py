@@ -0,0 +1,188 @@
+# scheduler.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Bounded job scheduler for the annotator
+#
+# Annotation jobs run as run.py subprocesses in a fixed number of worker
+# slots. Jobs that arrive while every slot is busy wait in a bounded local
+# queue (their SQS messages are kept invisible by jobqueue.JobQueue).
+# Once the local queue is full, capacity() drops to 0 and the poller
+# stops receiving messages until a slot frees up (backpressure).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import subprocess
+import threading
+from collections import deque
+
+
+"""An annotation job: the run.py arguments and the SQS message it came from
+on_start(job) runs when the job gets a slot, before its process is
+launched; if it returns False (e.g. the job is a duplicate delivery that
+has already been started), the job is skipped. on_finish(job) runs once
+its process has exited or it was skipped.
+"""
+class Job(object):
+    def __init__(self, job_id, args, message=None, on_start=None,
+        on_finish=None):
+        self.job_id = job_id
+        self.args = args
+        self.message = message
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.submitted_at = time.time()
+        self.process = None
+
+
+"""A worker slot and its counters
+"""
+class Slot(object):
+    def __init__(self, index):
+        self.index = index
+        self.job = None
+        self.started_at = None
+        self.busy_seconds = 0.0
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+
+    def busy(self, now):
+        if self.job is None:
+            return self.busy_seconds
+        return self.busy_seconds + (now - self.started_at)
+
+
+"""Runs jobs in at most `slots` concurrent subprocesses
+Call poll() regularly: it reaps finished jobs and starts pending ones.
+"""
+class JobScheduler(object):
+    def __init__(self, slots=None, max_pending=None, launch=None):
+        self.slots = [Slot(i) for i in range(slots or os.cpu_count() or 1)]
+        self.max_pending = len(self.slots) if max_pending is None \
+            else max_pending
+        self.launch = launch if (launch is not None) else subprocess.Popen
+        self.pending = deque()
+        self.lock = threading.RLock()
+        self.started_at = time.time()
+        self.jobs_submitted = 0
+        self.jobs_skipped = 0
+        self.receive_pauses = 0
+
+    def running(self):
+        return len([slot for slot in self.slots if slot.job is not None])
+
+    """True if no job is running or waiting for a slot
+    """
+    def idle(self):
+        with self.lock:
+            return (self.running() == 0) and (len(self.pending) == 0)
+
+    """Number of jobs that can be submitted without exceeding the slots
+    and the local queue; 0 means the poller should stop receiving
+    """
+    def capacity(self):
+        with self.lock:
+            free = len(self.slots) - self.running()
+            return max(0, free + self.max_pending - len(self.pending))
+
+    """Records that the poller skipped receiving because capacity() was 0
+    """
+    def paused(self):
+        with self.lock:
+            self.receive_pauses += 1
+
+    def submit(self, job):
+        with self.lock:
+            if (self.capacity() == 0):
+                raise RuntimeError(f"Job scheduler is full; cannot accept {job.job_id}")
+            self.jobs_submitted += 1
+            self.pending.append(job)
+            self.dispatch()
+
+    def dispatch(self):
+        with self.lock:
+            for slot in self.slots:
+                while (slot.job is None) and (len(self.pending) > 0):
+                    self.start(slot, self.pending.popleft())
+
+    """Launches job in slot unless its on_start skips it
+    A job whose on_start raises goes back to the head of the local queue
+    and is retried by the next dispatch().
+    """
+    def start(self, slot, job):
+        if job.on_start is not None:
+            try:
+                started = job.on_start(job)
+            except Exception:
+                self.pending.appendleft(job)
+                raise
+            if started is False:
+                self.jobs_skipped += 1
+                print(f"Skipped job {job.job_id}.")
+                if job.on_finish is not None:
+                    job.on_finish(job)
+                return
+
+        job.process = self.launch(job.args)
+        slot.job = job
+        slot.started_at = time.time()
+        print(f"Started job {job.job_id} in slot {slot.index}.")
+
+    def reap(self):
+        now = time.time()
+        finished = []
+        with self.lock:
+            for slot in self.slots:
+                if (slot.job is None) or (slot.job.process.poll() is None):
+                    continue
+                finished.append(slot.job)
+                if (slot.job.process.returncode == 0):
+                    slot.jobs_completed += 1
+                else:
+                    slot.jobs_failed += 1
+                    print(f"Job {slot.job.job_id} in slot {slot.index} " + \
+                        f"exited with {slot.job.process.returncode}.")
+                slot.busy_seconds += now - slot.started_at
+                slot.job = None
+                slot.started_at = None
+
+        for job in finished:
+            if job.on_finish is not None:
+                job.on_finish(job)
+
+    def poll(self):
+        self.reap()
+        self.dispatch()
+
+    """Slot utilisation and queue depth, e.g. for autoscaling
+    """
+    def metrics(self):
+        now = time.time()
+        with self.lock:
+            elapsed = max(now - self.started_at, 1e-9)
+            slots = [{
+                'slot': slot.index,
+                'job_id': slot.job.job_id if slot.job is not None else None,
+                'busy_seconds': round(slot.busy(now), 3),
+                'utilisation': round(slot.busy(now) / elapsed, 4),
+                'jobs_completed': slot.jobs_completed,
+                'jobs_failed': slot.jobs_failed
+            } for slot in self.slots]
+
+            return {
+                'slots': slots,
+                'running': self.running(),
+                'pending': len(self.pending),
+                'capacity': self.capacity(),
+                'utilisation': round(sum([s['busy_seconds'] for s in slots]) /
+                    (elapsed * len(self.slots)), 4),
+                'jobs_submitted': self.jobs_submitted,
+                'jobs_skipped': self.jobs_skipped,
+                'receive_pauses': self.receive_pauses
+            }
+
+### EOF
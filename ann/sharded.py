@@ -0,0 +1,201 @@
+# sharded.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Parallel, sharded AnnTools pipeline
+#
+# The records of the input are split into shards, either one per
+# chromosome or fixed-size ranges of records, and every shard is
+# annotated by the fused pipeline in its own worker process. The
+# annotated shards are merged back in the original record order and the
+# stage counters of all shards are summed into one .count.log, so the
+# output is identical to pipeline.run.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import shutil
+import tempfile
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pipeline
+import bgzf
+from profiler import Profiler
+
+# Position in the order array of lines that are not records
+HEADER = -1
+
+# Most shard files open at once while splitting or merging; assemblies
+# with thousands of contigs would otherwise run out of file descriptors
+MAX_OPEN_SHARDS = 256
+
+
+"""Handles of shard files, at most max_open of them open at once
+The least recently used handle is closed when another one is needed; a
+shard that is used again is reopened where it left off (in append mode
+for writing, at its last offset for reading).
+"""
+class ShardHandles(object):
+    def __init__(self, files, mode, max_open=None):
+        self.files = files
+        self.mode = mode
+        self.max_open = MAX_OPEN_SHARDS if (max_open is None) else max_open
+        self.handles = OrderedDict()
+        self.offsets = {}
+
+    def get(self, shard):
+        handle = self.handles.get(shard)
+        if handle is not None:
+            self.handles.move_to_end(shard)
+            return handle
+
+        if (len(self.handles) >= max(self.max_open, 1)):
+            self.close(next(iter(self.handles)))
+        if (self.mode == 'r'):
+            handle = open(self.files[shard])
+            if shard in self.offsets:
+                handle.seek(self.offsets[shard])
+        else:
+            handle = open(self.files[shard],
+                'a' if (shard in self.offsets) else 'w')
+        self.handles[shard] = handle
+        return handle
+
+    def close(self, shard):
+        handle = self.handles.pop(shard, None)
+        if handle is not None:
+            self.offsets[shard] = handle.tell()
+            handle.close()
+
+    def closeAll(self):
+        for shard in list(self.handles):
+            self.close(shard)
+
+
+"""Annotates one shard in a worker process
+Returns the counters of every stage and of the shard's profile
+"""
+def annotateShard(shard_in, shard_out, format, sep, backend, block_size):
+    stages = pipeline.default_stages(format=format)
+    profiler = Profiler(stages)
+    pipeline.annotateFile(shard_in, shard_out, stages, sep=sep,
+        backend=backend, block_size=block_size, profiler=profiler)
+    return ([stage.counters() for stage in stages], profiler.counters())
+
+
+"""Splits the records of infile into shard files in tmpdir
+shard_by is 'chrom' (one shard per chromosome) or 'records' (ranges of
+shard_size records). Returns the shard files, the header lines and the
+shard of every input line (HEADER for header lines), in input order.
+lines, if given, is read instead of infile. At most MAX_OPEN_SHARDS shard
+files are open at once, and in records mode a shard is closed as soon as
+the next one starts.
+"""
+def splitShards(infile, tmpdir, shard_by='chrom', shard_size=50000,
+    sep='\t', lines=None):
+    if shard_by not in ('chrom', 'records'):
+        raise ValueError(f"Unknown shard_by '{shard_by}'; " + \
+            "expected 'chrom' or 'records'")
+
+    shards = {}
+    files = []
+    handles = ShardHandles(files, 'w')
+    headers = []
+    order = array('i')
+    records = 0
+
+    fh = bgzf.open_text(infile) if (lines is None) else None
+    for line in (fh if (lines is None) else lines):
+        line = line.strip()
+        if line.startswith("#"):
+            headers.append(line)
+            order.append(HEADER)
+            continue
+
+        if (shard_by == 'chrom'):
+            key = line.split(sep, 1)[0].strip()
+        else:
+            key = records // shard_size
+        records = records + 1
+
+        shard = shards.get(key)
+        if shard is None:
+            shard = shards[key] = len(files)
+            files.append(os.path.join(tmpdir, f"shard{shard}.vcf"))
+            if (shard_by == 'records') and (shard > 0):
+                # Records never go back to an earlier range
+                handles.close(shard - 1)
+        handles.get(shard).write(line + '\n')
+        order.append(shard)
+    if fh is not None:
+        fh.close()
+
+    handles.closeAll()
+    return (files, headers, order)
+
+
+"""Interleaves the annotated shards back into the input order
+At most MAX_OPEN_SHARDS shard files are open at once.
+"""
+def mergeShards(outfile, shard_files, headers, order):
+    handles = ShardHandles(shard_files, 'r')
+    fh_out = bgzf.open_output(outfile)
+    header = 0
+    for shard in order:
+        if (shard == HEADER):
+            fh_out.write(headers[header] + '\n')
+            header = header + 1
+        else:
+            fh_out.write(handles.get(shard).readline())
+    fh_out.close()
+    handles.closeAll()
+
+
+"""Annotates infile with one worker process per shard
+workers defaults to the number of cores. Writes <infile>.count.log,
+<infile>.profile.json and the .annot.vcf and returns the output path,
+like pipeline.run. Stage times in the profile are summed over shards.
+"""
+def run(infile, format='vcf', shard_by='chrom', shard_size=50000,
+    workers=None, sep='\t', backend=None, block_size=10000, lines=None,
+    compress=None, index=True):
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    start = time.perf_counter()
+    outfile = pipeline.annotated_name(infile, compress)
+    tmpdir = tempfile.mkdtemp(prefix='shards.',
+        dir=os.path.dirname(os.path.abspath(infile)))
+    try:
+        (files, headers, order) = splitShards(infile, tmpdir,
+            shard_by=shard_by, shard_size=shard_size, sep=sep, lines=lines)
+
+        with ProcessPoolExecutor(max_workers=min(workers, max(len(files), 1))) \
+            as executor:
+            futures = [executor.submit(annotateShard, f, f + '.annot', format,
+                sep, backend, block_size) for f in files]
+            results = [future.result() for future in futures]
+
+        mergeShards(outfile, [f + '.annot' for f in files], headers, order)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if index:
+        pipeline.writeIndex(outfile)
+
+    stages = pipeline.default_stages(format=format)
+    profiler = Profiler(stages, start=start)
+    for (counters, profile) in results:
+        for (stage, stage_counters) in zip(stages, counters):
+            stage.merge(stage_counters)
+        profiler.merge(profile)
+    profiler.finish()
+    pipeline.writeCountLog(infile, stages, profiler)
+    return outfile
+
+### EOF
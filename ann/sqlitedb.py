@@ -0,0 +1,75 @@
+# sqlitedb.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# SQLite stand-in for the reference database
+#
+# Wraps an SQLite file in the parts of the PyMySQL connection interface
+# the annotator uses (cursor, execute with %s parameters, fetch*, ping,
+# close), so the reference backends can run against a local copy of the
+# reference tables, e.g. the synthetic fixtures of benchmark.py. Select
+# it with ANN_REFERENCE_DB=<path> (see utils.py).
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sqlite3
+
+
+class SqliteCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.description = None
+
+    """Runs sql with PyMySQL-style %s placeholders
+    """
+    def execute(self, sql, params=None):
+        self.cursor.execute(sql.replace('%s', '?'),
+            tuple(params) if (params is not None) else ())
+        self.description = self.cursor.description
+        return self.cursor.rowcount
+
+    def executemany(self, sql, seq_of_params):
+        self.cursor.executemany(sql.replace('%s', '?'),
+            [tuple(params) for params in seq_of_params])
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size):
+        return tuple(self.cursor.fetchmany(size))
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+
+class SqliteConnection(object):
+    def __init__(self, path):
+        # Connections are pooled and may be handed to another thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, cursor_class=None):
+        return SqliteCursor(self.conn.cursor())
+
+    def ping(self, reconnect=False):
+        return True
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def connect(path):
+    return SqliteConnection(path)
+
+### EOF
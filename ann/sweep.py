@@ -0,0 +1,155 @@
+# sweep.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Sweep-line overlap lookups for coordinate-sorted inputs
+#
+# Most VCFs are sorted by chromosome and position, so the lookups a stage
+# makes against a table only move forward. SweepReference wraps a
+# reference backend and answers overlapping()/first_overlapping() by
+# sweeping over the intervals of the current chromosome, sorted by start:
+# intervals enter an active heap (keyed by end) once their start is
+# reached and leave it once the lookups have moved past their end. A
+# chromosome costs one fetch of its intervals and O((N + M) log A) work
+# for N lookups, M intervals and at most A simultaneously active ones,
+# instead of one lookup per variant. Backends provide the intervals with
+# intervalRows().
+#
+# Each table keeps the state of one chromosome only. As soon as a lookup
+# moves backwards (the input is not sorted), the wrapper falls back to
+# the wrapped backend for the rest of the run; results are the same
+# either way.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from heapq import heappush, heappop
+
+
+"""Intervals of one table on one chromosome, swept in position order
+rows are in the order the backend returns them, and lookups return
+overlapping rows in that order.
+"""
+class Sweep(object):
+    def __init__(self, chrom, starts, ends, rows):
+        self.chrom = chrom
+        self.order = sorted(range(len(rows)), key=lambda i: starts[i])
+        self.starts = starts
+        self.ends = ends
+        self.rows = rows
+        self.next = 0
+        self.active = []
+        self.last = (None, None)
+
+    """Rows overlapping [start, end], or None if start or end is before
+    that of the previous lookup
+    """
+    def advance(self, start, end):
+        (last_start, last_end) = self.last
+        if (last_start is not None) and ((start < last_start) or
+            (end < last_end)):
+            return None
+        self.last = (start, end)
+
+        order = self.order
+        while (self.next < len(order)) and \
+            (self.starts[order[self.next]] <= end):
+            i = order[self.next]
+            heappush(self.active, (self.ends[i], i))
+            self.next = self.next + 1
+
+        while self.active and (self.active[0][0] < start):
+            (_, i) = heappop(self.active)
+            # Lookups never move back, so the row is not needed any more
+            self.rows[i] = None
+
+        return [self.rows[i] for i in sorted([i for (_, i) in self.active])]
+
+
+"""Reference backend wrapper that answers overlap lookups by sweep
+Every other call (rows_at, intervals, ...) goes to the wrapped
+backend.
+"""
+class SweepReference(object):
+    def __init__(self, reference):
+        self.reference = reference
+        self.sweeps = {}
+        self.sorted = True
+        self.chromosomes_loaded = 0
+        self.lookups = 0
+
+    def __getattr__(self, name):
+        return getattr(self.reference, name)
+
+    def close(self):
+        self.sweeps = {}
+        self.reference.close()
+
+    """Sweep of table on chrom; replaces the sweep of the previous
+    chromosome. Tables split by chromosome (chrom_col=None) share one.
+    """
+    def getSweep(self, table, chrom, columns, chrom_col, start_col, end_col):
+        group = (table if chrom_col is not None else None, columns,
+            chrom_col, start_col, end_col)
+        current = (table, chrom)
+        sweep = self.sweeps.get(group)
+        if (sweep is None) or (sweep.chrom != current):
+            (starts, ends, rows) = self.reference.intervalRows(table, chrom,
+                columns=columns, chrom_col=chrom_col, start_col=start_col,
+                end_col=end_col)
+            sweep = Sweep(current, [int(s) for s in starts],
+                [int(e) for e in ends], list(rows))
+            self.sweeps[group] = sweep
+            self.chromosomes_loaded = self.chromosomes_loaded + 1
+        return sweep
+
+    def sweepOverlapping(self, table, chrom, start, end, columns, chrom_col,
+        start_col, end_col):
+        if not self.sorted:
+            return None
+
+        sweep = self.getSweep(table, chrom, columns, chrom_col, start_col,
+            end_col)
+        rows = sweep.advance(int(start), int(end))
+        if rows is None:
+            print("Input is not sorted by position; " + \
+                "sweep-line lookups disabled.")
+            self.sorted = False
+            self.sweeps = {}
+        else:
+            self.lookups = self.lookups + 1
+        return rows
+
+    def overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        if end is None:
+            end = start
+        rows = self.sweepOverlapping(table, chrom, start, end, columns,
+            chrom_col, start_col, end_col)
+        if rows is None:
+            return self.reference.overlapping(table, chrom, start, end,
+                columns=columns, chrom_col=chrom_col, start_col=start_col,
+                end_col=end_col)
+        return rows
+
+    def first_overlapping(self, table, chrom, start, end=None, columns='*',
+        chrom_col='chrom', start_col='chromStart', end_col='chromEnd'):
+        if end is None:
+            end = start
+        rows = self.sweepOverlapping(table, chrom, start, end, columns,
+            chrom_col, start_col, end_col)
+        if rows is None:
+            return self.reference.first_overlapping(table, chrom, start, end,
+                columns=columns, chrom_col=chrom_col, start_col=start_col,
+                end_col=end_col)
+        return rows[0] if (len(rows) > 0) else None
+
+    def stats(self):
+        return {
+            'sorted': self.sorted,
+            'chromosomes_loaded': self.chromosomes_loaded,
+            'sweep_lookups': self.lookups
+        }
+
+### EOF
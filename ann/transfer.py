@@ -0,0 +1,102 @@
+# transfer.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Fetching annotation job inputs from S3
+#
+# download_input writes the input straight into the job's directory with a
+# multipart transfer (concurrent ranged GETs). stream_lines instead yields
+# the lines of the S3 object while it is still being downloaded, so the
+# annotation pipeline can start on the first block of records before the
+# last one has arrived.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import queue
+import threading
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.client import Config
+
+import bgzf
+
+MB = 1024 * 1024
+
+
+"""Multipart download settings: parts of chunk_size bytes fetched by up
+to max_concurrency threads
+"""
+def transfer_config(max_concurrency=10, chunk_size=16 * MB):
+    return TransferConfig(
+        multipart_threshold=chunk_size,
+        multipart_chunksize=chunk_size,
+        max_concurrency=max_concurrency,
+        use_threads=True)
+
+
+def s3_client(region_name):
+    return boto3.client('s3', region_name=region_name,
+        config=Config(signature_version='s3v4'))
+
+
+"""Downloads s3://bucket/key to <jobs_dir>/<job_id>/<file_name>
+Returns the local path
+"""
+def download_input(bucket, key, jobs_dir, job_id, file_name, region_name,
+    max_concurrency=10, chunk_size=16 * MB):
+    job_dir = os.path.join(jobs_dir, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    path = os.path.join(job_dir, file_name)
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
+    s3_client(region_name).download_file(bucket, key, path,
+        Config=transfer_config(max_concurrency, chunk_size))
+    return path
+
+
+"""Yields the lines of s3://bucket/key as they arrive
+A reader thread keeps up to read_ahead chunks of chunk_size bytes
+buffered, so the download continues while the caller annotates.
+gzip/BGZF objects are decompressed on the fly.
+"""
+def stream_lines(bucket, key, region_name, chunk_size=MB, read_ahead=16,
+    encoding='utf-8'):
+    body = s3_client(region_name).get_object(Bucket=bucket, Key=key)['Body']
+    chunks = queue.Queue(maxsize=read_ahead)
+    done = object()
+    errors = []
+
+    def read():
+        try:
+            while True:
+                chunk = body.read(chunk_size)
+                if not chunk:
+                    break
+                chunks.put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            chunks.put(done)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    pending = b''
+    for chunk in bgzf.iter_decompress(iter(chunks.get, done)):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode(encoding) + '\n'
+
+    reader.join()
+    body.close()
+    if errors:
+        raise errors[0]
+    if pending:
+        yield pending.decode(encoding)
+
+### EOF
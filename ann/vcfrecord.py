@@ -0,0 +1,120 @@
+# vcfrecord.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# VCF record shared by the stages of the fused pipeline
+#
+# A Record keeps the line it was read from and splits it into columns the
+# first time a column is accessed. Annotations appended to INFO are
+# collected in a list and joined into the column only when INFO itself
+# is read or the record is written, so the ~14 stages that extend INFO
+# do not each copy the whole column. Records index like the list of
+# columns they replace (record[7], record[1:] = ...), so helpers shared
+# with the staged pipeline (annotate.addDbSnpFields, ...) work on them
+# unchanged.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+# Column of INFO in a VCF record
+INFO = 7
+
+
+"""One VCF data line
+"""
+class Record(object):
+    __slots__ = ('line', 'sep', 'cols', 'info')
+
+    def __init__(self, line, sep='\t'):
+        self.line = line
+        self.sep = sep
+        self.cols = None
+        self.info = []
+
+    def columns(self):
+        if self.cols is None:
+            self.cols = self.line.split(self.sep)
+            self.line = None
+        return self.cols
+
+    """Joins pending INFO annotations into the INFO column
+    """
+    def flushInfo(self):
+        if self.info:
+            cols = self.columns()
+            cols[INFO] = cols[INFO] + ''.join(self.info)
+            self.info = []
+
+    def touchesInfo(self, i):
+        n = len(self.columns())
+        if isinstance(i, slice):
+            return INFO in range(*i.indices(n))
+        return ((i % n) == INFO) if (n > 0) else False
+
+    def __len__(self):
+        return len(self.columns())
+
+    def __iter__(self):
+        self.flushInfo()
+        return iter(self.columns())
+
+    def __getitem__(self, i):
+        if self.info and self.touchesInfo(i):
+            self.flushInfo()
+        return self.columns()[i]
+
+    def __setitem__(self, i, value):
+        if self.info and self.touchesInfo(i):
+            self.flushInfo()
+        self.columns()[i] = value
+
+    """Appends text to INFO, with a ';' separator unless INFO already
+    ends with one
+    """
+    def appendInfo(self, text):
+        if not self.infoEndsWith(';'):
+            self.info.append(';')
+        self.info.append(text)
+
+    """Appends text to INFO as is
+    """
+    def extendInfo(self, text):
+        self.info.append(text)
+
+    def infoEndsWith(self, suffix):
+        for part in reversed(self.info):
+            if part:
+                return part.endswith(suffix)
+        return str(self.columns()[INFO]).endswith(suffix)
+
+    """Strips trailing whitespace from the last column, as re-reading
+    the record from a file would
+    """
+    def rstrip(self):
+        cols = self.columns()
+        last = len(cols) - 1
+        if (last == INFO):
+            while self.info:
+                part = self.info[-1].rstrip()
+                if part:
+                    self.info[-1] = part
+                    return
+                self.info.pop()
+        cols[last] = cols[last].rstrip()
+
+    """Length of serialize(), without joining the record
+    """
+    def size(self):
+        if self.cols is None:
+            length = len(self.line)
+        else:
+            length = sum(map(len, self.cols)) + \
+                len(self.sep) * (len(self.cols) - 1)
+        return length + sum(map(len, self.info))
+
+    def serialize(self):
+        self.flushInfo()
+        return self.sep.join(self.columns())
+
+### EOF
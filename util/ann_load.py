@@ -5,37 +5,537 @@
 #
 # Exercises the annotator's auto scaling
 #
+#   python ann_load.py --input small.vcf:0.8 --input large.vcf:0.2 \
+#     [--arrival constant|poisson|burst] [--rate R] [--jobs N] \
+#     [--submitters K] [--annotators A] [--slots S] [--output F]
+#
+# Submitter threads fire off annotation jobs the way the web app does:
+# the input is uploaded to S3, a PENDING job item is put in DynamoDB and
+# the job request is published to SNS, which delivers it to the SQS job
+# requests queue. Annotator threads consume the queue with the
+# annotator's own poll loop, JobQueue and JobScheduler (ann/annotator.py,
+# ann/jobqueue.py, ann/scheduler.py), set the job RUNNING when it starts
+# in a worker slot and COMPLETED when its work is done, as run.py does.
+# S3, DynamoDB, SNS and SQS are local stand-ins, so no AWS resources are
+# used.
+#
+# Every status change is timestamped. The report gives the percentiles
+# of the queue-to-RUNNING and RUNNING-to-COMPLETED latencies and the
+# completed jobs per minute; --output writes it, with the timings of
+# every job, as JSON.
+#
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-import uuid
-import time
+import os
 import sys
 import json
-import boto3
-from botocore.exceptions import ClientError
+import math
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+
+# Import the annotator modules
+ANN_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+  os.path.pardir, 'ann')
+sys.path.insert(1, os.path.realpath(ANN_DIR))
+import annotator
+from scheduler import Job, JobScheduler
+from jobqueue import JobQueue, LocalQueue
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+  'ann_load_config.ini'))
+
+PERCENTILES = (50, 90, 95, 99)
 
-# Define constants here; no config file is used for this scipt
-USER_ID = "<UUID_for_your_Globus_Auth_identity>"
-EMAIL = "<CNetID>@uchicago.edu"
 
-"""Fires off annotation jobs with hardcoded data for testing
+"""Local stand-in for S3; objects are files under root/<bucket>/<key>
+Objects are never modified, so they are hard links to the uploaded file
+where the file system allows it
 """
-def load_requests_queue():
+class LocalS3(object):
+  def __init__(self, root):
+    self.root = root
 
-  # Define and persist job data
+  def path(self, bucket, key):
+    return os.path.join(self.root, bucket, key)
 
-  # Send message to request queue
+  def copy(self, source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+      os.link(source, target)
+    except OSError:
+      shutil.copyfile(source, target)
 
-  pass
+  def upload_file(self, Filename, Bucket, Key):
+    self.copy(Filename, self.path(Bucket, Key))
 
-if __name__ == '__main__':
+  def download_file(self, Bucket, Key, Filename):
+    self.copy(self.path(Bucket, Key), Filename)
+
+
+"""Local stand-in for the DynamoDB annotations table
+Records the time of every job status change.
+"""
+class LocalTable(object):
+  def __init__(self, name):
+    self.name = name
+    self.items = {}
+    self.history = {}
+    self.lock = threading.Lock()
+
+  def put_item(self, Item):
+    with self.lock:
+      self.items[Item['job_id']] = dict(Item)
+      self.history[Item['job_id']] = {Item['job_status']: time.time()}
+
+  def get_item(self, Key):
+    with self.lock:
+      item = self.items.get(Key['job_id'])
+      return {'Item': dict(item)} if (item is not None) else {}
+
+  """Sets the status of a job if it is expected; like a conditional
+  update_item, fails if the job has another status
+  """
+  def update_status(self, job_id, status, expected):
+    with self.lock:
+      item = self.items[job_id]
+      if (item['job_status'] != expected):
+        raise RuntimeError(f"Job {job_id} is {item['job_status']}, " + \
+          f"not {expected}")
+      item['job_status'] = status
+      self.history[job_id][status] = time.time()
+
+  def count(self, status):
+    with self.lock:
+      return len([item for item in self.items.values()
+        if (item['job_status'] == status)])
+
+
+"""Local stand-in for SNS; publishes to the subscribed queues with the
+envelope SNS puts around messages delivered to SQS
+"""
+class LocalTopic(object):
+  def __init__(self, topic_arn):
+    self.topic_arn = topic_arn
+    self.queues = []
+
+  def subscribe(self, queue):
+    self.queues.append(queue)
+
+  def publish(self, TopicArn, Message, MessageStructure=None):
+    if (MessageStructure == 'json'):
+      Message = json.loads(Message)['default']
+    message_id = str(uuid.uuid4())
+    body = json.dumps({
+      'Type': 'Notification',
+      'MessageId': message_id,
+      'TopicArn': TopicArn,
+      'Message': Message,
+      'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    })
+    for queue in self.queues:
+      queue.send_message(MessageBody=body)
+    return {'MessageId': message_id}
+
+
+"""Gaps in seconds between job arrivals, averaging rate jobs per second
+"""
+def arrival_gaps(arrival, rate, burst_size, rng):
   while True:
+    if (arrival == 'constant'):
+      yield 1.0 / rate
+    elif (arrival == 'poisson'):
+      yield rng.expovariate(rate)
+    elif (arrival == 'burst'):
+      for i in range(burst_size - 1):
+        yield 0.0
+      yield burst_size / rate
+    else:
+      raise ValueError(f"Unknown arrival model: {arrival}")
+
+
+"""An input file and the fraction of jobs that submit it
+"""
+class Input(object):
+  def __init__(self, spec):
+    (path, sep, weight) = spec.rpartition(':')
+    if not sep or not weight.replace('.', '', 1).isdigit():
+      (path, weight) = (spec, '1')
+    self.path = os.path.abspath(path)
+    self.file_name = os.path.basename(path)
+    self.weight = float(weight)
+    self.size = os.path.getsize(self.path)
+    with open(self.path) as fh:
+      self.records = len([line for line in fh if not line.startswith('#')])
+
+
+"""Fires off annotation jobs like the web app: upload the input, persist
+the PENDING job item and publish the job request
+"""
+class Submitter(object):
+  def __init__(self, args, inputs, s3, table, sns):
+    self.args = args
+    self.inputs = inputs
+    self.s3 = s3
+    self.table = table
+    self.sns = sns
+    self.submitted = 0
+    self.lock = threading.Lock()
+
+  def submit(self, source):
+    job_id = str(uuid.uuid4())
+    s3_key = config['s3']['AwsS3KeyPrefix'] + self.args.user_id + '/' + \
+      job_id + '~' + source.file_name
+
+    # Define and persist job data
+    self.s3.upload_file(source.path, config['s3']['AwsS3InputsBucket'],
+      s3_key)
+    data = {"job_id": job_id,
+            "user_id": self.args.user_id,
+            "input_file_name": source.file_name,
+            "s3_inputs_bucket": config['s3']['AwsS3InputsBucket'],
+            "s3_key_input_file": s3_key,
+            "submit_time": int(time.time()),
+            "job_status": "PENDING",
+            "archived": False
+           }
+    self.table.put_item(Item=data)
+
+    # Send message to request queue
+    data['email'] = self.args.email
+    self.sns.publish(TopicArn=config['sns']['AwsSNSJobRequestTopic'],
+      Message=json.dumps({'default': json.dumps(data)}),
+      MessageStructure='json')
+    with self.lock:
+      self.submitted += 1
+
+  """Submits jobs jobs at the configured arrival rate divided among
+  the submitters; arrivals are scheduled from the start time so slow
+  submissions do not lower the rate
+  """
+  def run(self, index, jobs):
+    rng = random.Random(self.args.seed * 1000 + index)
+    weights = [source.weight for source in self.inputs]
+    gaps = arrival_gaps(self.args.arrival,
+      self.args.rate / self.args.submitters, self.args.burst_size, rng)
+    next_at = time.time()
+    for i in range(jobs):
+      next_at += next(gaps)
+      delay = next_at - time.time()
+      if (delay > 0):
+        time.sleep(delay)
+      self.submit(rng.choices(self.inputs, weights)[0])
+
+
+"""The work of a job, run in a thread once the job is RUNNING; has the
+poll() and returncode of the run.py process it stands in for. Like
+run.py, sets the job COMPLETED as soon as the work is done.
+"""
+class LocalProcess(object):
+  def __init__(self, table, job_id, work):
+    self.table = table
+    self.job_id = job_id
+    self.work = work
+    self.thread = None
+    self.returncode = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    try:
+      returncode = self.work()
+    except Exception as e:
+      print(f"Job {self.job_id} failed: {e}", file=sys.stderr)
+      returncode = 1
+    self.table.update_status(self.job_id,
+      'COMPLETED' if (returncode == 0) else 'FAILED', 'RUNNING')
+    self.returncode = returncode
+
+  def poll(self):
+    return self.returncode
+
+
+"""An annotator instance: the poll loop of ann/annotator.py over the job
+requests queue, with its own worker slots
+"""
+class Annotator(object):
+  def __init__(self, index, args, queue, s3, table, inputs, jobs_dir):
+    self.index = index
+    self.args = args
+    self.s3 = s3
+    self.table = table
+    self.records = dict([(source.file_name, source.records)
+      for source in inputs])
+    self.jobs_dir = jobs_dir
+    self.requests = JobQueue(queue,
+      max_messages=args.max_messages,
+      wait_time=args.wait_time,
+      visibility_timeout=args.visibility_timeout)
+    self.scheduler = JobScheduler(slots=args.slots,
+      max_pending=args.max_pending, launch=self.launch)
+    self.stopped = threading.Event()
+
+  def work(self, target_path, file_name):
+    if (self.args.work == 'annotate'):
+      return subprocess.call([sys.executable, '-c',
+        f"import driver; driver.run({target_path!r}, 'vcf')"],
+        cwd=ANN_DIR, stdout=subprocess.DEVNULL)
+    time.sleep(self.args.startup_seconds +
+      self.records[file_name] / self.args.records_per_second)
+    return 0
+
+  def launch(self, args):
+    (target_path, file_name, job_id) = args
+    process = LocalProcess(self.table, job_id,
+      lambda: self.work(target_path, file_name))
+    process.start()
+    return process
+
+  def start_job(self, job):
     try:
-      load_requests_queue()
-      time.sleep(3)
-    except ClientError as e:
-      print("Irrecoverable error. Exiting.")
-      sys.exit()
+      self.table.update_status(job.job_id, 'RUNNING', 'PENDING')
+    except RuntimeError as e:
+      print(f"Skipping duplicate: {e}", file=sys.stderr)
+      return False
+    return True
+
+  def finish_job(self, job):
+    self.requests.done(job.message)
+
+  def submit_job(self, message):
+    mbody = json.loads(json.loads(message.body)["Message"])
+    job_id = mbody["job_id"]
+    file_name = mbody["input_file_name"]
+    target_path = os.path.join(self.jobs_dir, f"{self.index}", job_id,
+      file_name)
+    self.s3.download_file(mbody["s3_inputs_bucket"],
+      mbody["s3_key_input_file"], target_path)
+    self.scheduler.submit(Job(job_id, [target_path, file_name, job_id],
+      message=message, on_start=self.start_job, on_finish=self.finish_job))
+
+  def run(self):
+    annotator.startScheduler(self.requests, self.scheduler)
+    while not self.stopped.is_set():
+      annotator.poll(self.requests, self.scheduler, self.submit_job,
+        max_polls=1)
+
+  def stop(self):
+    self.stopped.set()
+
+
+"""Nearest-rank percentile of sorted values
+"""
+def percentile(values, p):
+  if not values:
+    return None
+  return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def summarize(values):
+  values = sorted(values)
+  summary = dict([(f"p{p}", percentile(values, p)) for p in PERCENTILES])
+  summary['max'] = values[-1] if values else None
+  summary['mean'] = (sum(values) / len(values)) if values else None
+  summary['count'] = len(values)
+  return dict([(name, round(value, 3) if isinstance(value, float) else value)
+    for (name, value) in summary.items()])
+
+
+"""Per-job timings from the status history of the annotations table
+"""
+def job_timings(table):
+  timings = []
+  with table.lock:
+    for (job_id, history) in table.history.items():
+      pending = history['PENDING']
+      running = history.get('RUNNING')
+      completed = history.get('COMPLETED')
+      timings.append({
+        'job_id': job_id,
+        'input_file_name': table.items[job_id]['input_file_name'],
+        'job_status': table.items[job_id]['job_status'],
+        'submitted': pending,
+        'queue_to_running': (running - pending)
+          if (running is not None) else None,
+        'running_to_completed': (completed - running)
+          if (completed is not None) else None,
+        'submit_to_completed': (completed - pending)
+          if (completed is not None) else None
+      })
+  return sorted(timings, key=lambda timing: timing['submitted'])
+
+
+def report(args, timings, started, annotators):
+  completed = [t for t in timings if (t['job_status'] == 'COMPLETED')]
+  finished = [t['submitted'] + t['submit_to_completed'] for t in completed]
+  elapsed = (max(finished) - started) if finished else 0.0
+  latencies = {}
+  for name in ('queue_to_running', 'running_to_completed',
+    'submit_to_completed'):
+    latencies[name] = summarize([t[name] for t in timings
+      if (t[name] is not None)])
+
+  by_input = {}
+  for name in sorted(set([t['input_file_name'] for t in timings])):
+    by_input[name] = summarize([t['running_to_completed'] for t in completed
+      if (t['input_file_name'] == name)])
+
+  return {
+    'arrival': args.arrival,
+    'rate': args.rate,
+    'submitters': args.submitters,
+    'annotators': args.annotators,
+    'slots': args.slots,
+    'work': args.work,
+    'jobs_submitted': len(timings),
+    'jobs_completed': len(completed),
+    'jobs_failed': len([t for t in timings if (t['job_status'] == 'FAILED')]),
+    'seconds': round(elapsed, 3),
+    'jobs_per_minute': round(len(completed) / elapsed * 60, 2)
+      if (elapsed > 0) else 0.0,
+    'latency': latencies,
+    'running_to_completed_by_input': by_input,
+    'annotator_utilisation': [a.scheduler.metrics()['utilisation']
+      for a in annotators],
+    'queue': [a.requests.stats() for a in annotators]
+  }
+
+
+def print_report(summary):
+  print(f"{summary['jobs_completed']} of {summary['jobs_submitted']} jobs " + \
+    f"completed ({summary['jobs_failed']} failed) in " + \
+    f"{summary['seconds']} s: {summary['jobs_per_minute']} jobs/min")
+  print(f"{'seconds':28}" + ''.join([f"{name:>9}" for name in
+    [f"p{p}" for p in PERCENTILES] + ['max', 'mean']]))
+  rows = [("queue -> RUNNING", summary['latency']['queue_to_running']),
+    ("RUNNING -> COMPLETED", summary['latency']['running_to_completed']),
+    ("submit -> COMPLETED", summary['latency']['submit_to_completed'])] + \
+    [(f"  {name}", latency) for (name, latency)
+      in summary['running_to_completed_by_input'].items()]
+  for (name, latency) in rows:
+    print(f"{name:28}" + ''.join([f"{str(latency[column]):>9}" for column in
+      [f"p{p}" for p in PERCENTILES] + ['max', 'mean']]))
+  print(f"Annotator slot utilisation: {summary['annotator_utilisation']}")
+
+
+"""Runs the load test and returns its report
+"""
+def load_requests_queue(args):
+  inputs = [Input(spec) for spec in args.input]
+  workdir = tempfile.mkdtemp(prefix='ann_load.')
+  s3 = LocalS3(os.path.join(workdir, 's3'))
+  table = LocalTable(config['dydb']['AwsDynamoDBAnnotationsName'])
+  sns = LocalTopic(config['sns']['AwsSNSJobRequestTopic'])
+  queue = LocalQueue(visibility_timeout=args.visibility_timeout)
+  sns.subscribe(queue)
+
+  annotators = [Annotator(i, args, queue, s3, table, inputs,
+    os.path.join(workdir, 'jobs')) for i in range(args.annotators)]
+  submitter = Submitter(args, inputs, s3, table, sns)
+  submitters = [threading.Thread(target=submitter.run,
+    args=(i, args.jobs // args.submitters +
+      (1 if (i < args.jobs % args.submitters) else 0)), daemon=True)
+    for i in range(args.submitters)]
+
+  # The annotators print every receive; keep the output for the report
+  output = sys.stdout if args.verbose else open(os.devnull, 'w')
+  started = time.time()
+  try:
+    with contextlib.redirect_stdout(output):
+      for a in annotators:
+        threading.Thread(target=a.run, daemon=True).start()
+      for thread in submitters:
+        thread.start()
+
+      deadline = None
+      while True:
+        time.sleep(1)
+        done = table.count('COMPLETED') + table.count('FAILED')
+        print(f"submitted {submitter.submitted}, " + \
+          f"running {table.count('RUNNING')}, done {done}",
+          file=sys.stderr)
+        if (submitter.submitted == args.jobs):
+          if (done == args.jobs):
+            break
+          deadline = deadline or (time.time() + args.timeout)
+          if (time.time() > deadline):
+            print(f"Timed out waiting for {args.jobs - done} jobs.",
+              file=sys.stderr)
+            break
+      for a in annotators:
+        a.stop()
+    timings = job_timings(table)
+    return (report(args, timings, started, annotators), timings)
+  finally:
+    if not args.verbose:
+      output.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(prog='ann_load.py',
+    description='Load generator for the annotator')
+  parser.add_argument('--input', action='append', required=True,
+    help='input VCF, optionally with a weight (path:weight); repeat for ' + \
+      'a mix of input sizes')
+  parser.add_argument('--arrival', choices=['constant', 'poisson', 'burst'],
+    default=config['load']['Arrival'])
+  parser.add_argument('--rate', type=float,
+    default=config.getfloat('load', 'Rate'), help='jobs per second')
+  parser.add_argument('--burst-size', type=int,
+    default=config.getint('load', 'BurstSize'))
+  parser.add_argument('--jobs', type=int, default=config.getint('load', 'Jobs'))
+  parser.add_argument('--submitters', type=int,
+    default=config.getint('load', 'Submitters'))
+  parser.add_argument('--seed', type=int, default=config.getint('load', 'Seed'))
+  parser.add_argument('--timeout', type=float,
+    default=config.getfloat('load', 'Timeout'))
+  parser.add_argument('--annotators', type=int,
+    default=config.getint('ann', 'Annotators'))
+  parser.add_argument('--slots', type=int,
+    default=config.getint('ann', 'WorkerSlots'))
+  parser.add_argument('--max-pending', type=int,
+    default=config.getint('ann', 'MaxPendingJobs'))
+  parser.add_argument('--work', choices=['simulated', 'annotate'],
+    default=config['ann']['Work'])
+  parser.add_argument('--startup-seconds', type=float,
+    default=config.getfloat('ann', 'StartupSeconds'))
+  parser.add_argument('--records-per-second', type=float,
+    default=config.getfloat('ann', 'RecordsPerSecond'))
+  parser.add_argument('--wait-time', type=int,
+    default=config.getint('sqs', 'AwsSQSWaitTime'))
+  parser.add_argument('--max-messages', type=int,
+    default=config.getint('sqs', 'AwsSQSMaxMessages'))
+  parser.add_argument('--visibility-timeout', type=int,
+    default=config.getint('sqs', 'AwsSQSVisibilityTimeout'))
+  parser.add_argument('--user-id', default=config['gas']['UserId'])
+  parser.add_argument('--email', default=config['gas']['Email'])
+  parser.add_argument('--output', default=None,
+    help='write the report and job timings to this JSON file')
+  parser.add_argument('--verbose', action='store_true',
+    help='show the annotator output')
+  return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+  args = parse_args(sys.argv[1:])
+  (summary, timings) = load_requests_queue(args)
+  print_report(summary)
+  if args.output is not None:
+    with open(args.output, 'w') as fh:
+      json.dump({'report': summary, 'jobs': timings}, fh, indent=2)
+      fh.write('\n')
 
-### EOF
\ No newline at end of file
+### EOF
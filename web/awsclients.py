@@ -0,0 +1,153 @@
+# awsclients.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Long-lived boto3 clients and resources for the web app
+#
+# Creating a boto3 client loads the botocore service model and sets up a
+# new connection pool, so clients are created once per worker process and
+# reused by every request handler. All of them share one botocore Config:
+# a connection pool of AWS_CLIENT_MAX_POOL_CONNECTIONS, TCP keep-alive,
+# connect/read timeouts and AWS_CLIENT_MAX_ATTEMPTS retries in
+# AWS_CLIENT_RETRY_MODE. Clients are thread-safe and shared by all
+# threads; boto3 resources are not, so each thread gets its own. A worker
+# forked after the registry was used starts over with new clients.
+#
+# stats() reports the clients and resources created and reused, and per
+# service the requests sent and the HTTPS connections opened for them.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import threading
+
+import boto3
+from botocore.client import Config
+
+# Options of individual services, merged into the shared Config
+SERVICE_CONFIG = {
+  # Presigned S3 POSTs and URLs need Signature Version 4
+  's3': Config(signature_version='s3v4')
+}
+
+
+"""boto3 clients and resources, created on first use and then reused
+"""
+class ClientRegistry(object):
+  def __init__(self, region_name, max_pool_connections=10,
+    connect_timeout=60, read_timeout=60, max_attempts=3,
+    retry_mode='standard'):
+    self.region_name = region_name
+    self.config = Config(
+      max_pool_connections=max_pool_connections,
+      connect_timeout=connect_timeout,
+      read_timeout=read_timeout,
+      retries={'max_attempts': max_attempts, 'mode': retry_mode},
+      tcp_keepalive=True)
+    self.lock = threading.Lock()
+    self.requests_lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.pid = os.getpid()
+    # Sessions are not thread-safe; clients are only created under lock
+    self.session = boto3.session.Session()
+    self.clients = {}
+    self.local = threading.local()
+    self.resource_clients = []
+    self.clients_created = 0
+    self.clients_reused = 0
+    self.resources_created = 0
+    self.resources_reused = 0
+    self.requests = {}
+
+  def service_config(self, service_name):
+    if service_name in SERVICE_CONFIG:
+      return self.config.merge(SERVICE_CONFIG[service_name])
+    return self.config
+
+  def check_fork(self):
+    if (os.getpid() != self.pid):
+      self.reset()
+
+  """Counts the requests a client sends
+  """
+  def count_requests(self, service_name, client):
+    def count(**kwargs):
+      with self.requests_lock:
+        self.requests[service_name] = self.requests.get(service_name, 0) + 1
+    client.meta.events.register('before-send', count)
+
+  def client(self, service_name):
+    with self.lock:
+      self.check_fork()
+      client = self.clients.get(service_name)
+      if client is not None:
+        self.clients_reused += 1
+        return client
+      client = self.session.client(service_name,
+        region_name=self.region_name,
+        config=self.service_config(service_name))
+      self.count_requests(service_name, client)
+      self.clients[service_name] = client
+      self.clients_created += 1
+      return client
+
+  """The calling thread's resource for service_name
+  """
+  def resource(self, service_name):
+    with self.lock:
+      self.check_fork()
+      resources = getattr(self.local, 'resources', None)
+      if resources is None:
+        resources = self.local.resources = {}
+      resource = resources.get(service_name)
+      if resource is not None:
+        self.resources_reused += 1
+        return resource
+      resource = self.session.resource(service_name,
+        region_name=self.region_name,
+        config=self.service_config(service_name))
+      self.count_requests(service_name, resource.meta.client)
+      resources[service_name] = resource
+      self.resource_clients.append((service_name, resource.meta.client))
+      self.resources_created += 1
+      return resource
+
+  def stats(self):
+    with self.requests_lock:
+      requests = dict(self.requests)
+    with self.lock:
+      clients = list(self.clients.items()) + list(self.resource_clients)
+      services = {}
+      for (service_name, client) in clients:
+        service = services.setdefault(service_name,
+          {'requests': requests.get(service_name, 0), 'connections': 0})
+        service['connections'] += connections_opened(client)
+      for service in services.values():
+        service['connections_reused'] = \
+          max(0, service['requests'] - service['connections'])
+
+      return {
+        'pid': self.pid,
+        'clients_created': self.clients_created,
+        'clients_reused': self.clients_reused,
+        'resources_created': self.resources_created,
+        'resources_reused': self.resources_reused,
+        'services': services
+      }
+
+
+"""HTTPS connections a client has opened so far, from the urllib3 pools
+of its botocore HTTP session (0 if they cannot be inspected)
+"""
+def connections_opened(client):
+  try:
+    pools = client._endpoint.http_session._manager.pools
+    return sum([pools[key].num_connections for key in pools.keys()])
+  except Exception:
+    return 0
+
+### EOF
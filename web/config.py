@@ -107,6 +107,23 @@ class Config(object):
   # Set validity of pre-signed POST requests (in seconds)
   AWS_SIGNED_REQUEST_EXPIRATION = 60
 
+  # boto3 clients shared by the request handlers of a worker process (see
+  # awsclients.py): connections kept open per client, timeouts in
+  # seconds and retries of throttled or failed calls
+  AWS_CLIENT_MAX_POOL_CONNECTIONS = 50
+  AWS_CLIENT_CONNECT_TIMEOUT = 5
+  AWS_CLIENT_READ_TIMEOUT = 30
+  AWS_CLIENT_MAX_ATTEMPTS = 5
+  AWS_CLIENT_RETRY_MODE = "standard"
+
+  # Annotation logs are read from S3 in chunks of GAS_LOG_CHUNK_SIZE bytes;
+  # the log page shows the last GAS_LOG_TAIL_BYTES, and logs of up to
+  # GAS_LOG_CACHE_MAX_BYTES are cached (GAS_LOG_CACHE_ENTRIES per worker)
+  GAS_LOG_CHUNK_SIZE = 64 * 1024
+  GAS_LOG_TAIL_BYTES = 64 * 1024
+  GAS_LOG_CACHE_MAX_BYTES = 256 * 1024
+  GAS_LOG_CACHE_ENTRIES = 64
+
   # AWS S3 upload parameters
   AWS_S3_INPUTS_BUCKET = "gas-inputs"
   AWS_S3_RESULTS_BUCKET = "gas-results"
@@ -122,6 +139,9 @@ class Config(object):
   AWS_SNS_JOB_REQUEST_TOPIC = \
     f"arn:aws:sns:us-east-1:127134666975:{iam_username}_a16_job_requests"
 
+  AWS_SNS_JOB_RESULTS_TOPIC = \
+    f"arn:aws:sns:us-east-1:127134666975:{iam_username}_a16_job_results"
+
   AWS_SNS_THAW_TOPIC = \
     f"arn:aws:sns:us-east-1:127134666975:{iam_username}_a16_thaw_jobs"
 
@@ -130,6 +150,26 @@ class Config(object):
 
   # AWS DynamoDB table
   AWS_DYNAMODB_ANNOTATIONS_TABLE = f"{iam_username}_annotations"
+  # Global secondary index of the annotations table on user_id (also used
+  # by util/thaw)
+  AWS_DYNAMODB_USER_ID_INDEX = "uder_id_index"
+
+  # Jobs on the first page of the annotations list, and per page loaded
+  # as the user scrolls
+  GAS_ANNOTATIONS_FIRST_PAGE_SIZE = 20
+  GAS_ANNOTATIONS_PAGE_SIZE = 50
+
+  # Results of identical inputs are reused: content hash (SHA-256 of the
+  # input and the reference version) -> result and log keys
+  GAS_RESULTS_DEDUP = True
+  GAS_REFERENCE_VERSION = os.environ['ANN_REFERENCE_VERSION'] \
+    if ('ANN_REFERENCE_VERSION' in os.environ) else '1'
+  AWS_DYNAMODB_RESULTS_INDEX_TABLE = f"{iam_username}_results_index"
+
+  # Step function that archives free user results after
+  # FREE_USER_DATA_RETENTION
+  AWS_SFN_ARCHIVE_STATE_MACHINE = \
+    f"arn:aws:states:us-east-1:127134666975:stateMachine:{iam_username}_a16_archive"
 
   # Use this email address to send email via SES
   MAIL_DEFAULT_SENDER = f"{iam_username}@ucmpcs.org"
@@ -0,0 +1,93 @@
+# dedup.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Content-addressed annotation results
+#
+# An uploaded input is identified by the SHA-256 of its bytes and the
+# version of the reference data it is annotated against (content hash).
+# The SHA-256 is computed by S3 while the input is uploaded (the upload
+# form asks for x-amz-checksum-algorithm SHA256) and read back with a
+# HEAD request, so the input is never downloaded to be hashed. The
+# annotator records the result, log and sidecar keys (tabix index, stage
+# profile) of every completed job under its content hash in the results
+# index table; a later upload with the same content hash completes
+# immediately with a server-side copy of those objects instead of a new
+# annotation job.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import base64
+
+from botocore.exceptions import ClientError
+
+# Checksum S3 computes for uploads, set as a field of the upload form
+CHECKSUM_ALGORITHM = 'SHA256'
+
+
+"""Content hash of an uploaded object: the SHA-256 S3 stored for it at
+upload time, combined with the reference version; None if the object
+has no full-object SHA-256 checksum (e.g. it was uploaded without one)
+"""
+def content_hash(s3, bucket, key, reference_version):
+  response = s3.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+  checksum = response.get('ChecksumSHA256')
+  # Checksums of multipart uploads are of the parts (<checksum>-<parts>)
+  if not checksum or ('-' in checksum):
+    return None
+  return f"{base64.b64decode(checksum).hex()}:{reference_version}"
+
+
+"""The results index entry for a content hash, or None
+"""
+def find_result(index_table, content_hash):
+  response = index_table.get_item(Key={'content_hash': content_hash})
+  return response.get('Item')
+
+
+"""Key of a copy of source_key for another job
+Keys are <prefix>/<job_id>~<file name>
+"""
+def copy_key(source_key, key_prefix, job_id):
+  return f"{key_prefix}/{job_id}~{source_key.split('~', 1)[1]}"
+
+
+"""Copies the result, log and sidecars of an index entry to the keys of a
+new job
+Copies are done by S3 (multipart for large objects); returns the new
+(result key, log key), or None if the indexed result or log no longer
+exist (e.g. they were archived), in which case the entry is removed.
+Sidecars (s3_sidecar_keys: the tabix index and stage profile of the
+result) are copied if they still exist; entries written before sidecars
+were indexed get the result's .tbi, if there is one.
+"""
+def copy_result(s3, index_table, entry, key_prefix, job_id):
+  bucket = entry['s3_results_bucket']
+  keys = []
+  try:
+    for source_key in (entry['s3_key_result_file'], entry['s3_key_log_file']):
+      target_key = copy_key(source_key, key_prefix, job_id)
+      s3.copy({'Bucket': bucket, 'Key': source_key}, bucket, target_key)
+      keys.append(target_key)
+  except ClientError as e:
+    if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+      raise
+    for key in keys:
+      s3.delete_object(Bucket=bucket, Key=key)
+    index_table.delete_item(Key={'content_hash': entry['content_hash']})
+    return None
+
+  sidecars = entry.get('s3_sidecar_keys',
+    [entry['s3_key_result_file'] + '.tbi'])
+  for source_key in sidecars:
+    try:
+      s3.copy({'Bucket': bucket, 'Key': source_key}, bucket,
+        copy_key(source_key, key_prefix, job_id))
+    except ClientError as e:
+      if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+        raise
+  return tuple(keys)
+
+### EOF
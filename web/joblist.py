@@ -0,0 +1,132 @@
+# joblist.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Paginated listing of a user's annotation jobs
+#
+# Jobs are read from the annotations table through its user_id global
+# secondary index: one Query per page instead of an S3 listing of the
+# user's inputs plus one Query per input. Filters on job status and
+# submit date are applied by DynamoDB (FilterExpression), so only
+# matching items are returned. A page ends where DynamoDB stopped reading
+# (LastEvaluatedKey); that key is handed out as an opaque cursor and
+# passed back as ExclusiveStartKey to read the next page.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import time
+import base64
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+from boto3.dynamodb.conditions import Key, Attr
+
+JOB_STATUSES = ['PENDING', 'RUNNING', 'COMPLETED']
+
+# Format of the since/until dates of the filters
+DATE_FORMAT = '%Y-%m-%d'
+
+
+"""Encodes a LastEvaluatedKey as a URL-safe cursor
+"""
+def encode_cursor(key):
+  if key is None:
+    return None
+  key = dict([(name, int(value) if isinstance(value, Decimal) else value)
+    for (name, value) in key.items()])
+  return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+"""Decodes a cursor back into an ExclusiveStartKey; raises ValueError if
+the cursor is not one handed out for this user
+"""
+def decode_cursor(cursor, user_id):
+  try:
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+  except Exception:
+    raise ValueError(f"Invalid cursor: {cursor}")
+  if not isinstance(key, dict) or (key.get('user_id') != user_id):
+    raise ValueError(f"Invalid cursor: {cursor}")
+  return key
+
+
+"""Seconds since the epoch at local midnight of a YYYY-MM-DD date, or None
+for an empty date; raises ValueError for anything else
+"""
+def parse_date(date):
+  if not date:
+    return None
+  return int(time.mktime(datetime.strptime(date, DATE_FORMAT).timetuple()))
+
+
+"""FilterExpression for a status and a range of submit dates (both
+inclusive), or None
+"""
+def filter_expression(status=None, since=None, until=None):
+  conditions = []
+  if status:
+    if status not in JOB_STATUSES:
+      raise ValueError(f"Unknown job status: {status}")
+    conditions.append(Attr('job_status').eq(status))
+  if since is not None:
+    conditions.append(Attr('submit_time').gte(since))
+  if until is not None:
+    # Up to the end of the until date
+    end = int(time.mktime((datetime.fromtimestamp(until) +
+      timedelta(days=1)).timetuple()))
+    conditions.append(Attr('submit_time').lt(end))
+
+  expression = None
+  for condition in conditions:
+    expression = condition if expression is None else (expression & condition)
+  return expression
+
+
+"""Reads one page of at most page_size jobs of a user
+Returns the jobs and the cursor of the next page (None after the last
+page). DynamoDB applies Limit before the filter, so a page that the
+filter thins out is topped up with further queries from where the last
+one stopped; the jobs past page_size are left for the next page.
+"""
+def list_jobs(table, index_name, user_id, page_size=50, cursor=None,
+  status=None, since=None, until=None):
+  query = {
+    'IndexName': index_name,
+    'KeyConditionExpression': Key('user_id').eq(user_id),
+    # Newest first when the index is sorted by submit time
+    'ScanIndexForward': False,
+    'Limit': page_size
+  }
+  expression = filter_expression(status, since, until)
+  if expression is not None:
+    query['FilterExpression'] = expression
+  start_key = decode_cursor(cursor, user_id) if cursor else None
+
+  items = []
+  while True:
+    if start_key is not None:
+      query['ExclusiveStartKey'] = start_key
+    response = table.query(**query)
+    items.extend(response.get('Items', []))
+    if (len(items) > page_size):
+      # Continue after the last job of this page; a key holds the same
+      # attributes in every response
+      items = items[:page_size]
+      start_key = dict([(name, items[-1][name]) for name in start_key])
+      break
+    start_key = response.get('LastEvaluatedKey')
+    if (start_key is None) or (len(items) == page_size):
+      break
+  return (items, encode_cursor(start_key))
+
+
+"""Submit time of a job as YYYY-MM-DD HH:MM, local time
+"""
+def request_time(item):
+  return time.strftime('%Y-%m-%d %H:%M',
+    time.localtime(float(item['submit_time'])))
+
+### EOF
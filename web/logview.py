@@ -0,0 +1,130 @@
+# logview.py
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+#
+# Reads annotation logs from S3 in bounded pieces
+#
+# A log is never read into memory whole unless it is small: large logs
+# are streamed in chunks of a ranged GET, and a byte range (HTTP Range)
+# or the tail of a log only fetches those bytes from S3. Logs of up to
+# GAS_LOG_CACHE_MAX_BYTES are read once and kept in a small LRU cache
+# keyed by their ETag, so a log that is viewed again (or replaced) is
+# served correctly without another GET.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import threading
+from collections import OrderedDict
+
+
+"""LRU cache of small logs, keyed by bucket, key and ETag
+"""
+class LogCache(object):
+  def __init__(self, entries=64, max_bytes=256 * 1024):
+    self.entries = entries
+    self.max_bytes = max_bytes
+    self.logs = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def cacheable(self, size):
+    return (self.entries > 0) and (size <= self.max_bytes)
+
+  def get(self, bucket, key, etag):
+    with self.lock:
+      body = self.logs.get((bucket, key, etag))
+      if body is None:
+        self.misses += 1
+        return None
+      self.logs.move_to_end((bucket, key, etag))
+      self.hits += 1
+      return body
+
+  def put(self, bucket, key, etag, body):
+    with self.lock:
+      self.logs[(bucket, key, etag)] = body
+      self.logs.move_to_end((bucket, key, etag))
+      while (len(self.logs) > self.entries):
+        self.logs.popitem(last=False)
+
+  def stats(self):
+    with self.lock:
+      return {'entries': len(self.logs), 'hits': self.hits,
+        'misses': self.misses}
+
+
+"""Size and ETag of a log object
+"""
+def log_info(s3, bucket, key):
+  response = s3.head_object(Bucket=bucket, Key=key)
+  return (response['ContentLength'], response['ETag'])
+
+
+"""(start, end) of the bytes an HTTP Range header asks for, or None for
+the whole log (no header, or one that is not a single byte range)
+Raises ValueError if the range is outside a log of size bytes.
+"""
+def parse_range(header, size):
+  if not header:
+    return None
+  (unit, sep, spec) = header.partition('=')
+  if (unit.strip() != 'bytes') or not sep or (',' in spec):
+    return None
+  (first, sep, last) = spec.strip().partition('-')
+  if not sep or not (first.isdigit() or (first == '')) or \
+    not (last.isdigit() or (last == '')) or (first == last == ''):
+    return None
+
+  if (first == ''):
+    # Suffix range: the last bytes of the log
+    if (int(last) == 0):
+      raise ValueError(f"Unsatisfiable range: {header}")
+    (start, end) = (max(0, size - int(last)), size - 1)
+  else:
+    if last and (int(last) < int(first)):
+      return None
+    start = int(first)
+    end = min(int(last), size - 1) if last else (size - 1)
+  if (start >= size) or (end < start):
+    raise ValueError(f"Unsatisfiable range: {header}")
+  return (start, end)
+
+
+"""(start, end) of the last tail_bytes of a log of size bytes
+"""
+def tail_range(tail_bytes, size):
+  return (max(0, size - tail_bytes), size - 1)
+
+
+"""Bytes start to end (inclusive) of an object, in chunks of a ranged GET
+"""
+def stream_range(s3, bucket, key, start, end, chunk_size=64 * 1024):
+  body = s3.get_object(Bucket=bucket, Key=key,
+    Range=f"bytes={start}-{end}")['Body']
+  try:
+    for chunk in body.iter_chunks(chunk_size):
+      yield chunk
+  finally:
+    body.close()
+
+
+"""Bytes start to end (inclusive) of a log of size bytes with the given
+ETag, as an iterable of chunks; small logs come from the cache
+"""
+def read_log(s3, cache, bucket, key, size, etag, start, end,
+  chunk_size=64 * 1024):
+  if (size == 0) or (start > end):
+    return []
+  if not cache.cacheable(size):
+    return stream_range(s3, bucket, key, start, end, chunk_size)
+
+  body = cache.get(bucket, key, etag)
+  if body is None:
+    body = b''.join(stream_range(s3, bucket, key, 0, size - 1, chunk_size))
+    cache.put(bucket, key, etag, body)
+  return [body[start:end + 1]]
+
+### EOF
@@ -13,17 +13,33 @@ import time
 import json
 from datetime import datetime, timedelta
 
-import boto3
-from botocore.client import Config
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 
 from flask import (abort, flash, redirect, render_template, 
-  request, session, url_for, send_file)
+  request, session, url_for, send_file, jsonify, Response,
+  stream_with_context)
 from app import app, db
 from decorators import authenticated, is_premium
 
 from auth import get_profile
+import dedup
+import joblist
+import awsclients
+import logview
+
+# boto3 clients and resources shared by all requests of this worker
+# process (see awsclients.py)
+aws = awsclients.ClientRegistry(app.config['AWS_REGION_NAME'],
+  max_pool_connections=app.config['AWS_CLIENT_MAX_POOL_CONNECTIONS'],
+  connect_timeout=app.config['AWS_CLIENT_CONNECT_TIMEOUT'],
+  read_timeout=app.config['AWS_CLIENT_READ_TIMEOUT'],
+  max_attempts=app.config['AWS_CLIENT_MAX_ATTEMPTS'],
+  retry_mode=app.config['AWS_CLIENT_RETRY_MODE'])
+
+# Small annotation logs, kept by each worker process (see logview.py)
+log_cache = logview.LogCache(entries=app.config['GAS_LOG_CACHE_ENTRIES'],
+  max_bytes=app.config['GAS_LOG_CACHE_MAX_BYTES'])
 
 """Start annotation request
 Create the required AWS S3 policy document and render a form for
@@ -33,9 +49,7 @@ uploading an annotation input file using the policy document
 @authenticated
 def annotate():
   # Open a connection to the S3 service
-  s3 = boto3.client('s3', 
-    region_name=app.config['AWS_REGION_NAME'], 
-    config=Config(signature_version='s3v4'))
+  s3 = aws.client('s3')
 
   # Get bucket name and user id
   bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
@@ -51,14 +65,17 @@ def annotate():
   # Define policy conditions
   encryption = app.config['AWS_S3_ENCRYPTION']
   acl = app.config['AWS_S3_ACL']
+  # S3 computes and stores the SHA-256 of the upload (see dedup.py)
   fields = {
     "success_action_redirect": redirect_url,
     "x-amz-server-side-encryption": encryption,
+    "x-amz-checksum-algorithm": dedup.CHECKSUM_ALGORITHM,
     "acl": acl
   }
   conditions = [
     ["starts-with", "$success_action_redirect", redirect_url],
     {"x-amz-server-side-encryption": encryption},
+    {"x-amz-checksum-algorithm": dedup.CHECKSUM_ALGORITHM},
     {"acl": acl}
   ]
 
@@ -110,7 +127,7 @@ def create_annotation_job_request():
   # ============ Working with annotation DynamoDB ==============
   # Get connection to Dynamodb
   # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table    
-  dynamodb = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  dynamodb = aws.resource('dynamodb')
   try:
     table = dynamodb.Table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"])
   except ClientError as e:
@@ -121,6 +138,25 @@ def create_annotation_job_request():
       message=f'Cannot get table from Dynamodb: {e}'
     )
 
+  # Look for the results of an identical earlier input (see dedup.py);
+  # any failure here just means the job is annotated as usual
+  input_hash = None
+  cached = None
+  if app.config['GAS_RESULTS_DEDUP']:
+    s3 = aws.client('s3')
+    try:
+      input_hash = dedup.content_hash(s3, bucket_name, s3_key,
+        app.config['GAS_REFERENCE_VERSION'])
+      index_table = dynamodb.Table(app.config['AWS_DYNAMODB_RESULTS_INDEX_TABLE'])
+      entry = dedup.find_result(index_table, input_hash) \
+        if (input_hash is not None) else None
+      if entry is not None:
+        keys = dedup.copy_result(s3, index_table, entry, path, job_id)
+        if keys is not None:
+          cached = (entry, keys)
+    except ClientError as e:
+      app.logger.error(f'Cannot reuse the results of an identical input: {e}')
+
   # Create a job item and persist it to the annotations database
   data = { "job_id": job_id,
            "user_id": session['primary_identity'],
@@ -131,6 +167,18 @@ def create_annotation_job_request():
            "job_status": "PENDING",
            "archived": False
          }
+  if input_hash is not None:
+    data['content_hash'] = input_hash
+  if cached is not None:
+    (entry, (key_result_file, key_log_file)) = cached
+    data.update({
+      "job_status": "COMPLETED",
+      "complete_time": int(time.time()),
+      "s3_results_bucket": entry['s3_results_bucket'],
+      "s3_key_result_file": key_result_file,
+      "s3_key_log_file": key_log_file,
+      "results_copied_from": entry['job_id']
+    })
   # Put the data into dynamodb
   # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.put_item
   try:
@@ -143,11 +191,14 @@ def create_annotation_job_request():
       message=f'Cannot put an item into Dynamodb: {e}'
     )
 
+  if cached is not None:
+    return complete_cached_job(data)
+
   # ============ Working with SNS and SQS =============
   # Publishes a notification message to the SNS topic
   # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.publish
   # Create SNS client
-  sns_client = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+  sns_client = aws.client('sns')
 
   # Get SNS topic arn
   sns_topic_arn = app.config["AWS_SNS_JOB_REQUEST_TOPIC"]
@@ -179,112 +230,137 @@ def create_annotation_job_request():
   return render_template('annotate_confirm.html', job_id=job_id)
 
 
-"""List all annotations for the user
+"""Finishes a job whose results were copied from an identical input
+Sends the same results notification and starts the same archive step
+function as the annotator does for a completed job.
 """
-@app.route('/annotations', methods=['GET'])
-@authenticated
-def annotations_list():
-  # Define a timedelta
-  epoch = datetime(1900, 1, 1)
+def complete_cached_job(data):
+  job_id = data['job_id']
+  user_id = data['user_id']
+  profile = get_profile(identity_id=user_id)
+  message = {
+    "job_id": job_id,
+    "complete_time": data['complete_time'],
+    "url": url_for('annotation_details', id=job_id, _external=True),
+    "email": profile.email,
+    "key_result": data['s3_key_result_file'],
+    "user_id": user_id
+  }
+
+  try:
+    sns_client = aws.client('sns')
+    sns_client.publish(
+      TopicArn=app.config['AWS_SNS_JOB_RESULTS_TOPIC'],
+      Message=json.dumps({'default': json.dumps(message)}),
+      MessageStructure='json'
+    )
+    sfn_client = aws.client('stepfunctions')
+    sfn_client.start_execution(
+      stateMachineArn=app.config['AWS_SFN_ARCHIVE_STATE_MACHINE'],
+      name=job_id,
+      input=json.dumps(message)
+    )
+  except ClientError as e:
+    app.logger.error(f'Unable to notify completion of job {job_id}: {e}')
 
+  return render_template('annotate_confirm.html', job_id=job_id)
+
+
+"""One page of the user's annotations, for annotations_list and
+annotations_page
+Reads the status, since, until and cursor query arguments and returns
+the filters, the jobs of the page and the cursor of the next page (see
+joblist.py). Raises ValueError for invalid arguments and ClientError if
+DynamoDB cannot be queried.
+"""
+def read_annotations_page(page_size):
   # Get authentic user id
   user_id = session['primary_identity']
 
   # Get connection to Dynamodb
-  dynamodb = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
-  try:
-    table = dynamodb.Table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"])
-  except ClientError as e:
-    app.logger.error(f'Cannot get table from Dynamodb: {e}')
-    return render_template('error.html',
-      title="Internal Error",
-      alert_level='warning',
-      message=f'Cannot get table from Dynamodb: {e}'
-    )
-  
-  # Reading items from gas-inputs bucket
-  # Get connection to S3
-  s3 = boto3.client('s3', 
-    region_name=app.config['AWS_REGION_NAME'], 
-    config=Config(signature_version='s3v4')
-  )
+  dynamodb = aws.resource('dynamodb')
+  table = dynamodb.Table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"])
 
-  # Prefix with authentic user
-  prefix_authentic = app.config['AWS_S3_KEY_PREFIX'] + user_id
+  filters = {
+    'status': request.args.get('status', ''),
+    'since': request.args.get('since', ''),
+    'until': request.args.get('until', '')
+  }
 
-  # Get items
+  # Read one page of the user's jobs through the user_id index
+  (items, next_cursor) = joblist.list_jobs(table,
+    app.config['AWS_DYNAMODB_USER_ID_INDEX'], user_id,
+    page_size=page_size,
+    cursor=request.args.get('cursor'),
+    status=filters['status'],
+    since=joblist.parse_date(filters['since']),
+    until=joblist.parse_date(filters['until']))
+
+  annotation_info = [{
+    "job_id": item['job_id'],
+    "request_time": joblist.request_time(item),
+    "vcf_file_name": item['input_file_name'],
+    "status": item['job_status']
+  } for item in items]
+  return (filters, annotation_info, next_cursor)
+
+
+"""List the user's annotations
+Renders the first GAS_ANNOTATIONS_FIRST_PAGE_SIZE jobs (or the page at
+cursor); the page loads further jobs from annotations_page as the user
+scrolls. Optional query arguments: status (PENDING, RUNNING or
+COMPLETED), since and until (YYYY-MM-DD submit dates) and cursor.
+"""
+@app.route('/annotations', methods=['GET'])
+@authenticated
+def annotations_list():
   try:
-    objects = s3.list_objects(
-      Bucket=app.config['AWS_S3_INPUTS_BUCKET'], 
-      Prefix=prefix_authentic
-    )
+    (filters, annotation_info, next_cursor) = read_annotations_page(
+      app.config['GAS_ANNOTATIONS_FIRST_PAGE_SIZE'])
+  except ValueError as e:
+    return render_template('error.html',
+      title="Bad Request",
+      alert_level='warning',
+      message=f'Cannot list annotations: {e}'
+    ), 400
   except ClientError as e:
-    app.logger.error(f'Cannot list objects from S3: {e}')
+    app.logger.error(f'Cannot query Dynamodb: {e}')
     return render_template('error.html',
       title="Internal Error",
       alert_level='warning',
-      message=f'Cannot list objects from S3: {e}'
+      message=f'Cannot query Dynamodb: {e}'
     )
 
-  annotation_info = []
-  if "Contents" in objects:
-    for obj in objects["Contents"]:
-      # Get job_id
-      file_key = obj["Key"]
-      job_id = file_key.split('/')[2].split('~')[0]
-      
-      # Get required info by querying DynamoDB
-      try:
-        query_results = table.query(
-          KeyConditionExpression=Key("job_id").eq(job_id)
-        )
-      except ClientError as e:
-        app.logger.error(f'Cannot query Dynamodb: {e}')
-        return render_template('error.html',
-          title="Internal Error",
-          alert_level='warning',
-          message=f'Cannot query Dynamodb: {e}'
-        )
-
-      # Not matching item
-      if len(query_results['Items']) == 0:
-        continue 
+  return render_template('annotations.html', annotations=annotation_info,
+    filters=filters, statuses=joblist.JOB_STATUSES,
+    cursor=request.args.get('cursor'), next_cursor=next_cursor)
 
-      # Found matching item
-      item = query_results['Items'][0]
-      # print(item)
 
-      # Process time format
-      request_time = time.localtime(float(item['submit_time']))
-      month = str(request_time.tm_mon)
-      if len(month) < 2:
-        month = '0' + month
-
-      day = str(request_time.tm_mday)
-      if len(day) < 2:
-        day = '0' + day
-
-      hour = str(request_time.tm_hour)
-      if len(hour) < 2:
-        hour = '0' + hour
-
-      minute = str(request_time.tm_min)
-      if len(minute) < 2:
-        minute = '0' + minute
-
-      request_time = f"{request_time.tm_year}-{month}-{day} {hour}:{minute}"
-
-      vcf_file_name = item['input_file_name']
-      status = item['job_status']
+"""Next page of the user's annotations as JSON, for infinite scroll
+Takes the query arguments of annotations_list; returns the jobs of the
+page and the cursor of the page after it (null after the last page).
+"""
+@app.route('/annotations.json', methods=['GET'])
+@authenticated
+def annotations_page():
+  try:
+    (filters, annotation_info, next_cursor) = read_annotations_page(
+      app.config['GAS_ANNOTATIONS_PAGE_SIZE'])
+  except ValueError as e:
+    return jsonify({
+      "code": 400,
+      "error": f'Cannot list annotations: {e}'
+    }), 400
+  except ClientError as e:
+    app.logger.error(f'Cannot query Dynamodb: {e}')
+    return jsonify({
+      "code": 500,
+      "error": f'Cannot query Dynamodb: {e}'
+    }), 500
 
-      annotation_info.append({
-        "job_id": job_id,
-        "request_time": request_time,
-        "vcf_file_name": vcf_file_name,
-        "status": status
-      })
-    
-  return render_template('annotations.html', annotations=annotation_info)
+  for annotation in annotation_info:
+    annotation['url'] = url_for('annotation_details', id=annotation['job_id'])
+  return jsonify({'annotations': annotation_info, 'next_cursor': next_cursor})
 
 
 """Display details of a specific annotation job
@@ -293,7 +369,7 @@ def annotations_list():
 @authenticated
 def annotation_details(id):
   # Get job info from DynamoDB using job id
-  dynamodb = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  dynamodb = aws.resource('dynamodb')
   try:
     table = dynamodb.Table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"])
   except ClientError as e:
@@ -377,13 +453,13 @@ def annotation_details(id):
     status = item['job_status']
 
     # Generate presigned_url for downloading
-    s3 = boto3.client('s3', 
-    region_name=app.config['AWS_REGION_NAME'], 
-    config=Config(signature_version='s3v4'))
+    s3 = aws.client('s3')
 
-    # Annotation File key
+    # Annotation File key, as recorded by the annotator (.annot.vcf or
+    # .annot.vcf.gz)
     file_name_prefix = vcf_file_name.split('.')[0]
-    key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + id + f'~{file_name_prefix}.annot.vcf'
+    key_name = item.get('s3_key_result_file',
+      app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + id + f'~{file_name_prefix}.annot.vcf')
 
     # Get presigned url to download file
     # https://allwin-raju-12.medium.com/boto3-and-python-upload-download-generate-pre-signed-urls-and-delete-files-from-the-bucket-87b959f7bbaf
@@ -436,54 +512,53 @@ def annotation_details(id):
     return render_template('annotation.html', annotations=annotation_info, download_url=presigned_url)
 
 
-"""Display the log file contents for an annotation job
+"""Bucket and key of the log file of one of the user's annotation jobs
+Aborts with 404 for an unknown job and 403 for another user's job.
 """
-@app.route('/annotations/<id>/log', methods=['GET'])
-@authenticated
-def annotation_log(id):
-  # Read log file from S3 bucket
+def log_location(id):
   # Get user id
   user_id = session['primary_identity']
 
-  # Get file key
-  # Read from DynamoDB for file name
-  dynamodb = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
-  try:
-    table = dynamodb.Table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"])
-  except ClientError as e:
-    app.logger.error(f'Cannot get table from Dynamodb: {e}')
-    return render_template('error.html',
-      title="Internal Error",
-      alert_level='warning',
-      message=f'Cannot get table from Dynamodb: {e}'
-    )
-
   # Get required info by querying DynamoDB
+  table = aws.resource('dynamodb').Table(
+    app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"])
   query_results = table.query(
     KeyConditionExpression=Key("job_id").eq(id)
   )
-
-  # Get required info by querying DynamoDB
-  query_results = table.query(
-    KeyConditionExpression=Key("job_id").eq(id)
-  )
-
+  if len(query_results['Items']) == 0:
+    abort(404)
   item = query_results['Items'][0]
-  vcf_file_name = item['input_file_name']
+  if user_id != item['user_id']:
+    abort(403)
 
   # Get prefix
-  file_name_prefix = vcf_file_name.split('.')[0]
+  file_name_prefix = item['input_file_name'].split('.')[0]
 
-  # Get file key
-  log_file_key = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + id + f'~{file_name_prefix}.vcf.count.log'
-  
-  # Get connection to s3
-  s3 = boto3.resource('s3')
+  # Get file key, as recorded by the annotator
+  log_file_key = item.get('s3_key_log_file',
+    app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + id + f'~{file_name_prefix}.vcf.count.log')
+  bucket_name = item.get('s3_results_bucket',
+    app.config['AWS_S3_RESULTS_BUCKET'])
+  return (bucket_name, log_file_key)
 
-  # Get object from S3
-  bucket_name = app.config['AWS_S3_RESULTS_BUCKET']
+
+"""Display the log file contents for an annotation job
+Shows the last GAS_LOG_TAIL_BYTES of the log; the whole log is served
+by annotation_log_text.
+"""
+@app.route('/annotations/<id>/log', methods=['GET'])
+@authenticated
+def annotation_log(id):
+  # Read the tail of the log file from S3
   try:
-    obj = s3.Object(bucket_name, log_file_key)
+    (bucket_name, log_file_key) = log_location(id)
+    s3 = aws.client('s3')
+    (size, etag) = logview.log_info(s3, bucket_name, log_file_key)
+    (start, end) = logview.tail_range(app.config['GAS_LOG_TAIL_BYTES'], size)
+    log_content = b''.join(logview.read_log(s3, log_cache, bucket_name,
+      log_file_key, size, etag, start, end,
+      chunk_size=app.config['GAS_LOG_CHUNK_SIZE'])).decode('utf-8',
+      errors='replace')
   except ClientError as e:
     app.logger.error(f'Cannot get the log file: {e}')
     return render_template('error.html',
@@ -492,12 +567,53 @@ def annotation_log(id):
       message=f'Cannot get the log file: {e}'
     )
 
-  log_content = obj.get()['Body'].read().decode('utf-8')
+  # Start the tail at a whole line
+  if (start > 0):
+    log_content = log_content.split('\n', 1)[-1]
 
-  # Replace '\n' with <br> in HTML
-  log_content = log_content.replace('\n', '<br>')
+  return render_template('view_log.html', log=log_content, job_id=id,
+    log_size=size, truncated=(start > 0))
 
-  return render_template('view_log.html', log=log_content, job_id=id)
+
+"""Stream the log file of an annotation job as text
+Reads the log from S3 in chunks. Supports single HTTP byte ranges
+(Range: bytes=start-end, bytes=start- and bytes=-length), and ?tail=<KB>
+for the last KB of the log.
+"""
+@app.route('/annotations/<id>/log.txt', methods=['GET'])
+@authenticated
+def annotation_log_text(id):
+  try:
+    (bucket_name, log_file_key) = log_location(id)
+    s3 = aws.client('s3')
+    (size, etag) = logview.log_info(s3, bucket_name, log_file_key)
+  except ClientError as e:
+    app.logger.error(f'Cannot get the log file: {e}')
+    abort(500)
+
+  headers = {'Accept-Ranges': 'bytes', 'ETag': etag}
+  status = 200
+  (start, end) = (0, size - 1)
+  if request.args.get('tail'):
+    tail = request.args['tail']
+    if not tail.isdigit() or (int(tail) == 0):
+      abort(400)
+    (start, end) = logview.tail_range(int(tail) * 1024, size)
+  else:
+    try:
+      byte_range = logview.parse_range(request.headers.get('Range'), size)
+    except ValueError:
+      return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+    if byte_range is not None:
+      (start, end) = byte_range
+      status = 206
+      headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+  headers['Content-Length'] = str(max(0, end - start + 1))
+  chunks = logview.read_log(s3, log_cache, bucket_name, log_file_key, size,
+    etag, start, end, chunk_size=app.config['GAS_LOG_CHUNK_SIZE'])
+  return Response(stream_with_context(chunks), status=status,
+    headers=headers, mimetype='text/plain')
 
 
 """Subscription management handler
@@ -586,7 +702,7 @@ def subscribe():
     # ...and make sure you handle files not yet archived!
 
     # Publish message for a thaw job with user id
-    sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+    sns = aws.client('sns')
     data = {"user_id": user_id}
 
     try:
@@ -635,6 +751,15 @@ def unsubscribe():
   return redirect(url_for('profile'))
 
 
+"""boto3 clients and resources created and reused by this worker
+process, and the requests and connections of each service
+"""
+@app.route('/aws-client-metrics', methods=['GET'])
+@authenticated
+def aws_client_metrics():
+  return jsonify(aws.stats()), 200
+
+
 
 """DO NOT CHANGE CODE BELOW THIS LINE
 *******************************************************************************